@@ -0,0 +1,75 @@
+""" Throughput of many concurrent readers of one file that is still being downloaded.
+
+Run from the repository root: python -m benchmarks.concurrent_reads [-s MiB] [-r READERS]
+
+Every reader opens the file and reads it in 128 KiB blocks, starting at a different offset. The fake download
+is throttled to `--bandwidth` MiB/s per connection. Both read paths are measured: positional reads (`os.pread`)
+and seek + read under a lock (the fallback where `os.pread` is missing).
+"""
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from threading import Thread
+from dropbox_fs import cache
+from dropbox_fs.cache import FileCache
+from dropbox_fs.crawler import File
+from benchmarks.fake_dropbox import FakeDropbox, FakeSession, content_hash
+
+block_size = 2 ** 17
+
+
+def reader(file_cache, db_file, start, latencies):
+    fh = file_cache.open('/file', 'file', db_file, '/file', os.O_RDONLY)
+    offset = start
+    for _ in range(0, db_file.size, block_size):
+        t0 = time.perf_counter()
+        file_cache.read('/file', block_size, offset, fh)
+        latencies.append(time.perf_counter() - t0)
+        offset = (offset + block_size) % db_file.size
+    file_cache.close(fh)
+
+
+def run(name, content, args):
+    dbx = FakeDropbox()
+    dbx.add_file('/file', content)
+    db_file = File('file', len(content), 0, content_hash=content_hash(content))
+    with tempfile.TemporaryDirectory() as base_path:
+        file_cache = FileCache(Path(base_path), dbx, download_workers=args.workers)
+        file_cache.scheduler.session = FakeSession(dbx, bandwidth=args.bandwidth * 2 ** 20)
+        latencies = []
+        threads = [Thread(target=reader, args=(file_cache, db_file, i * len(content) // args.readers, latencies))
+                   for i in range(args.readers)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        dt = time.perf_counter() - t0
+    latencies.sort()
+    print('{:<6} {:8.2f}s {:10.1f} MiB/s read  latency p50 {:7.2f}ms  p99 {:7.2f}ms'.format(
+        name, dt, args.readers * len(content) / dt / 2 ** 20, latencies[len(latencies) // 2] * 1000,
+        latencies[len(latencies) * 99 // 100] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--size', type=int, default=64, help='MiB')
+    parser.add_argument('-r', '--readers', type=int, default=16)
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('-b', '--bandwidth', type=float, default=50, help='MiB/s per connection')
+    args = parser.parse_args()
+
+    content = os.urandom(args.size * 2 ** 20)
+    print('{} readers of a {} MiB file'.format(args.readers, args.size))
+    pread = cache.use_pread
+    if pread:
+        run('pread', content, args)
+    cache.use_pread = False
+    run('seek', content, args)
+    cache.use_pread = pread
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+""" Initial crawl throughput of `DropboxCrawler.crawl` against a `FakeDropbox`, for each storage.
+
+Run from the repository root: python -m benchmarks.crawl [-n ENTRIES] [-l LATENCY] [-w WORKERS]
+
+The crawl saves a snapshot after every page, with 'pickle' that is the whole tree each time (quadratic in the
+tree size), so 'pickle' is skipped above `--pickle-limit` entries.
+"""
+import argparse
+import os
+import time
+from benchmarks.fake_dropbox import FakeDropbox, FakeCrawler, account_tree, data_folder
+
+
+def initial_crawl(dbx, storage='pickle', workers=1):
+    """ a `FakeCrawler` after the initial crawl of `dbx` (call it within `data_folder`) """
+    crawler = FakeCrawler(dbx)
+    crawler.crawl_workers = workers
+    crawler.init('token', '', None, storage)
+    crawler.finished_initial_crawl_callback = lambda: setattr(crawler, '_stop_request', True)
+    crawler.crawl()
+    return crawler
+
+
+def data_size():
+    return sum(os.path.getsize(f) for f in os.listdir('.') if f.startswith('data.'))
+
+
+def run(dbx, storages, workers, pickle_limit):
+    print('{:<8} {:>9} entries {:>3} workers'.format('', len(dbx), workers))
+    for storage in storages:
+        if storage == 'pickle' and len(dbx) > pickle_limit:
+            print('{:<8} skipped'.format(storage))
+            continue
+        with data_folder():
+            t0 = time.perf_counter()
+            crawler = initial_crawl(dbx, storage, workers)
+            dt = time.perf_counter() - t0
+            print('{:<8} {:8.2f}s {:>10.0f} entries/s {:8.1f} MiB on disk'.format(
+                storage, dt, len(dbx) / dt, data_size() / 2 ** 20))
+            del crawler
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--entries', type=int, default=100000)
+    parser.add_argument('-l', '--latency', type=float, default=0, help='ms per API call')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='crawl workers (> 1: partitioned crawl)')
+    parser.add_argument('-s', '--storage', default='pickle,journal,sqlite')
+    parser.add_argument('--pickle-limit', type=int, default=200000)
+    args = parser.parse_args()
+    dbx = FakeDropbox(account_tree(args.entries), latency=args.latency / 1000)
+    run(dbx, args.storage.split(','), args.workers, args.pickle_limit)
+
+
+if __name__ == '__main__':
+    main()
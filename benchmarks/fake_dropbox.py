@@ -0,0 +1,407 @@
+""" In-memory stand-ins for the dropbox client and the HTTP session of the download scheduler.
+
+`FakeDropbox` serves a synthetic account (see `account_tree`) through the calls dropbox_fs makes: listing with
+paged cursors, longpoll, temporary links / downloads, uploads (also in sessions and batches), deleting, moving,
+creating folders and the space usage. Every call can be slowed down by a fixed latency, downloads and uploads
+additionally by a bandwidth limit per connection.
+"""
+import contextlib
+import hashlib
+import itertools
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from dropbox.exceptions import ApiError
+from dropbox.files import FileMetadata, FolderMetadata, DeletedMetadata, ListFolderResult, LookupError, \
+    WriteConflictError, WriteError, DeleteError, RelocationError, CreateFolderError, UploadSessionLookupError, \
+    UploadSessionOffsetError, UploadSessionFinishError, UploadSessionFinishBatchResultEntry
+from dropbox_fs.crawler import DropboxCrawler, base_path_depth
+from benchmarks.update_tree import file_entry, folder_entry, page_size
+
+
+def content_hash(data, block_size=2 ** 22):
+    """ https://www.dropbox.com/developers/reference/content-hash """
+    blocks = b''.join(hashlib.sha256(data[i:i + block_size]).digest() for i in range(0, len(data), block_size))
+    return hashlib.sha256(blocks).digest()
+
+
+def account_tree(n, files_per_folder=20, folders_per_folder=4):
+    """ `n` entries, breadth first: every folder has `files_per_folder` files and `folders_per_folder` sub folders
+    (as tuples (path_display, i, is_folder), `FakeDropbox` only turns them into metadata when they are listed) """
+    queue = deque([''])
+    i = 0
+    while i < n:
+        folder = queue.popleft()
+        for j in range(files_per_folder):
+            if i >= n:
+                return
+            yield '{}/File {}.txt'.format(folder, j), i, False
+            i += 1
+        for j in range(folders_per_folder):
+            if i >= n:
+                return
+            path = '{}/Folder {}'.format(folder, j)
+            yield path, i, True
+            queue.append(path)
+            i += 1
+
+
+class FakeResponse:
+    def __init__(self, session, data, status_code):
+        self.session, self.data, self.status_code = session, data, status_code
+        self.headers = {}
+
+    @property
+    def content(self):
+        return b''.join(self.iter_content(2 ** 16))
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            if self.session.bandwidth is not None:  # bytes/s per connection
+                time.sleep(min(chunk_size, len(self.data) - i) / self.session.bandwidth)
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        with self.session.lock:
+            self.session.active -= 1
+
+
+class FakeSession:
+    """ Serves range requests for the temporary links of a `FakeDropbox` """
+
+    def __init__(self, dbx, bandwidth=None, latency=0):
+        self.dbx = dbx
+        self.bandwidth = bandwidth
+        self.latency = latency  # seconds per request
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.active = 0
+        self.max_active = 0
+
+    def get(self, link, headers=None, stream=True, timeout=None):
+        data = self.dbx.content(link)
+        start, end = 0, len(data) - 1
+        if headers is not None and 'Range' in headers:
+            start, end = (int(i) for i in headers['Range'][len('bytes='):].split('-'))
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            self.bytes += end + 1 - start
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        return FakeResponse(self, data[start:end + 1], 206)
+
+
+class FakeDropbox:
+    """ The parts of `dropbox.Dropbox` dropbox_fs uses, for an account of `tree` (see `account_tree`) and the files
+    added with `add_file`.
+
+    Cursors are immutable strings ('<listing>:<position>:<version>'), so saved cursors can be continued like real
+    ones. Once a listing is exhausted its cursor returns the changes made with `change` since it was created.
+    Uploads, deletions, moves and new folders are changes like that as well.
+    """
+
+    def __init__(self, tree=(), latency=0, bandwidth=None, longpoll_timeout=1):
+        self.latency = latency  # seconds per API call
+        self.session = FakeSession(self, bandwidth, latency)  # for `DownloadScheduler.session`
+        self.longpoll_timeout = longpoll_timeout  # maximum seconds a longpoll waits (regardless of its timeout)
+        self.calls = {}
+        self.files = {}  # path or 'rev:<rev>' -> content
+        self.entries = {}  # path_lower -> (path_display, i, is_folder) or metadata
+        self._log = []  # (path_lower, metadata) of every change
+        self._listings = []  # (path_lower, recursive, entries)
+        self._changed = threading.Condition()
+        self.received = 0  # uploaded bytes
+        self._sessions = {}  # upload session id -> [content, closed]
+        self._session_ids = itertools.count()
+        for entry in tree:
+            self.entries[entry[0].lower()] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_file(self, path, content, rev=None):
+        metadata = self.entries[path.lower()] = self._file(path, content, rev)
+        self.files[path] = content
+        self.files['rev:' + metadata.rev] = content
+
+    def change(self, entries):
+        """ applies metadata (`FileMetadata`, `FolderMetadata` or `DeletedMetadata`, e.g. from `modified`) to the
+        account and wakes up the longpolls """
+        with self._changed:
+            for e in entries:
+                if isinstance(e, DeletedMetadata):
+                    prefix = e.path_lower + '/'
+                    for key in [key for key in self.entries if key == e.path_lower or key.startswith(prefix)]:
+                        del self.entries[key]
+                else:
+                    self.entries[e.path_lower] = e
+                self._log.append((e.path_lower, e))
+            self._changed.notify_all()
+
+    def modified(self, n, start=0):
+        """ new revisions of `n` of the account's files """
+        files = [e for e in self.entries.values() if not self._is_folder(e)]
+        return [file_entry(self._path(e), 10 ** 9 + len(self._log) + i) for i, e in enumerate(files[start:start + n])]
+
+    def files_list_folder(self, path, recursive=False, include_deleted=False, limit=None):
+        self._call('files_list_folder')
+        key = path.lower()
+        if recursive:
+            prefix = key + '/'
+            entries = [e for k, e in self.entries.items() if k == key or k.startswith(prefix)]
+        else:
+            entries = [e for k, e in self.entries.items() if k.rsplit('/', 1)[0] == key]
+        return self._page(self._listing(key, recursive, entries), 0, len(self._log))
+
+    def files_list_folder_continue(self, cursor):
+        self._call('files_list_folder_continue')
+        listing, position, version = (int(i) for i in cursor.split(':'))
+        return self._page(listing, position, version)
+
+    def files_list_folder_get_latest_cursor(self, path, recursive=False, include_deleted=False):
+        self._call('files_list_folder_get_latest_cursor')
+        return SimpleNamespace(cursor='{}:0:{}'.format(self._listing(path.lower(), recursive, []), len(self._log)))
+
+    def files_list_folder_longpoll(self, cursor, timeout=30):
+        self._call('files_list_folder_longpoll')
+        listing, _, version = (int(i) for i in cursor.split(':'))
+        with self._changed:
+            self._changed.wait_for(lambda: len(self._changes(listing, version, 1)) > 0,
+                                   min(timeout, self.longpoll_timeout))
+            return SimpleNamespace(changes=len(self._changes(listing, version, 1)) > 0, backoff=None)
+
+    def files_get_temporary_link(self, path):
+        self._call('files_get_temporary_link')
+        if path not in self.files:
+            raise KeyError(path)
+        return SimpleNamespace(link='fake://' + path)
+
+    def files_download(self, path, rev=None):
+        self._call('files_download')
+        key = path if rev is None else 'rev:' + rev
+        if key not in self.files:
+            raise KeyError(key)
+        response = self.session.get('fake://' + key)
+        return self.entries[path.lower()], response
+
+    def files_upload(self, f, path, mode=None, client_modified=None, **kwargs):
+        self._call('files_upload')
+        self._receive(f)
+        return self._commit(path, bytes(f))
+
+    def files_upload_session_start(self, f, close=False, **kwargs):
+        self._call('files_upload_session_start')
+        self._receive(f)
+        with self._changed:
+            session_id = 'session:{}'.format(next(self._session_ids))
+            self._sessions[session_id] = [bytearray(f), close]
+        return SimpleNamespace(session_id=session_id)
+
+    def files_upload_session_append_v2(self, f, cursor, close=False):
+        self._call('files_upload_session_append_v2')
+        self._receive(f)
+        session = self._sessions.get(cursor.session_id)
+        error = self._session_error(session, cursor.offset, closed=False)
+        if error is not None:
+            raise ApiError(None, error, None, None)
+        session[0] += f
+        session[1] = close
+
+    def files_upload_session_finish_batch_v2(self, entries):
+        self._call('files_upload_session_finish_batch_v2')
+        results = []
+        for e in entries:
+            with self._changed:
+                session = self._sessions.get(e.cursor.session_id)
+                error = self._session_error(session, e.cursor.offset, closed=True)
+                if error is None:
+                    del self._sessions[e.cursor.session_id]
+            if error is not None:
+                results.append(UploadSessionFinishBatchResultEntry.failure(
+                    UploadSessionFinishError.lookup_failed(error)))
+            else:
+                results.append(UploadSessionFinishBatchResultEntry.success(self._commit(e.commit.path,
+                                                                                        bytes(session[0]))))
+        return SimpleNamespace(entries=results)
+
+    def files_delete_v2(self, path):
+        self._call('files_delete_v2')
+        e = self.entries.get(path.lower())
+        if e is None:
+            raise ApiError(None, DeleteError.path_lookup(LookupError.not_found), None, None)
+        metadata = self.metadata(e)
+        self.change([DeletedMetadata(name=metadata.name, path_lower=metadata.path_lower,
+                                     path_display=metadata.path_display)])
+        return SimpleNamespace(metadata=metadata)
+
+    def files_move_v2(self, from_path, to_path):
+        self._call('files_move_v2')
+        key, to_key = from_path.lower(), to_path.lower()
+        if key not in self.entries:
+            raise ApiError(None, RelocationError.from_lookup(LookupError.not_found), None, None)
+        if to_key in self.entries and to_key != key:
+            raise ApiError(None, RelocationError.to(WriteError.conflict(WriteConflictError.file)), None, None)
+        prefix = key + '/'
+        moved = []
+        for k, e in list(self.entries.items()):
+            if k == key or k.startswith(prefix):
+                path = self._path(e)
+                moved.append(self._moved(e, to_path + path[len(from_path):]))
+                if path in self.files:
+                    self.files[moved[-1].path_display] = self.files.pop(path)
+        metadata = self.metadata(self.entries[key])
+        self.change([DeletedMetadata(name=metadata.name, path_lower=key, path_display=from_path)] + moved)
+        return SimpleNamespace(metadata=next(e for e in moved if e.path_lower == to_key))
+
+    def files_create_folder_v2(self, path):
+        self._call('files_create_folder_v2')
+        if path.lower() in self.entries:
+            raise ApiError(None, CreateFolderError.path(WriteError.conflict(WriteConflictError.folder)), None, None)
+        metadata = folder_entry(path, len(self._log))
+        self.change([metadata])
+        return SimpleNamespace(metadata=metadata)
+
+    def users_get_space_usage(self):
+        self._call('users_get_space_usage')
+        used = sum(e.size if isinstance(e, FileMetadata) else e[1] for e in self.entries.values()
+                   if not self._is_folder(e))
+        allocation = SimpleNamespace(get_individual=lambda: SimpleNamespace(allocated=2 ** 40))
+        return SimpleNamespace(used=used, allocation=allocation)
+
+    def users_get_current_account(self):
+        self._call('users_get_current_account')
+        return SimpleNamespace(name=SimpleNamespace(display_name='Benchmark'))
+
+    def content(self, link):
+        return self.files[link[len('fake://'):]]
+
+    def _receive(self, data):
+        if self.session.bandwidth is not None:
+            time.sleep(len(data) / self.session.bandwidth)
+        with self._changed:
+            self.received += len(data)
+
+    @staticmethod
+    def _session_error(session, offset, closed):
+        """ why an upload session can't be continued (closed=False) or committed (closed=True) at `offset` """
+        if session is None:
+            return UploadSessionLookupError.not_found
+        if session[1] != closed:
+            return UploadSessionLookupError.closed if session[1] else UploadSessionLookupError.not_closed
+        if len(session[0]) != offset:
+            return UploadSessionLookupError.incorrect_offset(UploadSessionOffsetError(correct_offset=len(session[0])))
+        return None
+
+    def _commit(self, path, content):
+        """ stores an uploaded file (overwriting what is there) """
+        with self._changed:
+            rev = '{:09x}'.format(2 ** 32 + len(self._log))
+        metadata = self._file(path, content, rev, datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None))
+        self.files[path] = content
+        self.files['rev:' + rev] = content
+        self.change([metadata])
+        return metadata
+
+    def _moved(self, e, path):
+        """ the metadata of an entry at its new path """
+        m = self.metadata(e)
+        if isinstance(m, FolderMetadata):
+            return FolderMetadata(name=path.rsplit('/', 1)[-1], id=m.id, path_display=path, path_lower=path.lower())
+        return FileMetadata(name=path.rsplit('/', 1)[-1], id=m.id, path_display=path, path_lower=path.lower(),
+                            rev=m.rev, size=m.size, client_modified=m.client_modified,
+                            server_modified=m.server_modified, content_hash=m.content_hash)
+
+    def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _listing(self, key, recursive, entries):
+        with self._changed:
+            self._listings.append((key, recursive, entries))
+            return len(self._listings) - 1
+
+    def _page(self, listing, position, version):
+        _, _, entries = self._listings[listing]
+        if position < len(entries):
+            page = [self.metadata(e) for e in entries[position:position + page_size]]
+            position += len(page)
+            cursor = '{}:{}:{}'.format(listing, position, version)
+            return ListFolderResult(entries=page, cursor=cursor, has_more=True)
+        with self._changed:
+            changes = self._changes(listing, version, page_size)
+            version = changes[-1][0] + 1 if len(changes) > 0 else len(self._log)
+            has_more = len(self._changes(listing, version, 1)) > 0
+        return ListFolderResult(entries=[e for _, e in changes], cursor='{}:{}:{}'.format(listing, position, version),
+                                has_more=has_more)
+
+    def _changes(self, listing, version, limit):
+        """ up to `limit` (log index, metadata) of the changes below the listed folder since `version` """
+        key, recursive, _ = self._listings[listing]
+        prefix = key + '/'
+        changes = []
+        for i in range(version, len(self._log)):
+            path_lower, e = self._log[i]
+            if path_lower.rsplit('/', 1)[0] == key or (recursive and (path_lower == key or
+                                                                      path_lower.startswith(prefix))):
+                changes.append((i, e))
+                if len(changes) >= limit:
+                    break
+        return changes
+
+    @staticmethod
+    def metadata(e):
+        """ the dropbox metadata of an entry of `entries` """
+        if not isinstance(e, tuple):
+            return e
+        path, i, is_folder = e
+        return folder_entry(path, i) if is_folder else file_entry(path, i)
+
+    @staticmethod
+    def _is_folder(e):
+        return e[2] if isinstance(e, tuple) else isinstance(e, FolderMetadata)
+
+    @staticmethod
+    def _path(e):
+        return e[0] if isinstance(e, tuple) else e.path_display
+
+    def _file(self, path, content, rev, modified=datetime(2020, 1, 1)):
+        i = len(self.entries)
+        return FileMetadata(name=path.rsplit('/', 1)[-1], id='id:f{}'.format(i), path_display=path,
+                            path_lower=path.lower(), rev=rev or '{:09x}'.format(i + 1), size=len(content),
+                            client_modified=modified, server_modified=modified,
+                            content_hash=content_hash(content).hex())
+
+
+class FakeCrawler(DropboxCrawler):
+    """ A `DropboxCrawler` connected to a `FakeDropbox` """
+
+    def __init__(self, dbx: FakeDropbox, **kwargs):
+        super().__init__(**kwargs)
+        self.fake = dbx
+
+    def connect(self):
+        self._base_path_depth = base_path_depth(self._db_base_path)
+        self.dbx = self.fake
+
+
+@contextlib.contextmanager
+def data_folder():
+    """ runs the block in an empty temporary working directory (the crawler saves its data files there) """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(cwd)
@@ -0,0 +1,75 @@
+""" `FileCache` read throughput, cold (downloading from a `FakeDropbox`) and warm (cached).
+
+Run from the repository root: python -m benchmarks.file_cache [-f FILES] [-s MiB] [-r READERS]
+
+Every reader opens its share of the files one after another and reads each sequentially in 128 KiB blocks.
+"""
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from threading import Thread
+from dropbox_fs.cache import FileCache
+from dropbox_fs.crawler import File
+from benchmarks.fake_dropbox import FakeDropbox, content_hash
+
+block_size = 2 ** 17
+
+
+def reader(file_cache, files, first_bytes):
+    for path, db_file in files:
+        fh = file_cache.open(path, path[1:], db_file, path, os.O_RDONLY)
+        t0 = time.perf_counter()
+        for offset in range(0, db_file.size, block_size):
+            file_cache.read(path, block_size, offset, fh)
+            if offset == 0:
+                first_bytes.append(time.perf_counter() - t0)
+        file_cache.close(fh)
+
+
+def read_all(file_cache, files, readers):
+    first_bytes = []
+    threads = [Thread(target=reader, args=(file_cache, files[i::readers], first_bytes)) for i in range(readers)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - t0, sorted(first_bytes)
+
+
+def run(n_files, size, readers, workers, bandwidth, latency):
+    dbx = FakeDropbox(latency=latency, bandwidth=bandwidth)
+    files = []
+    for i in range(n_files):
+        content = os.urandom(size)
+        path = '/File {}.bin'.format(i)
+        dbx.add_file(path, content, '{:09x}'.format(i + 1))
+        files.append((path, File(path[1:], size, 0, '{:09x}'.format(i + 1), content_hash(content))))
+    print('{} files of {:.1f} MiB, {} readers'.format(n_files, size / 2 ** 20, readers))
+    with tempfile.TemporaryDirectory() as base_path:
+        file_cache = FileCache(Path(base_path), dbx, download_workers=workers)
+        file_cache.scheduler.session = dbx.session
+        for name in ['cold', 'warm']:
+            dt, first_bytes = read_all(file_cache, files, readers)
+            print('{:<6} {:8.2f}s {:10.1f} MiB/s  first byte p50 {:8.2f}ms  p99 {:8.2f}ms'.format(
+                name, dt, n_files * size / dt / 2 ** 20, first_bytes[len(first_bytes) // 2] * 1000,
+                first_bytes[len(first_bytes) * 99 // 100] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-f', '--files', type=int, default=64)
+    parser.add_argument('-s', '--size', type=float, default=4, help='MiB per file')
+    parser.add_argument('-r', '--readers', type=int, default=4)
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('-b', '--bandwidth', type=float, default=50, help='MiB/s per connection')
+    parser.add_argument('-l', '--latency', type=float, default=20, help='ms per request')
+    args = parser.parse_args()
+    run(args.files, int(args.size * 2 ** 20), args.readers, args.workers, args.bandwidth * 2 ** 20,
+        args.latency / 1000)
+
+
+if __name__ == '__main__':
+    main()
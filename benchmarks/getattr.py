@@ -0,0 +1,76 @@
+""" Micro-benchmark of `DropboxFs.getattr` and `readdir` latency, with and without the path cache.
+
+Run from the repository root: python -m benchmarks.getattr [-n ENTRIES] [-r ROUNDS] [--account]
+
+--account uses the breadth first tree of `fake_dropbox.account_tree` instead of deep folder chains.
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from fuse import FuseOSError
+from dropbox_fs.crawler import DropboxCrawler, Folder
+from dropbox_fs.fs import DropboxFs
+from benchmarks.update_tree import deep_tree, pages
+from benchmarks.fake_dropbox import FakeDropbox, account_tree
+
+
+def crawled(entries, local_folder):
+    crawler = DropboxCrawler()
+    crawler.root = Folder('')
+    crawler._base_path_depth = 0
+    crawler._db_base_path = ''
+    crawler._local_folder = local_folder
+    crawler._finished_crawling = True
+    for data in pages(entries):
+        crawler.update_tree(data)
+    return crawler
+
+
+def timed(fn, paths, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for path in paths:
+            try:
+                fn(path)
+            except FuseOSError:
+                pass
+    return (time.perf_counter() - t0) / (rounds * len(paths)) * 1e6
+
+
+def run(entries, rounds):
+    files = [e.path_display for e in entries if hasattr(e, 'size')]
+    folders = ['/'] + [e.path_display for e in entries if not hasattr(e, 'size')]
+    missing = [p + '.missing' for p in files[::10]]
+    with tempfile.TemporaryDirectory() as local_folder:
+        crawler = crawled(entries, Path(local_folder))
+        fs = DropboxFs(crawler, None)
+        while not fs.local_index.ready:  # (scanned in the background)
+            time.sleep(0.01)
+        print('{} files, {} folders (µs per call)'.format(len(files), len(folders)))
+        print('{:<10} {:>10} {:>10}'.format('', 'uncached', 'cached'))
+        for name, fn, paths in [('getattr', fs.getattr, files), ('ENOENT', fs.getattr, missing),
+                                ('readdir', lambda p: fs.readdir(p, None), folders)]:
+            fs.path_cache.size = 0
+            uncached = timed(fn, paths, rounds)
+            fs.path_cache.size = len(files) + len(folders) + len(missing)
+            timed(fn, paths, 1)  # warm up
+            cached = timed(fn, paths, rounds)
+            print('{:<10} {:>10.2f} {:>10.2f}'.format(name, uncached, cached))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--entries', type=int, default=50000)
+    parser.add_argument('-r', '--rounds', type=int, default=3)
+    parser.add_argument('--account', action='store_true')
+    args = parser.parse_args()
+    if args.account:
+        entries = [FakeDropbox.metadata(e) for e in account_tree(args.entries)]
+    else:
+        entries = list(deep_tree(args.entries))
+    run(entries, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+""" Overhead of the instrumentation (`DropboxFs.__call__`) on the read path.
+
+Run from the repository root: python -m benchmarks.metrics_overhead [-s MiB] [-r ROUNDS]
+
+Reads a cached file in blocks of 4 KiB and 128 KiB (the usual FUSE read size) through
+- "plain": `fuse.Operations.__call__`, the dispatch without any instrumentation,
+- "metrics": `DropboxFs.__call__`, which records the latency of every operation,
+- "before": the previous read path, `fuse.LoggingMixIn.__call__` (repr of every result) plus the `log.debug` of
+  `DropboxFs.read` (only if the installed fusepy has a `LoggingMixIn`).
+The overhead is relative to "plain"; the rounds of the variants are interleaved and the fastest one counts.
+In a mount every read also costs a kernel round trip and fusepy's ctypes marshalling, so the relative overhead
+there is lower than measured here.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from fuse import Operations, LoggingMixIn
+from dropbox_fs.cache import FileCache
+from dropbox_fs.crawler import File, Folder
+from dropbox_fs.fs import DropboxFs
+from benchmarks.fake_dropbox import FakeDropbox, FakeCrawler, content_hash
+
+log = logging.getLogger('dropbox_fs.fs')
+
+
+def plain(fs, *args):
+    return Operations.__call__(fs, *args)
+
+
+def before(fs, op, path, size, offset, fh):
+    log.debug('read {} @ {}: {}'.format(size, offset, path))
+    return LoggingMixIn.__call__(fs, op, path, size, offset, fh)
+
+
+def timed(call, fs, fh, size, block_size):
+    t0 = time.perf_counter()
+    for offset in range(0, size, block_size):
+        call(fs, 'read', '/file', block_size, offset, fh)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--size', type=int, default=64, help='MiB')
+    parser.add_argument('-r', '--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    content = os.urandom(args.size * 2 ** 20)
+    dbx = FakeDropbox()
+    dbx.add_file('/file', content)
+    crawler = FakeCrawler(dbx)
+    crawler.root = Folder('')
+    crawler._db_base_path = ''
+    crawler._base_path_depth = 0
+    crawler._local_folder = None
+    crawler._finished_crawling = True
+    crawler.root.add_file(File('file', len(content), 0, content_hash=content_hash(content)))
+    variants = [('plain', plain), ('metrics', DropboxFs.__call__)]
+    if '__call__' in vars(LoggingMixIn):
+        variants.append(('before', before))
+    with tempfile.TemporaryDirectory() as base_path:
+        file_cache = FileCache(Path(base_path), dbx)
+        file_cache.scheduler.session = dbx.session
+        fs = DropboxFs(crawler, file_cache)
+        fs.log = getattr(LoggingMixIn, 'log', None)  # (a class attribute of the mixin)
+        fh = fs('open', '/file', os.O_RDONLY)
+        timed(plain, fs, fh, len(content), 2 ** 20)  # downloads the file
+        print('{:<8} {:>10} {:>10} {:>10}'.format('block', 'variant', 'µs/read', 'overhead'))
+        for block_size in [2 ** 12, 2 ** 17]:
+            best = {name: float('inf') for name, _ in variants}
+            for _ in range(args.rounds):
+                for name, call in variants:
+                    best[name] = min(best[name], timed(call, fs, fh, len(content), block_size))
+            reads = len(content) // block_size
+            for name, _ in variants:
+                print('{:<8} {:>10} {:>10.2f} {:>9.1f}%'.format(
+                    '{} KiB'.format(block_size // 1024), name, best[name] / reads * 1e6,
+                    (best[name] / best['plain'] - 1) * 100))
+        fs('release', '/file', fh)
+
+
+if __name__ == '__main__':
+    main()
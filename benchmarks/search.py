@@ -0,0 +1,62 @@
+""" Build time and query latency of the `SearchIndex` on a synthetic account.
+
+Run from the repository root: python -m benchmarks.search [-n ENTRIES] [-c CHANGES]
+
+"changes" times keeping the index current: a batch of `--changes` modified files plus as many new ones, applied
+through `DropboxCrawler.update_tree` like the change feed does, then the deletion of `--deletions` folders.
+"""
+import argparse
+import time
+from dropbox.files import DeletedMetadata, FolderMetadata, ListFolderResult
+from dropbox_fs.search import SearchIndex, parse_query
+from benchmarks.fake_dropbox import FakeDropbox, account_tree
+from benchmarks.getattr import crawled
+from benchmarks.update_tree import file_entry
+
+queries = ['File 7.txt', 'folder 3', 'file 1 size>100k', 'txt in:"/Folder 2/Folder 1"', 'type:folder',
+           'after:2020-01-02 before:2020-01-03', 'nothing like this', '7']
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--entries', type=int, default=1000000)
+    parser.add_argument('-c', '--changes', type=int, default=10000)
+    parser.add_argument('-d', '--deletions', type=int, default=500)
+    parser.add_argument('-r', '--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    entries = [FakeDropbox.metadata(e) for e in account_tree(args.entries)]
+    crawler = crawled(entries, None)
+    index = SearchIndex(crawler)
+    t0 = time.perf_counter()
+    index.build()
+    print('indexed {} entries in {:.2f}s'.format(len(index), time.perf_counter() - t0))
+
+    files = [e for e in entries if hasattr(e, 'size')][:args.changes]
+    changes = [file_entry(e.path_display, e.size + 1) for e in files] + \
+              [file_entry(e.path_display + '.new', i) for i, e in enumerate(files)]
+    t0 = time.perf_counter()
+    crawler.update_tree(ListFolderResult(entries=changes, cursor='cursor', has_more=False))
+    print('applied {} changes in {:.3f}s'.format(len(changes), time.perf_counter() - t0))
+
+    folders = [e for e in entries if isinstance(e, FolderMetadata)][-args.deletions:]  # (the last ones listed)
+    t0 = time.perf_counter()
+    for e in folders:  # (one batch each, like separate deletions in the change feed)
+        deleted = DeletedMetadata(name=e.name, path_lower=e.path_lower, path_display=e.path_display)
+        crawler.update_tree(ListFolderResult(entries=[deleted], cursor='cursor', has_more=False))
+    print('deleted {} folders in {:.3f}s ({} entries left)'.format(len(folders), time.perf_counter() - t0,
+                                                                   len(index)))
+
+    print('{:<40} {:>8} {:>10}'.format('query', 'results', 'ms'))
+    for query in queries:
+        kwargs = parse_query(query)
+        best = float('inf')
+        for _ in range(args.rounds):
+            t0 = time.perf_counter()
+            results = index.search(**kwargs)
+            best = min(best, time.perf_counter() - t0)
+        print('{:<40} {:>8} {:>10.2f}'.format(query, len(results), best * 1000))
+
+
+if __name__ == '__main__':
+    main()
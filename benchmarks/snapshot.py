@@ -0,0 +1,68 @@
+""" `DropboxCrawler.save_snapshot` / `load_snapshot` time versus tree size, for each storage.
+
+Run from the repository root: python -m benchmarks.snapshot [-n ENTRIES[,ENTRIES..]] [-c CHANGES]
+
+"first save" is the snapshot right after listing the whole account, "save" the one after a batch of `--changes`
+modified files (pulled from the change feed), "load" a fresh crawler loading both (journal: replaying it).
+"""
+import argparse
+import time
+from benchmarks.crawl import data_size
+from benchmarks.fake_dropbox import FakeDropbox, FakeCrawler, account_tree, data_folder
+
+
+def listed(dbx, storage):
+    """ a `FakeCrawler` with the whole account of `dbx` in its tree, but nothing saved yet """
+    crawler = FakeCrawler(dbx)
+    crawler.init('token', '', None, storage)
+    data = dbx.files_list_folder('', recursive=True)
+    crawler.update_tree(data)
+    while data.has_more:
+        data = dbx.files_list_folder_continue(data.cursor)
+        crawler.update_tree(data)
+    crawler._finished_crawling = True
+    return crawler
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+
+def run(n, storages, changes):
+    dbx = FakeDropbox(account_tree(n))
+    for storage in storages:
+        with data_folder():
+            crawler = listed(dbx, storage)
+            first_save = timed(crawler.save_snapshot)
+            dbx.change(dbx.modified(changes))
+            crawler.pull_changes()
+            save = timed(crawler.save_snapshot)
+            crawler = FakeCrawler(dbx)
+            load = timed(crawler.load_snapshot)
+            if storage == 'sqlite':  # loads folders on access, walk all of them once
+                load += timed(lambda: walk(crawler.root))
+            print('{:>9} {:<8} {:>10.3f}s {:>10.3f}s {:>10.3f}s {:>8.1f} MiB'.format(
+                n, storage, first_save, save, load, data_size() / 2 ** 20))
+
+
+def walk(folder):
+    for sub_folder in list(folder.folders.values()):
+        walk(sub_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--entries', default='10000,100000')
+    parser.add_argument('-c', '--changes', type=int, default=1000)
+    parser.add_argument('-s', '--storage', default='pickle,journal,sqlite')
+    args = parser.parse_args()
+    print('{:>9} {:<8} {:>11} {:>11} {:>11} {:>12}'.format('entries', 'storage', 'first save', 'save', 'load',
+                                                           'on disk'))
+    for n in args.entries.split(','):
+        run(int(n), args.storage.split(','), args.changes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+""" All benchmarks against a `FakeDropbox`, for synthetic accounts of the given sizes.
+
+Run from the repository root: python -m benchmarks.suite [--sizes 10k,100k,1M,5M] [-l LATENCY]
+
+Every size runs the initial crawl (`benchmarks.crawl`), snapshot save / load (`benchmarks.snapshot`) and
+getattr / readdir latency (`benchmarks.getattr`); the file cache read throughput (`benchmarks.file_cache`) doesn't
+depend on the account size and runs once. The fake dropbox and the file system run in this process, so the numbers
+are the cost of dropbox_fs itself plus the configured latency / bandwidth, not of the network.
+"""
+import argparse
+import gc
+from benchmarks import crawl, file_cache, snapshot
+from benchmarks import getattr as getattr_latency
+from benchmarks.fake_dropbox import FakeDropbox, account_tree
+
+
+def size(text):
+    factor = {'k': 10 ** 3, 'm': 10 ** 6}.get(text[-1].lower(), 1)
+    return int(float(text.rstrip('kKmM')) * factor)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', default='10k,100k', help='entries of the accounts, e.g. 10k,100k,1M,5M')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='ms per API call (crawl)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='crawl workers')
+    parser.add_argument('-s', '--storage', default='pickle,journal,sqlite')
+    parser.add_argument('--pickle-limit', type=int, default=200000, help='largest account crawled with pickle')
+    parser.add_argument('--files', type=int, default=64, help='files of the file cache benchmark')
+    args = parser.parse_args()
+    storages = args.storage.split(',')
+
+    for n in [size(s) for s in args.sizes.split(',')]:
+        print('== {} entries'.format(n))
+        print('-- initial crawl')
+        crawl.run(FakeDropbox(account_tree(n), latency=args.latency / 1000), storages, args.workers,
+                  args.pickle_limit)
+        gc.collect()
+        print('-- snapshots')
+        print('{:>9} {:<8} {:>11} {:>11} {:>11} {:>12}'.format('entries', 'storage', 'first save', 'save', 'load',
+                                                               'on disk'))
+        snapshot.run(n, storages, 1000)
+        gc.collect()
+        print('-- getattr / readdir')
+        getattr_latency.run([FakeDropbox.metadata(e) for e in account_tree(n)], 1)
+        gc.collect()
+    print('== file cache')
+    file_cache.run(args.files, 4 * 2 ** 20, 4, 8, 50 * 2 ** 20, 0.02)
+
+
+if __name__ == '__main__':
+    main()
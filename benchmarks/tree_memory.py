@@ -0,0 +1,97 @@
+""" Memory benchmark of the metadata tree: bytes per entry in memory and in the pickled snapshot.
+
+"before" is the layout of data_version 5 (plain objects, a `files`, a `folders` and a case-folded index dict per
+folder and a `datetime` per file), "after" is the current `crawler.File` / `crawler.Folder`. Both keep the
+revision and content hash of the files (`File` got them after data_version 5; the old layout would have kept the
+metadata's hex strings).
+
+Run from the repository root: python -m benchmarks.tree_memory [-n ENTRIES]
+"""
+import argparse
+import gc
+import pickle
+import tracemalloc
+from benchmarks.update_tree import wide_tree, deep_tree, pages
+from dropbox.files import FileMetadata, FolderMetadata
+from dropbox_fs.crawler import DropboxCrawler, Folder
+
+
+class LegacyFile:
+    def __init__(self, name, metadata: FileMetadata):
+        self.name = name
+        self.size = metadata.size
+        self.modified = metadata.server_modified
+        self.rev = metadata.rev
+        self.content_hash = metadata.content_hash
+
+
+class LegacyFolder:
+    def __init__(self, name):
+        self.name = name
+        self.files = {}
+        self.folders = {}
+        self.lower = {}
+
+
+def add(folder, children, item):
+    children[item.name] = item
+    folder.lower[item.name.lower()] = item
+    return item
+
+
+def build_legacy(data):
+    root = LegacyFolder('')
+    for d in data:
+        for e in d.entries:
+            path_components = e.path_display[1:].split('/')
+            folder = root
+            for f in path_components[:-1]:
+                folder = folder.lower.get(f.lower()) or add(folder, folder.folders, LegacyFolder(f))
+            f = path_components[-1]
+            if isinstance(e, FileMetadata):
+                add(folder, folder.files, LegacyFile(f, e))
+            elif isinstance(e, FolderMetadata) and f.lower() not in folder.lower:
+                add(folder, folder.folders, LegacyFolder(f))
+    return root
+
+
+def build_current(data):
+    crawler = DropboxCrawler()
+    crawler.root = Folder('')
+    crawler._base_path_depth = 0
+    for d in data:
+        crawler.update_tree(d)
+    return crawler.root
+
+
+def measure(build, tree, n):
+    """ memory retained by the tree once the pages it was built from are gone """
+    gc.collect()
+    tracemalloc.start()
+    data = pages(tree(n))
+    entries = sum(len(d.entries) for d in data)
+    root = build(data)
+    del data
+    gc.collect()
+    in_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return entries, in_memory, len(pickle.dumps(root, pickle.HIGHEST_PROTOCOL))
+
+
+def run(name, tree, n):
+    for label, build in [('before', build_legacy), ('after', build_current)]:
+        entries, in_memory, pickled = measure(build, tree, n)
+        print('{:<6} {:<6} {:>9} entries  {:8.1f} B/entry in memory  {:8.1f} B/entry pickled'.format(
+            name, label, entries, in_memory / entries, pickled / entries))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--entries', type=int, default=200000)
+    args = parser.parse_args()
+    run('wide', wide_tree, args.entries)
+    run('deep', deep_tree, args.entries)
+
+
+if __name__ == '__main__':
+    main()
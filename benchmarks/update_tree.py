@@ -0,0 +1,77 @@
+""" Micro-benchmark of `DropboxCrawler.update_tree` throughput on synthetic trees.
+
+Run from the repository root: python -m benchmarks.update_tree [-n ENTRIES]
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+from dropbox.files import FileMetadata, FolderMetadata, ListFolderResult
+from dropbox_fs.crawler import DropboxCrawler, Folder
+
+page_size = 2000  # the maximum `files_list_folder` returns per page
+
+
+def file_entry(path, i):
+    modified = datetime(2020, 1, 1) + timedelta(seconds=i)
+    return FileMetadata(name=path.rsplit('/', 1)[-1], id='id:{}'.format(i), path_display=path, path_lower=path.lower(),
+                        rev='{:09x}'.format(i + 1), size=i, client_modified=modified,
+                        server_modified=modified, content_hash='{:064x}'.format(i))
+
+
+def folder_entry(path, i):
+    return FolderMetadata(name=path.rsplit('/', 1)[-1], id='id:{}'.format(i), path_display=path,
+                          path_lower=path.lower())
+
+
+def wide_tree(n):
+    """ one folder with `n` files """
+    yield folder_entry('/Wide', 0)
+    for i in range(1, n):
+        yield file_entry('/Wide/File {}.txt'.format(i), i)
+
+
+def deep_tree(n, depth=64, files_per_folder=16):
+    """ chains of `depth` nested folders with a few files in each """
+    i = 0
+    while i < n:
+        path = '/Deep {}'.format(i)
+        for level in range(depth):
+            if i >= n:
+                return
+            yield folder_entry(path, i)
+            i += 1
+            for j in range(files_per_folder):
+                yield file_entry('{}/File {}.txt'.format(path, j), i)
+                i += 1
+            path += '/Level {}'.format(level)
+
+
+def pages(entries):
+    entries = list(entries)
+    return [ListFolderResult(entries=entries[i:i + page_size], cursor='cursor', has_more=True)
+            for i in range(0, len(entries), page_size)]
+
+
+def run(name, tree):
+    data = pages(tree)
+    crawler = DropboxCrawler()
+    crawler.root = Folder('')
+    crawler._base_path_depth = 0
+    n = sum(len(d.entries) for d in data)
+    t0 = time.perf_counter()
+    for d in data:
+        crawler.update_tree(d)
+    dt = time.perf_counter() - t0
+    print('{:<6} {:>9} entries  {:8.3f}s  {:>10.0f} entries/s'.format(name, n, dt, n / dt))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--entries', type=int, default=50000)
+    args = parser.parse_args()
+    run('wide', wide_tree(args.entries))
+    run('deep', deep_tree(args.entries))
+
+
+if __name__ == '__main__':
+    main()
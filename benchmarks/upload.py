@@ -0,0 +1,116 @@
+""" Writes through a writable `DropboxFs` and the uploads of its `WriteCache`, against a `FakeDropbox`.
+
+Run from the repository root: python -m benchmarks.upload [-n FILES] [-s KIB] [--big MIB] [--latency S]
+
+- "small files": `-n` files of `-s` KiB are created and written (the time per file is what the writing
+  application waits), then uploaded in batches (upload sessions committed with one `finish_batch` call) and, for
+  comparison, one `files_upload` call after the other (`batch_size` 1, one worker), the way the web client does it.
+- "big file": one file of `--big` MiB written in blocks of 128 KiB, uploaded in a session.
+- "rewrites": a file rewritten 100 times in a row is uploaded once.
+Every upload is checked against what was written, in the fake account and in the crawled tree.
+"""
+import argparse
+import os
+import time
+from pathlib import Path
+from dropbox_fs.cache import FileCache
+from dropbox_fs.fs import DropboxFs
+from dropbox_fs.writeback import WriteCache
+from benchmarks.fake_dropbox import FakeDropbox, FakeCrawler, content_hash, data_folder
+
+
+def mounted(dbx, batch_size, workers):
+    """ a writable `DropboxFs` on `dbx` (in the current directory) """
+    crawler = FakeCrawler(dbx)
+    crawler.init('token', '')
+    crawler._finished_crawling = True
+    file_cache = FileCache(Path.cwd() / 'cache', dbx)
+    file_cache.scheduler.session = dbx.session
+    fs = DropboxFs(crawler, file_cache)
+    fs.write_cache = WriteCache(Path.cwd() / 'uploads', crawler, file_cache, workers)
+    fs.write_cache.delay = 0.2
+    fs.write_cache.batch_size = batch_size
+    fs.write_cache.start()
+    return fs
+
+
+def write(fs, path, data, block_size=2 ** 17):
+    fh = fs('create', path, 0o644)
+    for offset in range(0, len(data), block_size):
+        fs('write', path, data[offset:offset + block_size], offset, fh)
+    fs('flush', path, fh)
+    fs('release', path, fh)
+
+
+def uploaded(fs):
+    """ waits until everything is uploaded, returns the seconds that took """
+    t0 = time.perf_counter()
+    while fs.write_cache.pending() > 0:
+        time.sleep(0.01)
+    seconds = time.perf_counter() - t0
+    while fs.write_cache.stats()['local_copies'] > 0:  # (moving into the file cache)
+        time.sleep(0.01)
+    return seconds
+
+
+def check(fs, dbx, files):
+    for path, data in files.items():
+        node = fs.crawler.root.get_file(path[1:])
+        assert dbx.files[path] == data, path
+        assert node is not None and node.content_hash == content_hash(data), path
+
+
+def small_files(args, batch_size, workers):
+    dbx = FakeDropbox(latency=args.latency, bandwidth=args.bandwidth * 2 ** 20)
+    with data_folder():
+        fs = mounted(dbx, batch_size, workers)
+        files = {'/File {}.txt'.format(i): os.urandom(args.size * 1024) for i in range(args.files)}
+        t0 = time.perf_counter()
+        for path, data in files.items():
+            write(fs, path, data)
+        written = time.perf_counter() - t0
+        seconds = uploaded(fs)
+        check(fs, dbx, files)
+        return written / len(files), seconds, upload_calls(dbx)
+
+
+def upload_calls(dbx):
+    return sum(n for call, n in dbx.calls.items() if call.startswith('files_upload'))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--files', type=int, default=500)
+    parser.add_argument('-s', '--size', type=int, default=4, help='KiB per small file')
+    parser.add_argument('--big', type=int, default=64, help='MiB of the big file')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per API call')
+    parser.add_argument('--bandwidth', type=float, default=50, help='MiB/s per connection')
+    args = parser.parse_args()
+
+    print('{:<24} {:>12} {:>12} {:>8}'.format('small files', 'µs/file', 'upload s', 'calls'))
+    for name, batch_size, workers in [('batched', 1000, 8), ('one by one', 1, 1)]:
+        per_file, seconds, calls = small_files(args, batch_size, workers)
+        print('{:<24} {:>12.1f} {:>12.2f} {:>8}'.format(name, per_file * 1e6, seconds, calls))
+
+    dbx = FakeDropbox(latency=args.latency, bandwidth=args.bandwidth * 2 ** 20)
+    with data_folder():
+        fs = mounted(dbx, 1000, 8)
+        data = os.urandom(args.big * 2 ** 20)
+        t0 = time.perf_counter()
+        write(fs, '/big.bin', data)
+        written = time.perf_counter() - t0
+        seconds = uploaded(fs)
+        check(fs, dbx, {'/big.bin': data})
+        print('big file: written at {:.0f} MiB/s, uploaded in {:.2f}s ({} requests)'.format(
+            args.big / written, seconds, upload_calls(dbx)))
+
+        calls = dbx.calls.get('files_upload', 0)
+        for i in range(100):
+            write(fs, '/rewritten.txt', 'version {}'.format(i).encode())
+        uploaded(fs)
+        check(fs, dbx, {'/rewritten.txt': b'version 99'})
+        print('rewrites: 100 versions written, {} uploaded'.format(dbx.calls.get('files_upload', 0) - calls))
+
+
+if __name__ == '__main__':
+    main()
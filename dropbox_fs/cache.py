@@ -1,101 +1,683 @@
 import contextlib
 import logging
 import errno
-from typing import List
+import hashlib
+import heapq
+import itertools
+import os
+import shutil
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
 from enum import Enum
 from pathlib import Path
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from fuse import FuseOSError
-from requests.exceptions import ReadTimeout
+from requests.exceptions import ReadTimeout, ConnectionError, HTTPError
 from dropbox import Dropbox
+from dropbox.exceptions import ApiError, RateLimitError
 from dropbox_fs.crawler import File
+from dropbox_fs.cache_index import CacheIndex, object_key
+from dropbox_fs.scheduler import DownloadScheduler, Priority
 
 log = logging.getLogger(__name__)
 
+use_pread = hasattr(os, 'pread')  # positional I/O, so several threads can read and write a file at the same time
 
-class SizeWatcher(Event):
-    def __init__(self, size):
-        super().__init__()
-        self.size = size
+
+def read_at(f, size, offset, lock):
+    if use_pread:
+        return os.pread(f.fileno(), size, offset)
+    with lock:
+        f.seek(offset)
+        return f.read(size)
+
+
+def write_at(f, data, offset, lock):
+    if use_pread:
+        while len(data) > 0:
+            n = os.pwrite(f.fileno(), data, offset)
+            data, offset = data[n:], offset + n
+    else:
+        with lock:
+            f.seek(offset)
+            f.write(data)
+
+
+class ExtentMap:
+    """ Sorted, non-overlapping [start, end) byte ranges, e.g. the parts of a file that are downloaded """
+
+    def __init__(self, extents=()):
+        self.starts = []
+        self.ends = []
+        for start, end in extents:
+            self.add(start, end)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        i = bisect_left(self.ends, start)  # first extent that touches or follows `start`
+        j = bisect_right(self.starts, end)  # extents from i to j overlap or touch [start, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def missing(self, start, end):
+        """ the ranges within [start, end) that are not covered """
+        gaps = []
+        i = bisect_right(self.ends, start)
+        pos = start
+        while pos < end and i < len(self.starts) and self.starts[i] < end:
+            if self.starts[i] > pos:
+                gaps.append((pos, self.starts[i]))
+            pos = max(pos, self.ends[i])
+            i += 1
+        if pos < end:
+            gaps.append((pos, end))
+        return gaps
+
+    def contains(self, start, end):
+        i = bisect_right(self.starts, start) - 1
+        return start >= end or (i >= 0 and self.ends[i] >= end)
+
+    def filled(self):
+        return sum(end - start for start, end in self)
 
 
 class FileDownloader:
+    """ Downloads the parts of a file that are read, using HTTP range requests, into a sparse cache file.
+
+    The file is split into chunks of `chunk_size`; `extents` tracks which bytes are already there. The downloads
+    run on the workers of a `DownloadScheduler`: the chunks a read is waiting for with `Priority.read`, the rest of
+    the file (optionally) one chunk at a time with `Priority.fill`. Every chunk is hashed while it is downloaded,
+    so the complete file can be checked against dropbox' content hash.
+    """
+    chunk_size = 2 ** 22  # 4 MiB, the block size of dropbox' content hash
+    link_lifetime = 3 * 3600  # temporary links are valid for 4 hours
+    retries = 5  # for timeouts, connection errors and rate limiting
+    backoff = 1  # seconds before the first retry, doubled for each further one
+    max_backoff = 60
+
     class State(Enum):
         working = 0
         success = 1
         failure = 2
+        cancelled = 3
+        interrupted = 4  # the background fill gave up after `retries` (what is there can be resumed)
 
-    def __init__(self, path: str, file: Path, dbx: Dropbox, db_path: str, finished_callback):
-        self.path, self.file, self.dbx, self.db_path = path, file, dbx, db_path
+    def __init__(self, key: str, file: Path, dbx: Dropbox, scheduler: DownloadScheduler, db_path: str, size: int,
+                 finished_callback, background_fill=True, rev=None, content_hash=None, extents=None,
+                 block_hashes=None):
+        self.key, self.file, self.dbx, self.scheduler, self.db_path = key, file, dbx, scheduler, db_path
+        self.size = size
+        self.rev = rev  # download exactly this revision (if given)
+        self.content_hash = content_hash  # expected content hash (if given)
         self.state = self.State.working
         self.finished_callback = finished_callback
-        self.size_watcher: List[SizeWatcher] = []
+        self.background_fill = background_fill
+        self.extents = ExtentMap(extents or ())  # (resuming an earlier download if given)
+        self.bytes_downloaded = 0
+        self.reads = 0
+        self.fill_priority = Priority.fill  # `Priority.prefetch` while nobody has opened the file
+        self.prefetched = 0  # chunks scheduled by `prefetch`
+        self.prefetch_hits = 0  # of those, chunks that were read later
+
+        self._lock = Lock()
+        self._fetching = {}  # chunk -> Event that is set when the download of the chunk has ended
+        self._jobs = {}  # chunk -> queued Job that will download it
+        self._prefetched = set()  # prefetched chunks that haven't been read yet
+        self._block_hashes = dict(block_hashes or {})  # chunk -> sha256 digest
+        self._closing = False
+        self._writers = 0  # requests that are writing to `f` (it is closed when the last one is done)
+        self._link = None
+        self._link_time = 0
 
         file.parent.mkdir(parents=True, exist_ok=True)
-        self.f = open(str(file), 'wb')
-        self.bytes_downloaded = 0
-        Thread(target=self.download).start()
+        if len(self.extents) > 0:
+            self.f = open(str(file), 'r+b', buffering=0)
+        else:
+            self.f = open(str(file), 'wb', buffering=0)
+            self.f.truncate(size)  # sparse (where supported)
+
+    def start(self):
+        if self.extents.contains(0, self.size):
+            self._finished()
+        elif self.background_fill:
+            self.scheduler.submit(self.fill_priority, self._fill_next)
+
+    def cancel(self):
+        """ stops downloading (e.g. when the file was closed without being read) """
+        if self._stop(self.State.cancelled):
+            log.debug('download cancelled: {}'.format(self.db_path))
+            self.finished_callback(self)
 
-    def download(self):
-        log.debug('downloading {}'.format(self.db_path))
-        with contextlib.closing(self):
-            with contextlib.closing(self.f):
+    def fill(self, priority):
+        """ downloads the rest of the file in the background, if it doesn't do that already """
+        with self._lock:
+            if self.background_fill or self.state != self.State.working:
+                return
+            self.background_fill = True
+            self.fill_priority = priority
+        self.scheduler.submit(priority, self._fill_next)
+
+    def resumed(self):
+        """ a new downloader that continues this interrupted one, but only downloads what is read (so a lasting
+        error doesn't make it retry in a loop; the next download of the file resumes the fill) """
+        with self._lock:
+            extents, block_hashes = list(self.extents), dict(self._block_hashes)
+        return FileDownloader(self.key, self.file, self.dbx, self.scheduler, self.db_path, self.size,
+                              self.finished_callback, False, self.rev, self.content_hash, extents, block_hashes)
+
+    def _stop(self, state):
+        """ ends the download with `state`, wakes up everyone waiting for a chunk """
+        with self._lock:
+            if self.state != self.State.working:
+                return False
+            self.state = state
+            for job in self._jobs.values():
+                self.scheduler.cancel(job)
+            for event in self._fetching.values():
+                event.set()
+            self._jobs.clear()
+            self._fetching.clear()
+            self._close()
+        return True
+
+    def ensure(self, offset, size, priority=Priority.read) -> bool:
+        """ makes sure the given range is downloaded, returns False if that failed """
+        end = min(offset + size, self.size)
+        if offset >= end or self.state == self.State.success:
+            return True
+        for event in self._schedule(offset, end, priority):
+            event.wait()
+        return self.extents.contains(offset, end)
+
+    def prefetch(self, offset, size):
+        """ schedules the download of the given range (with `Priority.prefetch`) without waiting for it """
+        end = min(offset + size, self.size)
+        if offset < end and self.state == self.State.working:
+            self._schedule(offset, end, Priority.prefetch)
+
+    def cancel_prefetch(self):
+        """ drops the prefetches that haven't been started yet """
+        with self._lock:
+            for c, job in list(self._jobs.items()):
+                if job.priority == Priority.prefetch and self.scheduler.cancel(job):
+                    del self._jobs[c]
+                    self._fetching.pop(c).set()
+                    self._prefetched.discard(c)
+
+    def _schedule(self, offset, end, priority):
+        """ submits download jobs for the missing chunks of the given range, returns the events to wait for """
+        first, last = self._chunk(offset), self._chunk(end - 1)
+        with self._lock:
+            if self.state != self.State.working:
+                return []
+            if priority == Priority.read and len(self._prefetched) > 0:
+                hits = self._prefetched.intersection(range(first, last + 1))
+                self.prefetch_hits += len(hits)
+                self._prefetched -= hits
+            missing = [c for c in range(first, last + 1) if not self.extents.contains(*self._chunk_range(c))]
+            mine = [c for c in missing if c not in self._fetching]
+            for c in mine:
+                self._fetching[c] = Event()
+            if priority == Priority.prefetch:
+                self._prefetched.update(mine)
+                self.prefetched += len(mine)
+            for run in self._runs(mine):
+                job = self.scheduler.submit(priority, self._fetch, run[0], run[-1])
+                for c in run:
+                    self._jobs[c] = job
+            for c in missing:
+                if c not in mine and c in self._jobs:
+                    self.scheduler.boost(self._jobs[c], priority)
+            return [self._fetching[c] for c in missing]
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def checkpoint(self):
+        """ makes the downloaded parts durable, returns (extents, block hashes) for resuming the download later
+        (nothing if they can't be made durable). Syncs through its own descriptor, `f` is closed once the download
+        ended, and without holding the lock, so reads go on meanwhile. """
+        with self._lock:
+            extents, block_hashes = list(self.extents), dict(self._block_hashes)
+        if len(extents) == 0:
+            return extents, block_hashes
+        try:
+            fd = os.open(str(self.file), os.O_RDWR)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            log.warning('syncing {} failed, its download starts over ({})'.format(self.db_path, str(e)))
+            return [], {}
+        return extents, block_hashes
+
+    def _close(self):
+        self._closing = True
+        if self._writers == 0 and not self.f.closed:
+            self.f.close()
+
+    def _fill_next(self):
+        """ downloads the first chunk that isn't there (or on its way) and schedules the next one """
+        with self._lock:
+            if self.state != self.State.working:
+                return
+            chunk = next((c for c in range(self._chunk(self.size - 1) + 1)
+                          if c not in self._fetching and not self.extents.contains(*self._chunk_range(c))), None)
+            if chunk is None:
+                return
+            self._fetching[chunk] = Event()
+        try:
+            fetched = self._fetch(chunk, chunk)
+        except Exception:  # (e.g. an unexpected API error, the download would never end otherwise)
+            log.exception('downloading {} failed'.format(self.db_path))
+            fetched = False
+        if fetched:
+            self.scheduler.submit(self.fill_priority, self._fill_next)
+        elif not self._closing and self._stop(self.State.interrupted):
+            log.warning('download of {} interrupted ({} of {} bytes)'.format(
+                self.db_path, self.extents.filled(), self.size))
+            self.finished_callback(self)
+
+    def _chunk(self, offset):
+        return offset // self.chunk_size
+
+    def _chunk_range(self, chunk):
+        return chunk * self.chunk_size, min((chunk + 1) * self.chunk_size, self.size)
+
+    @staticmethod
+    def _runs(chunks):
+        """ groups consecutive chunks, so each group can be fetched with one request """
+        runs = []
+        for c in chunks:
+            if len(runs) > 0 and runs[-1][-1] == c - 1:
+                runs[-1].append(c)
+            else:
+                runs.append([c])
+        return runs
+
+    def _temporary_link(self):
+        if self._link is None or time.time() - self._link_time > self.link_lifetime:
+            self._link = self.dbx.files_get_temporary_link(
+                self.db_path if self.rev is None else 'rev:' + self.rev).link
+            self._link_time = time.time()
+        return self._link
+
+    def _fetch(self, first, last) -> bool:
+        """ downloads the chunks `first` to `last`, resuming after transient errors """
+        chunk = first
+        attempt = 0
+        try:
+            while chunk <= last and self.state == self.State.working:
                 try:
-                    md, res = self.dbx.files_download(self.db_path)
-                    with contextlib.closing(res):
-                        for c in res.iter_content(2 ** 16):
-                            self.f.write(c)
-                            self.bytes_downloaded += len(c)
-                            [w.set() for w in self.size_watcher if self.bytes_downloaded > w.size]
-                except (ConnectionError, ReadTimeout):
-                    log.error('downloading failed for {}'.format(self.db_path))
-                    self.state = self.State.failure
-                    [w.set() for w in self.size_watcher]
-                    return
+                    chunk = self._request(chunk, last)
+                except (ConnectionError, ReadTimeout, HTTPError, RateLimitError, ApiError, OSError) as e:
+                    delay = self._retry_delay(e, attempt)
+                    if delay is None or attempt >= self.retries:
+                        log.error('downloading failed for {} ({})'.format(self.db_path, str(e)))
+                        break
+                    attempt += 1
+                    log.warning('downloading {} failed ({}), retrying in {}s'.format(self.db_path, str(e), delay))
+                    time.sleep(delay)
+        finally:
+            with self._lock:
+                for c in range(first, last + 1):
+                    self._jobs.pop(c, None)
+                for c in range(chunk, last + 1):  # wake up the waiters of chunks that didn't make it
+                    event = self._fetching.pop(c, None)
+                    if event is not None:
+                        event.set()
+        return chunk > last
+
+    def _request(self, first, last):
+        """ one range request for the chunks `first` to `last`, returns the first chunk that didn't make it """
+        start, end = self._chunk_range(first)[0], self._chunk_range(last)[1]
+        log.debug('downloading {} bytes @ {}: {}'.format(end - start, start, self.db_path))
+        chunk = first
+        with self._lock:
+            if self._closing:
+                return chunk
+            self._writers += 1
+        try:
+            res = self.scheduler.session.get(self._temporary_link(),
+                                             headers={'Range': 'bytes={}-{}'.format(start, end - 1)},
+                                             stream=True, timeout=60)
+            with contextlib.closing(res):
+                res.raise_for_status()
+                if res.status_code != 206 and start > 0:
+                    raise HTTPError('range request not supported ({})'.format(res.status_code))
+                pos = start
+                block_hash = hashlib.sha256()
+                for c in res.iter_content(2 ** 16):
+                    if self._closing:
+                        break
+                    c = memoryview(c)[:end - pos]
+                    write_at(self.f, c, pos, self._lock)
+                    while len(c) > 0:  # the data may span chunk boundaries
+                        chunk_end = self._chunk_range(chunk)[1]
+                        part = c[:chunk_end - pos]
+                        block_hash.update(part)
+                        c = c[len(part):]
+                        pos += len(part)
+                        if pos >= chunk_end:
+                            self._chunk_done(chunk, block_hash.digest())
+                            block_hash = hashlib.sha256()
+                            chunk += 1
+                    if pos >= end:
+                        break
+                if pos < end and not self._closing:
+                    raise ConnectionError('connection closed after {} of {} bytes'.format(pos - start, end - start))
+        finally:
+            with self._lock:
+                self._writers -= 1
+                if self._closing:
+                    self._close()
+        return chunk
 
+    def _retry_delay(self, e, attempt):
+        """ seconds to wait before retrying after `e`, None if retrying doesn't make sense """
+        if isinstance(e, RateLimitError):
+            return e.backoff or self.backoff * 2 ** attempt
+        if isinstance(e, HTTPError):
+            response = getattr(e, 'response', None)
+            status = None if response is None else response.status_code
+            if status == 429 or status == 503:
+                try:
+                    return float(response.headers['Retry-After'])
+                except (KeyError, ValueError):
+                    pass
+            elif status == 410:  # the temporary link expired
+                self._link = None
+                return 0
+            elif status is None or status < 500:
+                return None
+        elif not isinstance(e, (ConnectionError, ReadTimeout)):
+            return None
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+    def _chunk_done(self, chunk, block_hash):
+        start, end = self._chunk_range(chunk)
+        with self._lock:
+            self.extents.add(start, end)
+            self.bytes_downloaded += end - start
+            self._block_hashes[chunk] = block_hash
+            event = self._fetching.pop(chunk, None)
+            if event is not None:
+                event.set()
+            complete = self.extents.contains(0, self.size)
+        if complete:
+            self._finished()
+
+    def _finished(self):
+        if self.content_hash is None or self._content_hash() == self.content_hash:
             self.state = self.State.success
             log.debug('download finished: {}'.format(self.db_path))
-            [w.set() for w in self.size_watcher]
-
-    def close(self):
+        else:
+            self.state = self.State.failure
+            log.error('content hash mismatch, discarding the download of {}'.format(self.db_path))
+            with self._lock:  # nothing of it can be trusted (reads waiting for it fail)
+                self.extents = ExtentMap()
+                self._block_hashes.clear()
+        self.close()
         self.finished_callback(self)
 
-    def wait_for_size(self, size) -> bool:
-        log.debug('waiting for size {}: {}'.format(size, self.db_path))
-        if self.state == self.State.working and self.bytes_downloaded < size:
-            log.debug('new size watcher for {}'.format(self.db_path))
-            watcher = SizeWatcher(size)
-            self.size_watcher.append(watcher)
-            while self.bytes_downloaded < size and self.state == self.State.working:
-                watcher.wait(2)
-            self.size_watcher.remove(watcher)
-        if self.state == self.State.failure:
-            return False
-        if not self.f.closed:
-            log.debug('flush {}'.format(self.db_path))
-            self.f.flush()
-        return True
+    def _content_hash(self):
+        """ https://www.dropbox.com/developers/reference/content-hash """
+        blocks = b''.join(self._block_hashes[c] for c in range(len(self._block_hashes)))
+        return hashlib.sha256(blocks).digest()
 
 
 class FileCache:
-    def __init__(self, base_path: Path, dbx: Dropbox):
+    def __init__(self, base_path: Path, dbx: Dropbox, background_fill=True, max_size=None, max_files=None,
+                 policy='lru', download_workers=8):
         self.base_path = base_path
         self.dbx = dbx
-        self.downloading = {}
+        self.background_fill = background_fill  # download whole files, not only the parts that are read
+        self.max_size = max_size  # in bytes (None: unlimited)
+        self.max_files = max_files  # (None: unlimited)
+        self.policy = policy  # which files to evict first: 'lru' (least recently used) or 'lfu' (least frequently)
+        self.save_interval = 60  # save the index every n seconds (if it changed)
+        self.readahead = 2  # chunks to prefetch ahead of sequential reads (0: off)
+        self.sequential_reads = 2  # consecutive reads after which a handle is considered sequential
+        self.max_prefetch_files = 16  # files prefetched (see `prefetch`) at the same time
+        self.max_sync_files = 8  # pinned files downloaded (see `sync`) at the same time
+        self.scheduler = DownloadScheduler(download_workers)
+        self.downloading = {}  # key -> FileDownloader
         self.files_opened = {}
 
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.cancellations = 0
+        self.readahead_chunks = 0
+        self.readahead_hits = 0
+        self.prefetched_files = 0
+        self.prefetch_file_hits = 0
+        self.downloaded_bytes = 0  # of the finished downloads
+        self.interruptions = 0  # downloads that gave up (see `FileDownloader.State.interrupted`)
+
+        self.index = CacheIndex(base_path)
+        if not self.index.load():
+            log.info('indexing the file cache..')
+            self.index.scan()
+        self._lock = Lock()
+        self._read_lock = Lock()  # (without `os.pread`)
+        self._handles = {}  # fh -> key (see `object_key`) of the files opened from the cache
+        self._corrupt = set()  # handles of files whose download failed the content hash check (reads fail)
+        self._in_use = {}  # key -> number of open handles
+        self._streams = {}  # fh -> [offset where a sequential read would continue, number of sequential reads]
+        self._prefetched = set()  # keys prefetched by `prefetch` that haven't been opened yet
+        self._prefetch_queue = deque()
+        self._sync_queue = []  # heap of (size, order, rel_path, db_file, db_path), the smallest files first
+        self._sync_order = itertools.count()
+        self._syncing = set()  # keys of the downloads started by `sync` (they aren't cancelled on close)
+        self.sync_failed = {}  # key -> db_path of the files `sync` didn't get (until they are synced again)
+        self._evict_request = Event()
+        Thread(target=self._maintain, daemon=True).start()
+
     def open(self, path: str, rel_path: str, db_file: File, db_path: str, flags: int) -> int:
-        file = self.base_path / rel_path
-
-        if file.exists():
-            if db_path in self.downloading:
-                return self.open_file(file, flags)
-            return self.open_file(file, flags)
-            # downloading ..?
-            # newer ..?
+        key = object_key(rel_path, db_file)
+        file = self.base_path / key
+
+        downloader = None
+        with self._lock:  # the file mustn't be evicted from now on
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+            self.index.set_path(rel_path, key)
+            if key in self._prefetched:
+                self._prefetched.discard(key)
+                self.prefetch_file_hits += 1
+            if self._cached(key, db_file):
+                self.hits += 1
+                self.index.touch(key)
+                current = self.downloading.get(key)
+                if current is not None:
+                    current.fill_priority = Priority.fill
+            elif self._resumable(key, db_file):
+                self.misses += 1
+                downloader = self._download(key, rel_path, db_file, db_path, self.background_fill, resume=True)
+            elif self.index.get(key) is not None and not self._discard(file):
+                log.warning('serving outdated {} (the cached file could not be replaced)'.format(rel_path))
+                self.index.touch(key)
+            else:
+                self.misses += 1
+                downloader = self._download(key, rel_path, db_file, db_path, self.background_fill)
+        try:
+            fh = self.open_file(file, flags)
+        except OSError:
+            self._release(key)
+            raise
+        self._handles[fh] = key  # (before the download can end)
+        if downloader is not None:
+            downloader.start()
+            self._evict_request.set()
+        return fh
+
+    def prefetch(self, rel_path: str, db_file: File, db_path: str):
+        """ queues the download of a whole file in the background (with `Priority.prefetch`), unless it is cached
+        already. At most `max_prefetch_files` of them are downloaded at the same time. """
+        with self._lock:
+            self._prefetch_queue.append((rel_path, db_file, db_path))
+        self._start_prefetches()
+
+    def cancel_prefetch(self):
+        """ cancels the prefetched downloads of files that haven't been opened """
+        with self._lock:
+            self._prefetch_queue.clear()
+            downloaders = [self.downloading.pop(key) for key in self._prefetched
+                           if key in self.downloading and key not in self._in_use and key not in self._syncing]
+            self._prefetched.clear()
+        for downloader in downloaders:
+            downloader.cancel()
+
+    def _start_prefetches(self):
+        started = []
+        with self._lock:
+            running = sum(1 for k in self._prefetched if k in self.downloading)
+            while running < self.max_prefetch_files and len(self._prefetch_queue) > 0:
+                rel_path, db_file, db_path = self._prefetch_queue.popleft()
+                key = object_key(rel_path, db_file)
+                if self._cached(key, db_file):
+                    continue
+                resume = self._resumable(key, db_file)
+                if not resume and key in self.index and not self._discard(self.base_path / key):
+                    continue
+                downloader = self._download(key, rel_path, db_file, db_path, True, resume)
+                downloader.fill_priority = Priority.prefetch
+                self._prefetched.add(key)
+                self.prefetched_files += 1
+                started.append(downloader)
+                running += 1
+        for downloader in started:
+            downloader.start()
+        if len(started) > 0:
+            self._evict_request.set()
+
+    def pin(self, rel_path):
+        """ pins a file or folder: its files are never evicted (they are downloaded with `sync`) """
+        with self._lock:
+            self.index.pin(rel_path)
+
+    def unpin(self, rel_path):
+        with self._lock:
+            return self.index.unpin(rel_path)
+
+    def is_pinned(self, rel_path):
+        return self.index.is_pinned(rel_path)
+
+    def sync(self, files):
+        """ downloads the files (rel_path, db_file, db_path) completely in the background (with `Priority.sync`),
+        the smallest first and at most `max_sync_files` at the same time. What is cached already is skipped,
+        partial downloads are resumed. """
+        with self._lock:
+            for rel_path, db_file, db_path in files:
+                heapq.heappush(self._sync_queue, (db_file.size, next(self._sync_order), rel_path, db_file, db_path))
+        self._start_syncs()
+
+    def sync_pending(self):
+        """ number of files `sync` hasn't finished yet """
+        with self._lock:
+            return len(self._sync_queue) + len(self._syncing)
+
+    def _start_syncs(self):
+        started = []
+        with self._lock:
+            while len(self._syncing) < self.max_sync_files and len(self._sync_queue) > 0:
+                _, _, rel_path, db_file, db_path = heapq.heappop(self._sync_queue)
+                key = object_key(rel_path, db_file)
+                self.sync_failed.pop(key, None)
+                self.index.set_path(rel_path, key)  # (`evict` finds the pinned content by its paths)
+                if key in self.downloading:  # opened or prefetched, make sure it isn't cancelled and completes
+                    self._syncing.add(key)
+                    self.downloading[key].fill(Priority.sync)
+                    continue
+                if self._cached(key, db_file):
+                    continue
+                resume = self._resumable(key, db_file)
+                if not resume and key in self.index and not self._discard(self.base_path / key):
+                    continue
+                downloader = self._download(key, rel_path, db_file, db_path, True, resume)
+                downloader.fill_priority = Priority.sync
+                self._syncing.add(key)
+                started.append(downloader)
+        for downloader in started:
+            downloader.start()
+        if len(started) > 0:
+            self._evict_request.set()
+
+    def add_local(self, rel_path, db_file: File, source: Path):
+        """ caches `source` (e.g. the local copy of a file that was just uploaded) as the content of `db_file`,
+        by linking it (copying where that isn't possible) """
+        key = object_key(rel_path, db_file)
+        file = self.base_path / key
+        with self._lock:
+            if self._cached(key, db_file):
+                self.index.set_path(rel_path, key)
+                return
+        tmp_file = file.with_name(file.name + '.tmp')
+        try:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(str(source), str(tmp_file))
+            except OSError:
+                shutil.copyfile(str(source), str(tmp_file))
+            with self._lock:
+                if key in self.downloading or key in self._in_use:  # (started in the meantime)
+                    tmp_file.unlink()
+                    return
+                os.replace(str(tmp_file), str(file))
+                self.index.add(key, db_file, complete=True)
+                self.index.set_path(rel_path, key)
+        except OSError as e:
+            log.warning('caching the local copy of {} failed ({})'.format(rel_path, str(e)))
+            return
+        if self.over_budget():  # (otherwise the index is saved with the next interval)
+            self._evict_request.set()
+
+    def _cached(self, key, db_file: File):
+        """ whether the content of `db_file` is cached (or being downloaded) """
+        entry = self.index.get(key)
+        return key in self.downloading or (entry is not None and entry.complete and entry.matches(db_file)
+                                           and (self.base_path / key).exists())
+
+    def _resumable(self, key, db_file: File):
+        """ whether a partial download of the content of `db_file` can be continued """
+        entry = self.index.get(key)
+        if entry is None or entry.complete or not entry.extents or not entry.matches(db_file):
+            return False
+        try:
+            return (self.base_path / key).stat().st_size == entry.size
+        except OSError:
+            return False
+
+    def _download(self, key, rel_path, db_file: File, db_path, background_fill, resume=False):
+        entry = self.index.get(key) if resume else None
+        if entry is not None:
+            log.debug('resuming the download of {} ({} of {} bytes)'.format(
+                rel_path, sum(end - start for start, end in entry.extents), entry.size))
         else:
-            self.downloading[path] = FileDownloader(path, file, self.dbx, db_path, self.finished_downloading)
-            return self.open_file(file, flags)
+            if key in self.index:
+                log.debug('cached file is outdated or incomplete: {}'.format(rel_path))
+            self.index.add(key, db_file)
+        self.index.set_path(rel_path, key)
+        downloader = FileDownloader(key, self.base_path / key, self.dbx, self.scheduler, db_path, db_file.size,
+                                    self.finished_downloading, background_fill, db_file.rev, db_file.content_hash,
+                                    None if entry is None else entry.extents,
+                                    None if entry is None else entry.block_hashes)
+        self.downloading[key] = downloader
+        return downloader
 
     def read(self, path, size, offset, fh):
         try:
@@ -103,25 +685,185 @@ class FileCache:
         except KeyError:
             log.error('no open file found while reading from {}'.format(path))
             raise FuseOSError(errno.EIO)
-        if path in self.downloading:
-            if not self.downloading[path].wait_for_size(offset+size):
+        if fh in self._corrupt:
+            raise FuseOSError(errno.EIO)
+        downloader = self.downloading.get(self._handles.get(fh))
+        if downloader is not None:
+            downloader.reads += 1
+            if not downloader.ensure(offset, size):
                 raise FuseOSError(errno.EIO)
-        # else:
-        #     log.debug('{} not in {}'.format(path, list(self.downloading.keys())))
-        f.seek(offset)
-        return f.read(size)
+            if self.readahead > 0 and self._sequential(fh, offset, size) \
+                    and self.scheduler.pending() < 2 * self.scheduler.workers:  # don't pile up prefetches
+                downloader.prefetch(offset + size, self.readahead * downloader.chunk_size)
+        return read_at(f, size, offset, self._read_lock)
+
+    def _sequential(self, fh, offset, size):
+        """ tracks the reads of a handle, returns whether they are sequential """
+        stream = self._streams.get(fh)
+        if stream is None:
+            stream = self._streams[fh] = [offset, 0]
+        stream[1] = stream[1] + 1 if offset == stream[0] else 0
+        stream[0] = offset + size
+        return stream[1] >= self.sequential_reads
 
     def close(self, fh):
         try:
             self.files_opened.pop(fh).close()
         except KeyError:
             log.error('no open file found while closing file handle {}'.format(fh))
+        self._streams.pop(fh, None)
+        self._corrupt.discard(fh)
+        key = self._handles.pop(fh, None)
+        if key is not None:
+            self._release(key)
+
+    @staticmethod
+    def _discard(file: Path) -> bool:
+        """ deletes an outdated cached file (readers that still have it open keep the old content) """
+        try:
+            file.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning('deleting {} failed ({})'.format(file, str(e)))
+            return False
+        return True
+
+    def _release(self, key):
+        """ gives up a handle of `key`, its download is cancelled if it was closed without being read (or only
+        downloads what is read, see `background_fill`), what is there is kept for resuming """
+        with self._lock:
+            n = self._in_use.pop(key) - 1
+            if n > 0:
+                self._in_use[key] = n
+                return
+            downloader = self.downloading.get(key)
+            if downloader is None:
+                return
+            if downloader.reads > 0 and downloader.background_fill:
+                downloader.cancel_prefetch()  # readahead nobody is waiting for anymore
+                return
+            if key in self._syncing:
+                return
+            del self.downloading[key]
+            self.cancellations += 1
+        downloader.cancel()
+
+    def stats(self):
+        downloading = list(self.downloading.values())
+        readahead_chunks = self.readahead_chunks + sum(d.prefetched for d in downloading)
+        readahead_hits = self.readahead_hits + sum(d.prefetch_hits for d in downloading)
+        downloaded_bytes = self.downloaded_bytes + sum(d.bytes_downloaded for d in downloading)
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, evicted_bytes=self.evicted_bytes,
+                    cancellations=self.cancellations, readahead_chunks=readahead_chunks,
+                    readahead_hit_rate=round(readahead_hits / max(readahead_chunks, 1), 3),
+                    prefetched_files=self.prefetched_files,
+                    prefetch_hit_rate=round(self.prefetch_file_hits / max(self.prefetched_files, 1), 3),
+                    downloaded_bytes=downloaded_bytes, interruptions=self.interruptions, size=self.index.total_size,
+                    files=len(self.index),
+                    downloading=len(downloading), queued=self.scheduler.pending(), pinned=len(self.index.pinned),
+                    syncing=len(self._syncing), sync_queued=len(self._sync_queue), sync_failed=len(self.sync_failed))
+
+    def over_budget(self):
+        return (self.max_size is not None and self.index.total_size > self.max_size) \
+            or (self.max_files is not None and len(self.index) > self.max_files)
+
+    def evict(self):
+        """ deletes cached files (least recently / frequently used first) until the cache is within its budget.
+        Files that are open, still being downloaded or pinned are never evicted. """
+        if not self.over_budget():
+            return
+        with self._lock:
+            busy = set(self._in_use) | set(self.downloading) | self.index.pinned_keys()
+            if self.policy == 'lfu':
+                candidates = sorted(self.index.entries.items(), key=lambda i: (i[1].hits, i[1].last_access))
+            else:
+                candidates = sorted(self.index.entries.items(), key=lambda i: i[1].last_access)
+            for key, entry in candidates:
+                if not self.over_budget():
+                    break
+                if key in busy:
+                    continue
+                file = self.base_path / key
+                try:
+                    file.unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    log.warning('evicting {} failed ({})'.format(key, str(e)))
+                    continue
+                self._remove_empty_folders(file.parent)
+                self.index.remove(key)
+                self._prefetched.discard(key)
+                self.evictions += 1
+                self.evicted_bytes += entry.size
+        log.info('file cache: {}'.format(self.stats()))
+
+    def _remove_empty_folders(self, folder: Path):
+        while folder != self.base_path:
+            try:
+                folder.rmdir()
+            except OSError:  # not empty
+                return
+            folder = folder.parent
+
+    def _maintain(self):
+        """ evicts files in the background and saves the index from time to time """
+        while True:
+            self._evict_request.wait(self.save_interval)
+            self._evict_request.clear()
+            try:
+                self.evict()
+                self.save()
+            except OSError as e:
+                log.error('maintaining the file cache failed ({})'.format(str(e)))
+
+    def save(self):
+        """ saves the index, including the progress of the running downloads """
+        for downloader in list(self.downloading.values()):
+            extents, block_hashes = downloader.checkpoint()
+            with self._lock:
+                self.index.set_progress(downloader.key, extents, block_hashes)
+        if self.index.dirty:
+            with self._lock:
+                self.index.save()
 
     def finished_downloading(self, downloader: FileDownloader):
         log.debug('removing {} from downloading'.format(downloader.db_path))
-        del self.downloading[downloader.path]
+        resumed = None
+        progress = None
+        if downloader.state in [FileDownloader.State.cancelled, FileDownloader.State.interrupted]:
+            progress = downloader.checkpoint()  # (syncs the file, not under the lock `open` needs)
+        with self._lock:
+            if progress is not None:
+                self.index.set_progress(downloader.key, *progress)
+            else:  # (a failed download had a wrong content hash, nothing of it can be trusted)
+                self.index.set_complete(downloader.key, downloader.state == FileDownloader.State.success)
+            if self.downloading.get(downloader.key) is downloader:
+                del self.downloading[downloader.key]
+                if downloader.state == FileDownloader.State.failure:
+                    self._corrupt.update(fh for fh, key in self._handles.items() if key == downloader.key)
+                if downloader.state == FileDownloader.State.interrupted:
+                    self.interruptions += 1
+                    if downloader.key in self._in_use:  # (its reads need a downloader, not the sparse file)
+                        resumed = self.downloading[downloader.key] = downloader.resumed()
+            self.readahead_chunks += downloader.prefetched
+            self.readahead_hits += downloader.prefetch_hits
+            self.downloaded_bytes += downloader.bytes_downloaded
+            prefetch_waiting = len(self._prefetch_queue) > 0
+            if downloader.key in self._syncing:
+                self._syncing.discard(downloader.key)
+                if downloader.state != FileDownloader.State.success:
+                    self.sync_failed[downloader.key] = downloader.db_path
+            sync_waiting = len(self._sync_queue) > 0
+        if resumed is not None:
+            resumed.start()
+        if prefetch_waiting:
+            self.scheduler.submit(Priority.prefetch, self._start_prefetches)
+        if sync_waiting:
+            self.scheduler.submit(Priority.sync, self._start_syncs)
 
     def open_file(self, file, _flags) -> int:
-        f = open(file, 'rb')
+        f = open(file, 'rb', buffering=0)  # unbuffered: parts of the file may still be downloaded
         self.files_opened[f.fileno()] = f
-        return f.fileno()
\ No newline at end of file
+        return f.fileno()
@@ -0,0 +1,243 @@
+import logging
+import os
+import pickle
+import time
+from pathlib import Path
+from dropbox_fs.crawler import File
+
+log = logging.getLogger(__name__)
+
+index_version = 3  # bump this on changes how the index is saved
+
+
+class CacheEntry:
+    __slots__ = ('size', 'last_access', 'hits', 'rev', 'content_hash', 'complete', 'extents', 'block_hashes')
+
+    def __init__(self, size, last_access=None, hits=0, rev=None, content_hash=None, complete=False):
+        self.size = size
+        self.last_access = time.time() if last_access is None else last_access
+        self.hits = hits
+        self.rev = rev  # the revision of the cached content (see `crawler.File`)
+        self.content_hash = content_hash
+        self.complete = complete  # False while (or if) the download didn't finish
+        # of incomplete files: the [start, end) ranges that are downloaded and the sha256 of their chunks
+        self.extents = None
+        self.block_hashes = None
+
+    def __getstate__(self):
+        return self.size, self.last_access, self.hits, self.rev, self.content_hash, self.complete, self.extents, \
+            self.block_hashes
+
+    def __setstate__(self, state):
+        if len(state) == 6:  # saved before downloads were resumable
+            state += (None, None)
+        self.size, self.last_access, self.hits, self.rev, self.content_hash, self.complete, self.extents, \
+            self.block_hashes = state
+
+    def matches(self, file: File):
+        """ whether this is the content of `file` """
+        if self.content_hash is not None and file.content_hash is not None:
+            return self.content_hash == file.content_hash
+        return self.rev is not None and self.rev == file.rev
+
+
+def object_key(rel_path, file: File):
+    """ where the content of `file` is cached (relative to the cache directory): by content hash, so every content
+    is only stored once, no matter how many copies there are. Files without a hash are stored by path. """
+    if file.content_hash is None:
+        return 'files/' + rel_path
+    h = file.content_hash.hex()
+    return 'objects/{}/{}'.format(h[:2], h)
+
+
+class CacheIndex:
+    """ What the file cache holds, saved to `<cache dir>/index.pkl`:
+    `entries`: key (see `object_key`) -> `CacheEntry`, `paths`: rel_path -> key of its (last known) content
+    and `pinned`: case-folded rel_path -> rel_path (as spelled when pinned) of the pinned files and folders ('' is
+    everything)
+    """
+
+    def __init__(self, base_path: Path):
+        self.path = base_path / 'index.pkl'
+        self.entries = {}
+        self.paths = {}
+        self.refs = {}  # key -> set of rel_paths (the reverse of `paths`)
+        self.pinned = {}
+        self.total_size = 0
+        self.dirty = False
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key) -> CacheEntry:
+        return self.entries.get(key)
+
+    def add(self, key, file: File, complete=False):
+        """ adds an entry for the content of `file` """
+        self.remove(key)
+        entry = self.entries[key] = CacheEntry(file.size, rev=file.rev, content_hash=file.content_hash,
+                                               complete=complete)
+        self.total_size += entry.size
+        self.dirty = True
+        return entry
+
+    def set_path(self, rel_path, key):
+        old_key = self.paths.get(rel_path)
+        if old_key == key:
+            return
+        if old_key is not None:
+            self._unref(rel_path, old_key)
+        self.paths[rel_path] = key
+        self.refs.setdefault(key, set()).add(rel_path)
+        self.dirty = True
+
+    def pin(self, rel_path):
+        self.pinned[rel_path.lower()] = rel_path
+        self.dirty = True
+
+    def unpin(self, rel_path):
+        """ unpins `rel_path` and everything pinned below it, returns the paths that were unpinned """
+        path = rel_path.lower()
+        prefix = path + '/' if path else ''
+        removed = sorted(p for p in self.pinned if p == path or p.startswith(prefix))
+        removed = [self.pinned.pop(p) for p in removed]
+        self.dirty = self.dirty or len(removed) > 0
+        return removed
+
+    def is_pinned(self, rel_path):
+        """ whether `rel_path` or a folder above it is pinned """
+        if len(self.pinned) == 0:
+            return False
+        path = rel_path.lower()
+        while path not in self.pinned:
+            if path == '':
+                return False
+            path = path.rpartition('/')[0]
+        return True
+
+    def pinned_keys(self):
+        return {key for rel_path, key in self.paths.items() if self.is_pinned(rel_path)} if self.pinned else set()
+
+    def set_complete(self, key, complete=True):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.complete = complete
+            entry.extents = entry.block_hashes = None
+            self.dirty = True
+
+    def set_progress(self, key, extents, block_hashes):
+        """ records the downloaded parts of an incomplete file, so its download can be resumed """
+        entry = self.entries.get(key)
+        if entry is not None and not entry.complete:
+            entry.extents, entry.block_hashes = extents, block_hashes
+            self.dirty = True
+
+    def touch(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.last_access = time.time()
+            entry.hits += 1
+            self.dirty = True
+        return entry
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_size -= entry.size
+            for rel_path in self.refs.pop(key, ()):
+                del self.paths[rel_path]
+            self.dirty = True
+        return entry
+
+    def _unref(self, rel_path, key):
+        paths = self.refs[key]
+        paths.discard(rel_path)
+        if len(paths) == 0:
+            del self.refs[key]
+
+    def load(self):
+        """ loads the saved index, returns False if there is none (or it is unusable) """
+        try:
+            with open(str(self.path), 'rb') as f:
+                data = pickle.load(f)
+            if data['index_version'] != index_version:
+                log.warning('ignoring cache index of version {}'.format(data['index_version']))
+                return False
+        except FileNotFoundError:
+            return False
+        except (pickle.PickleError, EOFError, KeyError) as e:
+            log.warning('ignoring corrupt cache index ({})'.format(str(e)))
+            return False
+        self.entries = data['entries']
+        self.total_size = sum(e.size for e in self.entries.values())
+        self.paths, self.refs = {}, {}
+        for rel_path, key in data['paths'].items():
+            if key in self.entries:
+                self.set_path(rel_path, key)
+        pinned = data.get('pinned', {})  # (not saved before pinning existed)
+        self.pinned = pinned if isinstance(pinned, dict) else {p: p for p in pinned}  # (a set of folded paths before)
+        self.dirty = False
+        self._reconcile()
+        return True
+
+    def _reconcile(self):
+        """ matches the loaded index with the cache directory, which may have changed after it was saved (e.g. when
+        the process crashed): files that aren't in the index are added (like by `scan`), entries without a file are
+        removed """
+        missing = set(self.entries)
+        added = 0
+        for key, st, content_hash in self._cached_files():
+            if key in missing:
+                missing.discard(key)
+            else:
+                self.entries[key] = CacheEntry(st.st_size, st.st_atime, content_hash=content_hash)
+                self.total_size += st.st_size
+                added += 1
+        for key in missing:
+            self.remove(key)
+        if added > 0 or len(missing) > 0:
+            log.info('cache index: added {} unindexed files, removed {} missing ones'.format(added, len(missing)))
+            self.dirty = True
+
+    def scan(self):
+        """ indexes the files in the cache directory (e.g. when there is no saved index).
+        Their revision is unknown, so they are downloaded again when they are opened. Files of older cache layouts
+        are deleted. """
+        for key, st, content_hash in self._cached_files():
+            self.entries[key] = CacheEntry(st.st_size, st.st_atime, content_hash=content_hash)
+        self.total_size = sum(e.size for e in self.entries.values())
+        self.dirty = True
+
+    def _cached_files(self):
+        """ yields (key, stat result, content hash) of the files in the cache directory, deletes the other ones """
+        base_path = self.path.parent
+        removed = 0
+        for dir_path, _, files in os.walk(str(base_path)):
+            for name in files:
+                file = Path(dir_path) / name
+                key = file.relative_to(base_path).as_posix()
+                if file == self.path:
+                    continue
+                try:
+                    if not key.startswith(('objects/', 'files/')) or name.endswith('.tmp'):
+                        raise ValueError('not a cached file')
+                    content_hash = bytes.fromhex(name) if key.startswith('objects/') else None
+                except ValueError:
+                    file.unlink()
+                    removed += 1
+                    continue
+                yield key, file.stat(), content_hash
+        if removed > 0:
+            log.info('removed {} files of an old cache layout'.format(removed))
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = str(self.path) + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'index_version': index_version, 'entries': dict(self.entries), 'paths': dict(self.paths),
+                         'pinned': dict(self.pinned)}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, str(self.path))
+        self.dirty = False
@@ -3,22 +3,35 @@ import argparse
 import sys
 import os
 import signal
+import time
+from datetime import datetime, timezone
 from threading import Thread
 from pathlib import Path
 from fuse import FUSE
+from dropbox_fs import control
 from dropbox_fs.cache import FileCache
+from dropbox_fs.control import ControlServer
 from dropbox_fs.crawler import DropboxCrawler
 from dropbox_fs.fs import DropboxFs
-from dropbox_fs.misc import wait_for_event
+from dropbox_fs.metrics import MetricsServer
+from dropbox_fs.misc import wait_for_event, parse_size
+from dropbox_fs.pinning import Pinner
+from dropbox_fs.search import SearchIndex, parse_query
+from dropbox_fs.writeback import WriteCache
 
 log = logging.getLogger(__name__)
 
 
 def exit_handler(signum, frame):
-    global stop_request
-    log.info("Waiting for crawler thread to finish (this might take around 30s)")
-    stop_request = True
+    crawler._stop_request = True
     signal.signal(signal.SIGINT, original_sigint)
+    fs.file_cache.save()  # (before waiting for the crawler, which may end the process)
+    if fs.write_cache is not None:
+        fs.write_cache.save()
+        pending = fs.write_cache.pending()
+        if pending > 0:
+            log.warning('{} files are not uploaded yet, they are uploaded after the next start'.format(pending))
+    log.info("Waiting for crawler thread to finish (this might take around 30s)")
     try:
         if not wait_for_event(crawler._finished, 60):
             if os.name == 'nt':
@@ -37,19 +50,150 @@ def exit_handler(signum, frame):
 
 def dropbox_fs():
     log.info('starting file system on z:')
-    FUSE(fs, "z:", foreground=True, ro=True)
+    FUSE(fs, "z:", foreground=True, ro=fs.write_cache is None, **fuse_options)
 
 
 def start_fs():
     Thread(target=dropbox_fs).start()
 
 
+def file_cache(args, crawler):
+    cache = FileCache(Path.cwd() / 'cache', crawler.dbx, max_size=args.cache_size, max_files=args.cache_files,
+                      policy=args.cache_policy, download_workers=args.download_workers)
+    cache.readahead = args.readahead
+    return cache
+
+
+def pin(args):
+    """ `pin` / `unpin` a path (`pin` without one lists the pinned paths) in the running instance, or right here
+    if there is none (then `pin` waits until the files are downloaded) """
+    action = 'pinned' if args.action == 'pin' and args.target is None else args.action
+    targets = [] if args.target is None else [args.target]
+    try:
+        show(action, control.call(action, *targets))
+        return
+    except ConnectionError:
+        pass
+    except ValueError as e:
+        log.error(str(e))
+        return
+    crawler = DropboxCrawler()
+    if not crawler.load_snapshot():
+        return
+    cache = file_cache(args, crawler)
+    pinner = Pinner(crawler, cache)
+    try:
+        show(action, getattr(pinner, action)(*targets))
+    except ValueError as e:
+        log.error(str(e))
+        return
+    pending = cache.sync_pending()
+    while pending > 0:
+        log.info('{} files left to download'.format(pending))
+        time.sleep(5)
+        pending = cache.sync_pending()
+    cache.save()
+    failed = sorted(cache.sync_failed.values())
+    if len(failed) > 0:
+        log.error('{} files could not be downloaded (pin again to retry):\n{}'.format(len(failed), '\n'.join(failed)))
+        sys.exit(1)
+
+
+def search(args):
+    """ runs the query `target` in the running instance, or right here on the saved tree if there is none """
+    try:
+        results = control.call('search', args.target, args.limit)
+    except ConnectionError:
+        results = None
+    except ValueError as e:
+        log.error(str(e))
+        return
+    if results is None:
+        crawler = DropboxCrawler()
+        if not crawler.load_snapshot():
+            return
+        index = SearchIndex(crawler)
+        index.build()
+        try:
+            results = index.search(limit=args.limit, **parse_query(args.target))
+        except ValueError as e:
+            log.error(str(e))
+            return
+    for path, size, modified in results:
+        if size is None:
+            print('{:>12} {:16} {}/'.format('', '', path))
+        else:
+            print('{:>12} {:%Y-%m-%d %H:%M} {}'.format(size, datetime.fromtimestamp(modified, timezone.utc), path))
+
+
+def search_disabled(text, limit):
+    raise ValueError('the running instance has no search index (start it with --search-index)')
+
+
+def show(action, result):
+    if action == 'pin':
+        print('pinned {path}: {files} files, {mib:.1f} MiB are downloaded in the background (if not cached yet)'
+              .format(mib=result['bytes'] / 2 ** 20, **result))
+    else:
+        print('\n'.join(result))
+
+
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('action', type=str, choices=['init', 'load'], nargs='?', default='load')
+    parser.add_argument('action', type=str, choices=['init', 'load', 'pin', 'unpin', 'search'], nargs='?',
+                        default='load', help='pin / unpin: keep a file or folder (TARGET) downloaded, also while '
+                                             'offline; search: find files and folders by name (TARGET is the query)')
+    parser.add_argument('target', type=str, nargs='?',
+                        help="the path of pin / unpin (e.g. /Photos/2020) or the query of search: words that must be "
+                             "in the name and filters, e.g. 'holiday jpg type:file size>1M after:2020-01-31 "
+                             "in:/Photos'")
+    parser.add_argument('--search-index', action='store_true',
+                        help='keep an index of all names for the search action and the query folders in '
+                             '<mount>/.dropbox_fs/search/')
+    parser.add_argument('--limit', type=int, default=1000, help='maximum number of search results')
     parser.add_argument('-t', '--token', type=str)
     parser.add_argument('-p', '--path', type=str, default='')
     parser.add_argument('-l', '--local-folder', type=str, default=None)
+    parser.add_argument('-s', '--storage', type=str, choices=['pickle', 'journal', 'sqlite'], default=None,
+                        help='how to save the crawled data (default: pickle for init, unchanged for load)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of subtrees that are crawled in parallel during the initial crawl')
+    parser.add_argument('--cache-size', type=parse_size, default=None,
+                        help='maximum size of the file cache, e.g. 500M or 20G (default: unlimited)')
+    parser.add_argument('--cache-files', type=int, default=None,
+                        help='maximum number of files in the file cache (default: unlimited)')
+    parser.add_argument('--cache-policy', type=str, choices=['lru', 'lfu'], default='lru',
+                        help='which files to evict first: least recently or least frequently used')
+    parser.add_argument('--download-workers', type=int, default=8,
+                        help='number of downloads that run at the same time')
+    parser.add_argument('--readahead', type=int, default=2,
+                        help='number of 4 MiB chunks that are downloaded ahead of sequential reads (0: off)')
+    parser.add_argument('--prefetch-folders', action='store_true',
+                        help='download the small files of a folder when some of them are opened after listing it')
+    parser.add_argument('--attr-timeout', type=float, default=None,
+                        help='seconds the kernel caches file attributes (default: the FUSE default, 1s). Remote '
+                             'changes show up only after it expired')
+    parser.add_argument('--entry-timeout', type=float, default=None,
+                        help='seconds the kernel caches name lookups (default: like --attr-timeout)')
+    parser.add_argument('--negative-timeout', type=float, default=None,
+                        help='seconds the kernel caches lookups of names that do not exist')
+    parser.add_argument('--kernel-cache', action='store_true',
+                        help="keep file contents in the kernel's page cache until their size or time changes")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve the statistics (also in /.dropbox_fs/stats) in the Prometheus text format on '
+                             'http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--profile', action='store_true',
+                        help='sample the stacks of all threads from the start, see /.dropbox_fs/profile '
+                             '(SIGUSR2 toggles the profiler at any time)')
+    parser.add_argument('--writable', action='store_true',
+                        help='mount read-write: written files are kept in ./uploads and uploaded in the background')
+    parser.add_argument('--write-sync', type=str, choices=['none', 'fsync', 'close'], default='fsync',
+                        help='what waits until a written file is uploaded: fsync(2), close(2) as well, or nothing '
+                             '(fsync then only makes the local copy durable)')
+    parser.add_argument('--upload-delay', type=float, default=2,
+                        help='seconds a written file has to stay unchanged before it is uploaded')
+    parser.add_argument('--upload-workers', type=int, default=8,
+                        help='number of files that are uploaded at the same time')
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
 
@@ -59,9 +203,28 @@ def main():
         # level=log_level
     )
     logging.getLogger('dropbox_fs').setLevel(log_level)
+    if args.action in ['pin', 'unpin']:
+        if args.action == 'unpin' and args.target is None:
+            parser.error('unpin requires a path')
+        return pin(args)
+    if args.action == 'search':
+        if args.target is None:
+            parser.error('search requires a query')
+        return search(args)
 
-    global crawler, original_sigint, fs
-    crawler = DropboxCrawler(start_fs)
+    global crawler, original_sigint, fs, fuse_options
+    fuse_options = {}
+    attr_timeout = args.attr_timeout
+    if attr_timeout is not None:
+        fuse_options['attr_timeout'] = attr_timeout
+    if args.entry_timeout is not None or attr_timeout is not None:
+        fuse_options['entry_timeout'] = attr_timeout if args.entry_timeout is None else args.entry_timeout
+    if args.negative_timeout is not None:
+        fuse_options['negative_timeout'] = args.negative_timeout
+    if args.kernel_cache:
+        fuse_options['auto_cache'] = True
+    crawler = DropboxCrawler()
+    crawler.crawl_workers = args.workers
     if args.action == 'init':
         if args.token is None:
             args.error('initialization requires a dropbox token')
@@ -72,13 +235,41 @@ def main():
             local_folder = Path(args.local_folder)
             if not local_folder.exists():
                 args.error('Local dropbox folder not found')
-        crawler.init(args.token, args.path, local_folder)
+        crawler.init(args.token, args.path, local_folder, args.storage or 'pickle')
     elif args.action == 'load':
         if not crawler.load_snapshot():
             return
+        if args.storage is not None and args.storage != crawler.storage:
+            if 'sqlite' in [args.storage, crawler.storage]:
+                parser.error('switching from or to sqlite storage requires a new init')
+            crawler.storage = args.storage
 
-    cache = FileCache(Path.cwd() / 'cache', crawler.dbx)
+    cache = file_cache(args, crawler)
     fs = DropboxFs(crawler, cache)
+    fs.folder_prefetch = args.prefetch_folders
+    if args.metrics_port is not None:
+        MetricsServer(fs.metrics, args.metrics_port).start()
+    if args.profile:
+        fs.profiler.start()
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: fs.profiler.toggle())
+    if args.writable:
+        fs.write_cache = WriteCache(Path.cwd() / 'uploads', crawler, cache, args.upload_workers)
+        fs.write_cache.sync_mode = args.write_sync
+        fs.write_cache.delay = args.upload_delay
+        fs.metrics.sources['uploads'] = fs.write_cache.stats
+        fs.write_cache.start()
+    pinner = Pinner(crawler, cache)
+    handlers = {'pin': pinner.pin, 'unpin': pinner.unpin, 'pinned': pinner.pinned, 'search': search_disabled}
+    if args.search_index:
+        fs.search_index = SearchIndex(crawler)
+        fs.search_limit = args.limit
+        fs.metrics.sources['search'] = fs.search_index.stats
+        handlers['search'] = lambda text, limit: fs.search_index.search(limit=limit, **parse_query(text))
+        Thread(target=fs.search_index.build, daemon=True).start()
+    ControlServer(handlers).start()
+    Thread(target=pinner.resync, daemon=True).start()
+    start_fs()  # right away, folders the initial crawl hasn't reached yet are listed on demand
     Thread(target=crawler.crawl).start()
     original_sigint = signal.signal(signal.SIGINT, exit_handler)
     if os.name != 'nt':
@@ -0,0 +1,96 @@
+import logging
+import os
+import secrets
+import socket
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from threading import Thread
+
+log = logging.getLogger(__name__)
+
+key_file = 'control.key'  # (in the working directory, like the crawler's data files)
+address = r'\\.\pipe\dropbox_fs' if os.name == 'nt' else 'control.sock'
+
+
+class ControlServer:
+    """ Lets other invocations of the cli (e.g. `pin`) talk to the running instance.
+
+    Requests are (action, args) tuples, answered with ('ok', result) or ('error', message) by calling
+    `handlers[action](*args)`. Clients authenticate with the random key in `key_file`, which only the user that
+    runs the instance can read.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self._listener = None
+
+    def start(self):
+        if self._in_use():
+            log.warning('the cli cannot reach this instance (another one listens at {})'.format(address))
+            return
+        authkey = secrets.token_bytes(32)
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(authkey)
+        try:
+            self._listener = Listener(address, authkey=authkey)
+        except OSError as e:
+            log.warning('the cli cannot reach this instance ({})'.format(str(e)))
+            return
+        Thread(target=self._accept, daemon=True).start()
+
+    @staticmethod
+    def _in_use():
+        """ whether another instance listens at `address`, removes the socket if it was left over by one that didn't
+        exit cleanly """
+        if os.name == 'nt':
+            return os.path.exists(address)  # (a pipe is gone with the process that made it)
+        if not os.path.exists(address):
+            return False
+        with socket.socket(socket.AF_UNIX) as s:
+            try:
+                s.connect(address)
+                return True
+            except ConnectionRefusedError:
+                os.unlink(address)
+                return False
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError) as e:  # e.g. a client with a wrong key (or none)
+                log.warning('control connection failed ({})'.format(str(e)))
+                continue
+            Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        with connection:
+            try:
+                action, args = connection.recv()
+            except (EOFError, OSError, ValueError):
+                return
+            handler = self.handlers.get(action)
+            try:
+                if handler is None:
+                    raise ValueError('unknown action {}'.format(action))
+                connection.send(('ok', handler(*args)))
+            except Exception as e:
+                connection.send(('error', str(e)))
+
+
+def call(action, *args):
+    """ runs `action` in the running instance, raises ConnectionError if there is none and ValueError if the action
+    failed """
+    try:
+        with open(key_file, 'rb') as f:
+            authkey = f.read()
+        connection = Client(address, authkey=authkey)
+    except (OSError, AuthenticationError) as e:
+        raise ConnectionError('no running instance found ({})'.format(str(e)))
+    with connection:
+        connection.send((action, args))
+        status, result = connection.recv()
+    if status != 'ok':
+        raise ValueError(result)
+    return result
@@ -1,35 +1,287 @@
 import logging
 import shutil
 import pickle
+import calendar
+import os
+import time
 import dropbox
 from datetime import datetime
 from pathlib import Path
-from threading import Event
+from threading import Event, Lock, Thread, RLock
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from requests.exceptions import ReadTimeout, ConnectionError
-from dropbox.exceptions import ApiError, AuthError
+from dropbox.exceptions import ApiError, AuthError, RateLimitError
 from dropbox.files import FileMetadata, FolderMetadata
-from .misc import remove_from_dict_case_insensitive
+from .journal import Journal
+from .store import SqliteStore
 
-data_version = 4  # bump this on changes how the data is saved
+data_version = 7  # bump this on changes how the data is saved
 data_file = 'data.pkl'
+journal_file = 'data.journal'
+db_file = 'data.sqlite'
 
 # https://www.dropbox.com/developers/documentation/http/documentation#files-list_folder-continue
 
 log = logging.getLogger(__name__)
 
 
+_shared_names = {}  # name -> the one string object for it, see `_shared`
+max_shared_names = 2 ** 14
+
+
+def _shared(name):
+    """ an earlier string equal to `name` if there is one, so names that repeat across folders (e.g. 'Photos',
+    'README.md') are stored once. Unlike `sys.intern` the table is bounded: it is cleared once it holds
+    `max_shared_names` names, so unique names don't accumulate in it and repeated ones are soon shared again. """
+    shared = _shared_names.get(name)
+    if shared is not None:
+        return shared
+    if len(_shared_names) >= max_shared_names:
+        _shared_names.clear()
+    _shared_names[name] = name
+    return name
+
+
+def _key(name):
+    """ case-folded dictionary key for `name` (dropbox paths are case-insensitive) """
+    key = name.lower()
+    return name if key == name else _shared(key)
+
+
+_no_children = MappingProxyType({})  # shared by all empty folders
+
+
 class File:
-    def __init__(self, name, metadata: FileMetadata):
-        self.name = name
-        self.size = metadata.size
-        self.modified = metadata.server_modified
+    __slots__ = ('name', 'size', 'modified', 'rev', 'content_hash')
+
+    def __init__(self, name, size, modified, rev=None, content_hash=None):
+        self.name = _shared(name)
+        self.size = size
+        self.modified = modified  # epoch seconds
+        self.rev = rev
+        self.content_hash = content_hash  # dropbox content hash (raw bytes, not hex)
+
+    @classmethod
+    def from_metadata(cls, name, metadata: FileMetadata):
+        content_hash = None if metadata.content_hash is None else bytes.fromhex(metadata.content_hash)
+        return cls(name, metadata.size, calendar.timegm(metadata.server_modified.utctimetuple()), metadata.rev,
+                   content_hash)
+
+    def __getstate__(self):
+        return self.name, self.size, self.modified, self.rev, self.content_hash
+
+    def __setstate__(self, state):
+        name, self.size, self.modified, self.rev, self.content_hash = state
+        self.name = _shared(name)
 
 
 class Folder:
+    __slots__ = ('name', '_children')
+
     def __init__(self, name, files=None, folders=None):
-        self.name = name
-        self.files = {} if files is None else {f.name: f for f in files}
-        self.folders = {} if folders is None else {f.name: f for f in folders}
+        self.name = _shared(name)
+        self._children = _no_children  # case-folded name -> File / Folder, a dict once there are any
+        for f in files or ():
+            self.add_file(f)
+        for f in folders or ():
+            self.add_folder(f)
+
+    def __getstate__(self):
+        return self.name, tuple(self._children.values())
+
+    def __setstate__(self, state):
+        name, children = state
+        self.name = _shared(name)
+        self._children = {_key(c.name): c for c in children} if children else _no_children
+
+    def __iter__(self):
+        return iter(self._children.values())
+
+    def __len__(self):
+        return len(self._children)
+
+    @property
+    def files(self):
+        return {c.name: c for c in self if isinstance(c, File)}
+
+    @property
+    def folders(self):
+        return {c.name: c for c in self if isinstance(c, Folder)}
+
+    def get(self, name):
+        """ case-insensitive lookup of a child file or folder """
+        return self._children.get(name.lower())
+
+    def get_file(self, name):
+        item = self._children.get(name.lower())
+        return item if isinstance(item, File) else None
+
+    def get_folder(self, name):
+        item = self._children.get(name.lower())
+        return item if isinstance(item, Folder) else None
+
+    def add_file(self, file: File):
+        """ adds `file`, replacing any file or folder with the same (case-insensitive) name """
+        return self._add(file)
+
+    def add_folder(self, folder: 'Folder'):
+        """ adds `folder`, replacing any file or folder with the same (case-insensitive) name """
+        return self._add(folder)
+
+    def new_folder(self, name):
+        """ a new (not yet added) sub folder """
+        return Folder(name)
+
+    def is_loaded(self):
+        return True
+
+    def _add(self, item):
+        if self._children is _no_children:
+            self._children = {}
+        self._children[_key(item.name)] = item
+        return item
+
+    def rename(self, item, name):
+        """ changes the name (e.g. only its case) of the child `item` """
+        del self._children[item.name.lower()]
+        item.name = _shared(name)
+        self._children[_key(name)] = item
+
+    def remove(self, name):
+        if self._children is _no_children:
+            return None
+        item = self._children.pop(name.lower(), None)
+        if item is not None and len(self._children) == 0:
+            self._children = _no_children
+        return item
+
+
+class LazyFolder(Folder):
+    """ Folder of a `SqliteStore` tree: its children are loaded from the store when they're first accessed
+    (and unloaded again by the store when the folder hasn't been used for a while) """
+    __slots__ = ('_store', '_key')
+
+    def __init__(self, name, store: SqliteStore, key):
+        super().__init__(name)
+        self._children = None  # not loaded
+        self._store = store
+        self._key = key  # case-folded path relative to the base path
+
+    def __getstate__(self):
+        raise TypeError('LazyFolder is persisted by its store')
+
+    def _entries(self):
+        children = self._children
+        if children is None:
+            return self._load()
+        self._store.touch(self)
+        return children
+
+    def _load(self):
+        with self._store.lock:
+            if self._children is None:
+                children = {}
+                for name, size, modified, rev, content_hash in self._store.children(self._key):
+                    node = self.new_folder(name) if size is None else File(name, size, modified, rev, content_hash)
+                    children[_key(name)] = node
+                self._children = children if len(children) > 0 else _no_children
+                self._store.loaded(self)
+            return self._children
+
+    def unload(self):
+        self._children = None
+
+    def is_loaded(self):
+        return self._children is not None
+
+    def __iter__(self):
+        return iter(self._entries().values())
+
+    def __len__(self):
+        return len(self._entries())
+
+    def get(self, name):
+        return self._entries().get(name.lower())
+
+    def get_file(self, name):
+        item = self._entries().get(name.lower())
+        return item if isinstance(item, File) else None
+
+    def get_folder(self, name):
+        item = self._entries().get(name.lower())
+        return item if isinstance(item, Folder) else None
+
+    def new_folder(self, name):
+        return LazyFolder(name, self._store, self._key + '/' + name.lower() if self._key else name.lower())
+
+
+def node_from_metadata(e):
+    """ the tree node for a `files_list_folder` entry (None for deleted entries) """
+    name = e.path_display.rsplit('/', 1)[-1]
+    if isinstance(e, FileMetadata):
+        return File.from_metadata(name, e)
+    elif isinstance(e, FolderMetadata):
+        return Folder(name)
+    return None
+
+
+def base_path_depth(db_base_path):
+    return len([t for t in db_base_path.split('/') if len(t) > 0])
+
+
+def apply_changes(root: Folder, changes, path_depth):
+    """ applies a list of `(path_display, node)` changes (see `node_from_metadata`) to the tree below `root`
+    (changes below folders that aren't loaded from a `SqliteStore` are skipped, the store has them already) """
+    for path, node in changes:
+        path_components = path[1:].split('/')[path_depth:]
+        if len(path_components) <= 0:
+            continue
+        folder = root
+        for f in path_components[:-1]:
+            if not folder.is_loaded():
+                break
+            sub_folder = folder.get_folder(f)
+            folder = folder.add_folder(folder.new_folder(f)) if sub_folder is None else sub_folder
+        if not folder.is_loaded():
+            continue
+        f = path_components[-1]
+        if isinstance(node, File):
+            # log.debug('add/change file {}'.format(path))
+            folder.add_file(node)
+        elif isinstance(node, Folder):
+            # log.debug('add/change folder {}'.format(path))
+            existing = folder.get_folder(f)
+            if existing is None:
+                folder.add_folder(folder.new_folder(f))
+            elif existing.name != f:
+                log.debug('change {} to {}'.format(existing.name, f))
+                folder.rename(existing, f)
+        else:  # deleted
+            # log.debug('removing file/folder {}'.format(path))
+            folder.remove(f)
+
+
+def store_changes(store: SqliteStore, changes, path_depth):
+    """ writes a list of `(path_display, node)` changes to `store` (within a transaction) """
+    for path, node in changes:
+        path_components = path[1:].split('/')[path_depth:]
+        if len(path_components) <= 0:
+            continue
+        if isinstance(node, File):
+            store.put_file(path_components, node.size, node.modified, node.rev, node.content_hash)
+        elif isinstance(node, Folder):
+            store.put_folder(path_components)
+        else:
+            store.delete(path_components)
+
+
+def remove_db_file():
+    for path in [db_file, db_file + '-wal', db_file + '-shm']:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 
 class DropboxCrawler:
@@ -37,43 +289,86 @@ class DropboxCrawler:
     dbx: dropbox.Dropbox
     _update_cursor: str
     _crawl_cursor: str
+    _partitions: dict  # path -> cursor of the subtrees that are still being crawled in parallel
     _finished_crawling: bool
     _db_token: str
     _db_base_path: str
     _local_folder: Path
     _base_path_depth: int
+    storage: str
 
     def __init__(self, finished_initial_crawl_callback=lambda: None):
         """ You must either call `init` or `load_snapshot` to get things going."""
 
         self.save_interval = 120  # periodically save every n seconds
         self.save_interval_entries = 500  # save when n items have been updated
+        self.crawl_workers = 1  # > 1: crawl that many subtrees in parallel (see `_crawl_partitions`)
+        self.crawl_partition_depth = 1  # number of folder levels that are listed to find the subtrees
+        self.journal_compact_size = 64 * 2 ** 20  # merge the journal into `data_file` when it exceeds n bytes
+        self.compact_retry_interval = 60  # seconds before a failed compaction is tried again
         self.finished_initial_crawl_callback = finished_initial_crawl_callback
+        self.change_listeners = []  # called with the changes (see `apply_changes`) applied by `update_tree`
 
         self.space_used = 0
         self.space_allocated = 0
 
         self._finished = Event()
         self._stop_request = False
+        self._lock = RLock()  # for changing the tree (from several crawl workers)
+        self._save_lock = Lock()  # one save at a time (a full snapshot is written without holding `_lock`)
         self._updated_entries = 0  # count how many entries have been updated
         self._last_save = datetime.now()
+        self.storage = 'pickle'
+        self._journal = Journal(journal_file)
+        self._unsaved_changes = []  # changes not yet appended to the journal
+        self._compacting = None
+        self._compact_retry = 0  # time after which a failed compaction is tried again
+        self._store = None  # for storage == 'sqlite'
+        self.folder_cache_size = 10000  # number of folders a `SqliteStore` keeps in memory
+        self.change_batch_size = 100000  # maximum number of changes applied (and saved) at once
+        self.feed_stats = dict(batches=0, entries=0, last_batch=0, entries_per_second=None, lag=None,
+                               modified_lag=None)  # of `pull_changes` (lag: seconds from noticing to applying)
+        self.list_timeout = 60  # seconds to wait for an on-demand listing another thread started
+        self._listed = set()  # case-folded paths of the folders listed on demand during the initial crawl
+        self._listing = {}  # case-folded path -> Event of the on-demand listings in progress
+        self._listing_lock = RLock()
+        self.applied_entries = 0  # entries applied to the tree (initial crawl and changes)
+        self.snapshots = 0
+        self.snapshot_seconds = None  # duration of the last `save_snapshot`
+        self.snapshot_seconds_total = 0.
+        self._crawl_start = None  # (time, applied_entries) when the initial crawl started
+        self._crawl_end = None
 
         self.dbx = None
 
-    def init(self, db_token, db_base_path='', local_folder: Path = None):
-        """ db_base_path: for dropbox root use ''. Otherwise prepend a '/' """
+    def init(self, db_token, db_base_path='', local_folder: Path = None, storage='pickle'):
+        """ db_base_path: for dropbox root use ''. Otherwise prepend a '/'
+        storage: 'pickle' saves the whole tree to `data_file` every time,
+                 'journal' only appends the changes to `journal_file` (and compacts it in the background),
+                 'sqlite' keeps the tree in `db_file` and only loads the folders that are accessed
+        """
+        self.storage = storage
         self._db_token = db_token
         self._db_base_path = db_base_path
         self._local_folder = local_folder
         self._crawl_cursor = None
+        self._partitions = None
         self._finished_crawling = False
         self.connect()
         self._update_cursor = self.dbx.files_list_folder_get_latest_cursor(self._db_base_path, recursive=True,
                                                                            include_deleted=True).cursor
-        self.root = Folder(self._db_base_path)
+        if storage == 'sqlite':
+            self._move_data_file()  # `load_snapshot` would prefer it otherwise
+            self._journal.reset()
+            remove_db_file()  # might have an outdated schema
+            self._store = SqliteStore(db_file, self.folder_cache_size)
+            self.root = LazyFolder(self._db_base_path, self._store, '')
+        else:
+            remove_db_file()
+            self.root = Folder(self._db_base_path)
 
     def connect(self):
-        self._base_path_depth = len([t for t in self._db_base_path.split('/') if len(t) > 0])
+        self._base_path_depth = base_path_depth(self._db_base_path)
         log.info('Connecting to Dropbox...')
         self.dbx = dropbox.Dropbox(self._db_token)
 
@@ -91,37 +386,31 @@ class DropboxCrawler:
 
     def update_tree(self, data):
         log.debug('new data (%i entries)' % len(data.entries))
-        self._updated_entries += len(data.entries)
-        for e in data.entries:
-            path_components = e.path_display[1:].split('/')[self._base_path_depth:]
-            if len(path_components) <= 0:
-                continue
-            folder = self.root
-            for f in path_components[:-1]:
-                try:
-                    f_lower = f.lower()
-                    folder = next(val for key, val in folder.folders.items() if key.lower() == f_lower)
-                except StopIteration:
-                    new_folder = Folder(f)
-                    folder.folders[f] = new_folder
-                    folder = new_folder
-            f = path_components[-1]
-            if isinstance(e, FileMetadata):
-                # log.debug('add/change file {}'.format(e.path_display))
-                if f not in folder.files:
-                    remove_from_dict_case_insensitive(folder.files, f)
-                folder.files[f] = File(f, e)
-            elif isinstance(e, FolderMetadata):
-                # log.debug('add/change folder {}'.format(e.path_display))
-                if f not in folder.folders:
-                    remove_from_dict_case_insensitive(folder.folders, f)
-                folder.folders[f] = Folder(f)
-            else:  # DeletedMetadata
-                # log.debug('removing file/folder {}'.format(e.path_display))
-                remove_from_dict_case_insensitive(folder.files, f)
-                remove_from_dict_case_insensitive(folder.folders, f)
+        changes = [(e.path_display, node_from_metadata(e)) for e in data.entries]
+        with self._lock:
+            self._apply(changes)
         return data.cursor
 
+    def apply_local(self, changes):
+        """ applies `(path_display, node)` changes this instance made through the API (e.g. uploads) right away,
+        without waiting for the change feed (which delivers them again later) """
+        with self._lock:
+            self._apply(changes)
+
+    def _apply(self, changes):
+        self._updated_entries += len(changes)
+        self.applied_entries += len(changes)
+        if self._store is not None:
+            with self._store.transaction():
+                store_changes(self._store, changes, self._base_path_depth)
+                apply_changes(self.root, changes, self._base_path_depth)
+        else:
+            apply_changes(self.root, changes, self._base_path_depth)
+        if self.storage == 'journal':
+            self._unsaved_changes += changes
+        for listener in self.change_listeners:
+            listener(changes)
+
     def crawl(self):
         dbx = self.dbx
 
@@ -131,6 +420,11 @@ class DropboxCrawler:
         self.space_allocated = data.allocation.get_individual().allocated
 
         if not self._finished_crawling:
+            self._crawl_start = (time.time(), self.applied_entries)
+        if not self._finished_crawling and self._crawl_cursor is None \
+                and (self.crawl_workers > 1 or self._partitions is not None):
+            self._crawl_partitions()
+        elif not self._finished_crawling:
             log.info('doing initial crawl..')
             if self._crawl_cursor is None:
                 data = dbx.files_list_folder(self._db_base_path, recursive=True)
@@ -142,10 +436,13 @@ class DropboxCrawler:
                 if not data.has_more:
                     log.info('no further data')
                     self._finished_crawling = True
+                    self._listed.clear()
                     self.save_snapshot()
                     break
                 else:
                     self.save_snapshot()
+        if self._crawl_start is not None:
+            self._crawl_end = (time.time(), self.applied_entries)
 
         self.finished_initial_crawl_callback()
         log.info('poll for changes..')
@@ -157,72 +454,343 @@ class DropboxCrawler:
                 log.warning(e)
                 continue
             else:
-                # TODO: what if `changes.backoff is not None`?
                 if changes.changes:
-                    try:
-                        data = dbx.files_list_folder_continue(self._update_cursor)
-                    except ConnectionError as e:
-                        log.warning(e)
-                    else:
-                        self._update_cursor = self.update_tree(data)
+                    self.pull_changes()
+                if changes.backoff is not None:
+                    log.debug('backing off for {}s'.format(changes.backoff))
+                    time.sleep(changes.backoff)
             if self._stop_request:
                 break
             if (datetime.now() - self._last_save).total_seconds() > self.save_interval \
-                    or self._updated_entries >= self.save_interval_entries:
+                    or self._updated_entries >= self.save_interval_entries \
+                    or (self.storage != 'pickle' and self._updated_entries > 0):
                 self.save_snapshot()
 
         self.save_snapshot()
         self._finished.set()
         log.info('Worker thread exited normally')
 
+    def _header(self):
+        """ everything that is saved except for the tree """
+        data = {
+            'data_version': data_version,
+            'storage': self.storage,
+            'root_path': self._db_base_path,
+            'local_folder': self._local_folder,
+            'db_token': self._db_token,
+        }
+        data.update(self._state())
+        return data
+
+    def _crawl_partitions(self):
+        """ initial crawl with `crawl_workers` recursive cursors in parallel, one per subtree ("partition")
+
+        The top `crawl_partition_depth` folder levels are listed non-recursively first, their sub folders are the
+        partitions. The cursor of every partition is saved, so an interrupted crawl resumes each one where it
+        stopped. Changes after `init` are picked up by `_update_cursor` afterwards, as usual.
+        """
+        if self._partitions is None:
+            log.info('listing the top {} folder level(s)..'.format(self.crawl_partition_depth))
+            folders = [self._db_base_path]
+            for _ in range(self.crawl_partition_depth):
+                folders = [sub_folder for folder in folders for sub_folder in self._list_folders(folder)]
+            with self._lock:
+                self._partitions = {folder: None for folder in folders}
+                self.save_snapshot()
+        log.info('doing initial crawl of {} subtrees with {} workers..'.format(
+            len(self._partitions), self.crawl_workers))
+        with ThreadPoolExecutor(max(1, self.crawl_workers)) as pool:
+            for result in [pool.submit(self._crawl_partition, path) for path in list(self._partitions)]:
+                result.result()
+        if len(self._partitions) == 0:
+            log.info('no further data')
+            with self._lock:
+                self._partitions = None
+                self._finished_crawling = True
+                self._listed.clear()
+                self.save_snapshot()
+
+    def pull_changes(self):
+        """ fetches all pages of changes since `_update_cursor` and applies them to the tree, in batches of up to
+        `change_batch_size` entries (so a burst of changes is saved with one write) """
+        signaled = time.time()
+        while True:
+            entries, cursor, has_more = self._fetch_changes()
+            if cursor is None:
+                return
+            changes = [(e.path_display, node_from_metadata(e)) for e in entries]
+            with self._lock:
+                self._apply(changes)
+                self._update_cursor = cursor
+            now = time.time()
+            modified = [e.server_modified for e in entries if isinstance(e, FileMetadata)]
+            self.feed_stats['batches'] += 1
+            self.feed_stats['entries'] += len(entries)
+            self.feed_stats['last_batch'] = len(entries)
+            self.feed_stats['entries_per_second'] = round(len(entries) / max(now - signaled, 1e-6), 1)
+            self.feed_stats['lag'] = round(now - signaled, 3)
+            self.feed_stats['modified_lag'] = None if len(modified) == 0 else \
+                round(now - calendar.timegm(max(modified).utctimetuple()), 3)
+            log.debug('applied {} changes ({})'.format(len(entries), self.feed_stats))
+            if not has_more:
+                return
+            self.save_snapshot()  # (the last batch is saved by the polling loop)
+            signaled = now
+
+    def _fetch_changes(self):
+        """ (entries, cursor, has_more) of the next pages after `_update_cursor`, the cursor is None if nothing
+        could be fetched """
+        entries, cursor, has_more = [], None, True
+        while has_more and len(entries) < self.change_batch_size and not self._stop_request:
+            try:
+                data = self.dbx.files_list_folder_continue(self._update_cursor if cursor is None else cursor)
+            except RateLimitError as e:
+                log.warning('rate limited, backing off for {}s'.format(e.backoff))
+                time.sleep(e.backoff or 5)
+                continue
+            except (ReadTimeout, ConnectionError) as e:
+                log.warning(e)
+                break  # apply what was fetched so far, the longpoll notices the rest
+            entries += data.entries
+            cursor, has_more = data.cursor, data.has_more
+        return entries, cursor, has_more
+
+    def ensure_listed(self, path):
+        """ During the initial crawl: makes sure the folder `path` (relative to the base path, e.g. '/a/b') is in the
+        tree, by listing it right away (non-recursively) if it hasn't been yet. Concurrent calls for the same folder
+        share one listing. The background crawl may deliver the same entries again later, which doesn't change the
+        tree, and changes made since are delivered by its cursor afterwards.
+        """
+        if self._finished_crawling:
+            return
+        key = path.lower()
+        with self._listing_lock:
+            if key in self._listed:
+                return
+            event = self._listing.get(key)
+            if event is None:
+                event = self._listing[key] = Event()
+                mine = True
+            else:
+                mine = False
+        if not mine:
+            event.wait(self.list_timeout)
+            return
+        listed = False
+        try:
+            log.debug('listing {} on demand'.format(path))
+            self._list_folders(self._db_base_path + ('' if path == '/' else path))
+            listed = True
+        except ApiError as e:
+            listed = e.error.is_path() and e.error.get_path().is_not_found()  # nothing to wait for
+            if not listed:
+                log.warning('listing {} failed ({})'.format(path, str(e)))
+        except (ReadTimeout, ConnectionError) as e:
+            log.warning('listing {} failed ({})'.format(path, str(e)))
+        finally:
+            with self._listing_lock:
+                if listed:
+                    self._listed.add(key)
+                del self._listing[key]
+            event.set()
+
+    def _list_folders(self, path):
+        """ lists `path` (non-recursively) into the tree and returns its sub folders """
+        folders = []
+        data = self.dbx.files_list_folder(path)
+        while True:
+            self.update_tree(data)
+            folders += [e.path_display for e in data.entries if isinstance(e, FolderMetadata)]
+            if not data.has_more:
+                return folders
+            data = self.dbx.files_list_folder_continue(data.cursor)
+
+    def _crawl_partition(self, path):
+        cursor = self._partitions[path]
+        try:
+            if cursor is None:
+                data = self.dbx.files_list_folder(path, recursive=True)
+            else:
+                data = self.dbx.files_list_folder_continue(cursor)
+        except ApiError as e:  # e.g. deleted in the meantime (`_update_cursor` will tell)
+            log.warning('crawling {} failed: {}'.format(path, str(e)))
+            data = None
+        while not self._stop_request:
+            if data is not None:
+                cursor = self.update_tree(data)
+            with self._lock:
+                if data is None or not data.has_more:
+                    log.debug('finished crawling {}'.format(path))
+                    del self._partitions[path]
+                else:
+                    self._partitions[path] = cursor
+            self.save_snapshot()
+            if path not in self._partitions:
+                break
+            data = self.dbx.files_list_folder_continue(cursor)
+
+    def _state(self):
+        """ the part of the saved data that changes while crawling """
+        return {
+            'partitions': None if self._partitions is None else dict(self._partitions),
+            'crawl_cursor': self._crawl_cursor,
+            'update_cursor': self._update_cursor,
+            'finished_crawling': self._finished_crawling,
+            'last_save': self._last_save.timestamp()
+        }
+
     def load_snapshot(self):
         try:
-            with open(data_file, 'rb') as f:
-                data = pickle.load(f)
+            if os.path.exists(db_file) and not os.path.exists(data_file):
+                self._store = SqliteStore(db_file, self.folder_cache_size)
+                data = self._store.get_meta()
+                if data is None:
+                    raise RuntimeError('{} contains no data'.format(db_file))
+                data['root'] = LazyFolder(data['root_path'], self._store, '')
+            else:
+                with open(data_file, 'rb') as f:
+                    data = pickle.load(f)
             if data['data_version'] != data_version:
                 raise RuntimeError(
                     'incompatible versions of script ({}) and data file ({})'.format(
                         data_version, data['data_version'])
                 )
+            path_depth = base_path_depth(data['root_path'])
+            replayed = 0
+            for changes, state in self._journal.replay():
+                apply_changes(data['root'], changes, path_depth)
+                data.update(state)
+                replayed += 1
+            if replayed > 0:
+                log.info('replayed {} journal records'.format(replayed))
+            self.storage = data.get('storage', 'pickle')
             self._db_base_path = data['root_path']
             self.root = data['root']
             self._local_folder = data['local_folder']
             self._db_token = data['db_token']
             self._crawl_cursor = data['crawl_cursor']
+            self._partitions = data.get('partitions')
             self._update_cursor = data['update_cursor']
             self._finished_crawling = data['finished_crawling']
             self._last_save = datetime.fromtimestamp(data['last_save'])
             log.info('successfully loaded data')
+            if self.storage == 'journal' and self._journal.sealed():  # (a compaction was interrupted)
+                self._start_compaction()
             self.connect()
             return True
         except RuntimeError as e:
             log.error("loading data failed: {}".format(str(e)))
             return False
 
+    def stats(self):
+        rate = None
+        if self._crawl_start is not None:
+            t0, n0 = self._crawl_start
+            t1, n1 = self._crawl_end or (time.time(), self.applied_entries)
+            rate = round((n1 - n0) / max(t1 - t0, 1e-6), 1)
+        return dict(entries=self.applied_entries, finished_crawling=self._finished_crawling,
+                    crawl_entries_per_second=rate, snapshots=self.snapshots,
+                    snapshot_seconds=None if self.snapshot_seconds is None else round(self.snapshot_seconds, 4),
+                    snapshot_seconds_total=round(self.snapshot_seconds_total, 3), space_used=self.space_used,
+                    space_allocated=self.space_allocated)
+
     def save_snapshot(self):
-        log.debug('save data to %s' % data_file)
+        with self._save_lock:
+            t = time.perf_counter()
+            self._save_snapshot()
+            self.snapshot_seconds = time.perf_counter() - t
+            self.snapshot_seconds_total += self.snapshot_seconds
+            self.snapshots += 1
+
+    def _save_snapshot(self):
         was_finished = self._finished.is_set()
         self._finished.clear()  # don't kill the process during saving data!
+        if self._store is not None:
+            log.debug('save state to %s' % db_file)
+            with self._lock:
+                self._last_save = datetime.now()
+                self._store.set_meta(self._header())
+        elif self.storage == 'journal' and os.path.exists(data_file):
+            with self._lock:
+                self._append_journal()
+        else:
+            self._save_full_snapshot()
+        self._updated_entries = 0
+        if was_finished:
+            self._finished.set()
+
+    def _append_journal(self):
+        log.debug('append {} changes to {}'.format(len(self._unsaved_changes), journal_file))
+        self._last_save = datetime.now()
+        self._journal.append(self._unsaved_changes, self._state())
+        self._unsaved_changes = []
+        if self._compacting is None and (self._journal.sealed() or self._journal.size() > self.journal_compact_size
+                                         and self._journal.seal()):
+            self._start_compaction()
+
+    def _start_compaction(self):
+        """ merges the sealed journal into `data_file` in the background (unless that failed a short while ago,
+        the sealed journal stays until it succeeds) """
+        if self._compacting is None and time.time() >= self._compact_retry:
+            self._compacting = Thread(target=self._compact, daemon=True)
+            self._compacting.start()
+
+    def _compact(self):
+        """ merges the sealed journal into `data_file` (without touching `self.root`) """
+        log.debug('compacting {} into {}'.format(self._journal.sealed_path, data_file))
+        self._compact_retry = time.time() + self.compact_retry_interval  # (until it succeeded)
+        try:
+            with open(data_file, 'rb') as f:
+                data = pickle.load(f)
+            path_depth = base_path_depth(data['root_path'])
+            for changes, state in self._journal.records(self._journal.sealed_path):
+                apply_changes(data['root'], changes, path_depth)
+                data.update(state)
+            self._write(data)
+            self._journal.remove_sealed()
+            self._compact_retry = 0
+            log.debug('compaction finished')
+        except (OSError, EOFError, pickle.PickleError) as e:
+            log.error('compacting the journal failed: {}'.format(str(e)))
+        finally:
+            self._compacting = None
+
+    def _save_full_snapshot(self):
+        """ pickles the tree without holding `_lock`, so on-demand listings don't wait for it. Changes applied
+        meanwhile may or may not be in the snapshot; either way they are delivered again after its cursors (and
+        stay in `_unsaved_changes`). Only if one of them changes a folder while it is pickled, the tree is pickled
+        again under the lock. """
+        log.debug('save data to %s' % data_file)
+        self._move_data_file()
+        with self._lock:
+            self._last_save = datetime.now()
+            data = self._header()
+            data['root'] = self.root
+            saved = len(self._unsaved_changes)
+        try:
+            self._write(data)
+        except RuntimeError:  # (dictionary changed size during iteration)
+            log.debug('the tree changed while saving it, saving it again under the lock')
+            with self._lock:
+                self._write(data)
+        with self._lock:
+            self._journal.reset()  # everything is in `data_file` now
+            del self._unsaved_changes[:saved]
+
+    @staticmethod
+    def _move_data_file():
         try:
             shutil.move(data_file, 'data.prev.pkl')
         except FileNotFoundError:
             pass
         except shutil.Error as e:
             log.warning("moving {} to {} failed ({})".format(data_file, 'data.prev.pkl', str(e)))
-        self._last_save = datetime.now()
-        data = {
-            'data_version': data_version,
-            'root_path': self._db_base_path,
-            'root': self.root,
-            'local_folder': self._local_folder,
-            'db_token': self._db_token,
-            'crawl_cursor': self._crawl_cursor,
-            'update_cursor': self._update_cursor,
-            'finished_crawling': self._finished_crawling,
-            'last_save': self._last_save.timestamp()
-        }
-        with open(data_file, 'wb') as f:
-            pickle.dump(data, f)
-        self._updated_entries = 0
-        if was_finished:
-            self._finished.set()
+
+    @staticmethod
+    def _write(data):
+        tmp_file = data_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, data_file)
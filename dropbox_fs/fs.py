@@ -1,102 +1,410 @@
 import os
+import itertools
 import logging
 import stat
 import errno
-from time import time
-from fuse import FuseOSError, Operations, LoggingMixIn
+from collections import OrderedDict
+from threading import Lock
+from time import time, perf_counter
+from fuse import FuseOSError, Operations
 
 from dropbox_fs.crawler import DropboxCrawler, File
 from dropbox_fs.cache import FileCache
+from dropbox_fs.local_index import LocalIndex
+from dropbox_fs.metrics import Metrics, SamplingProfiler
+from dropbox_fs.path_cache import PathCache
+from dropbox_fs.search import SearchIndex, parse_query
+from dropbox_fs.writeback import WriteCache
 
 log = logging.getLogger(__name__)
 
+virtual_folder = '/.dropbox_fs'  # statistics inside the mount (not listed in the root folder)
+virtual_fh = 2 ** 48  # handles of the files in `virtual_folder` start here (the others are file descriptors)
+search_folder = virtual_folder + '/search'  # its sub folders list the results of their names as queries
 
-class DropboxFs(LoggingMixIn, Operations):
+
+class DropboxFs(Operations):
     def __init__(self, crawler: DropboxCrawler, file_cache: FileCache):
         # super().__init__()
         self.root = crawler.root
+        self.crawler = crawler
         self.file_cache = file_cache
         self.db_base_path = crawler._db_base_path
         if len(self.db_base_path) <= 0 or self.db_base_path[-1] != '/':
             self.db_base_path += '/'
 
-        self.local_folder = crawler._local_folder / self.db_base_path[1:]
+        self.local_folder = None if crawler._local_folder is None else crawler._local_folder / self.db_base_path[1:]
+        self.local_index = LocalIndex(self.local_folder)
+        self.local_index.start()
         self.time_created = time()
         self.folder_attr = dict(st_mode=(stat.S_IFDIR | 0o777), st_nlink=1)
         for t in ['st_ctime', 'st_mtime', 'st_atime']:
             self.folder_attr[t] = self.time_created
         self.file_attr_base = dict(st_mode=(stat.S_IFREG | 0o666), st_nlink=1, st_ctime=self.time_created)
 
+        # folder prefetch: when files of a folder are opened after listing it (e.g. by an image viewer), the other
+        # small files of the folder are downloaded in the background
+        self.folder_prefetch = False
+        self.folder_prefetch_trigger = 2  # opened files after which the rest of the folder is prefetched
+        self.folder_prefetch_max_size = 2 ** 22
+        self.folder_prefetch_folders = 64  # recently listed folders whose opened files are tracked
+        self._listed = OrderedDict()  # path of a listed folder -> names of the files opened in it since
+        self._listed_lock = Lock()
+
+        self.path_cache = PathCache()
+        crawler.change_listeners.append(lambda changes: self.path_cache.invalidate(changes, crawler._base_path_depth))
+
+        self.metrics = Metrics()
+        self.metrics.sources.update(crawler=crawler.stats, feed=lambda: crawler.feed_stats,
+                                    path_cache=self.path_cache.stats)
+        if file_cache is not None:
+            self.metrics.sources['file_cache'] = file_cache.stats
+        self.profiler = SamplingProfiler()
+        self.virtual_files = {virtual_folder + '/stats': self.metrics.json,
+                              virtual_folder + '/metrics': self.metrics.prometheus,
+                              virtual_folder + '/profile': self.profiler.folded}
+        self._virtual = {}  # path -> content of a virtual file as its last `getattr` reported it
+        self._virtual_handles = {}  # fh -> content
+        self._virtual_fh = itertools.count(virtual_fh)
+        self._operations = self.metrics.operations
+
+        self.search_index: SearchIndex = None  # (optional)
+        self.search_limit = 1000  # results listed in a query folder
+        self._search_results = OrderedDict()  # query -> {link name: target} of the last queries
+        self._search_lock = Lock()
+
+        self.write_cache: WriteCache = None  # (None: read-only)
+
+    def __call__(self, op, *args):
+        """ runs a FUSE operation and records its duration """
+        t = perf_counter()
+        try:
+            return getattr(self, op)(*args)
+        finally:
+            self._operations[op].observe(perf_counter() - t)
+
     def readdir(self, path, fh):
         log.debug('readdir {} {}'.format(path, fh))
+        if path.startswith(virtual_folder):
+            listing = self.virtual_listing(path)
+            if listing is not None:
+                return listing
+        listing = self.tree_listing(path)
+        return listing if self.write_cache is None else self.write_cache.listing(path, listing)
+
+    def tree_listing(self, path):
+        if self.folder_prefetch:
+            with self._listed_lock:
+                self._listed.pop(path, None)
+                self._listed[path] = set()
+                if len(self._listed) > self.folder_prefetch_folders:
+                    self._listed.popitem(last=False)
+        key = path.lower()
+        generation = self.path_cache.generation
+        try:
+            return self.path_cache.listing(key)
+        except KeyError:
+            pass
         folder = self.find_folder(path)  # os.path.normpath
         if folder is None:
             log.warning('unknown path: {}'.format(path))
             return ['.', '..']
-        return ['.', '..'] + list(folder.folders.keys()) + list(folder.files.keys())
+        listing = ['.', '..'] + [item.name for item in folder]
+        self.path_cache.set_listing(key, listing, generation)
+        return listing
 
     def file_attr(self, file: File):
         attr = self.file_attr_base.copy()
         attr['st_size'] = file.size
-        modified = file.modified.timestamp()
-        attr['st_mtime'] = modified
-        attr['st_atime'] = modified
+        attr['st_mtime'] = file.modified
+        attr['st_atime'] = file.modified
         return attr
 
     def getattr(self, path, fh=None):
-        # log.debug('getattr {} {}'.format(path, fh))
-        local = self.local_folder / path[1:]
-        if local.exists():
-            st = os.lstat(local)
-            return {key: getattr(st, key) for key in
-                    ['st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid']}
+        if path.startswith(virtual_folder):
+            attr = self.virtual_attr(path)
+            if attr is not None:
+                return attr
+        if self.write_cache is not None:
+            attr = self.write_cache.attr(path)
+            if attr is not None:
+                return attr
+        attr = self.local_index.get(path)
+        if attr is not None:
+            return attr
+        key = path.lower()
+        generation = self.path_cache.generation
+        try:
+            attr = self.path_cache.attr(key)
+        except KeyError:
+            attr = self.tree_attr(path)
+            self.path_cache.set_attr(key, attr, generation)
+        if attr is None:
+            raise FuseOSError(errno.ENOENT)
+        return attr
+
+    def virtual_listing(self, path):
+        """ the listing of `virtual_folder` or a folder in it (None for other paths) """
+        if path == virtual_folder:
+            names = [p.rsplit('/', 1)[1] for p in self.virtual_files]
+            return ['.', '..'] + names + ([] if self.search_index is None else ['search'])
+        query = self._query(path)
+        if query is None or '/' in query:
+            return None
+        return ['.', '..'] + ([] if query == '' else list(self.search_results(query, refresh=True)))
+
+    def _query(self, path):
+        """ the query of a path in `search_folder` ('' for the folder itself, None for other paths) """
+        if self.search_index is None or not path.startswith(search_folder):
+            return None
+        if path == search_folder:
+            return ''
+        return path[len(search_folder) + 1:] if path[len(search_folder)] == '/' else None
+
+    def search_results(self, query, refresh=False):
+        """ {link name: target} of the results of a query (see `search.parse_query`). The results of the last
+        queries are kept, so the links can be looked up after listing them. """
+        with self._search_lock:
+            results = None if refresh else self._search_results.get(query)
+        if results is not None:
+            return results
+        try:
+            found = self.search_index.search(limit=self.search_limit, **parse_query(query))
+        except ValueError as e:
+            log.warning('search for {} failed ({})'.format(query, str(e)))
+            raise FuseOSError(errno.EINVAL)
+        results = {}
+        for path, _, _ in found:
+            name = path[1:].replace('/', '\u2215')  # (division slash)
+            if len(name.encode()) > 255:
+                name = '{} {}'.format(len(results), path.rsplit('/', 1)[1])[:127]
+            results[name] = '../../..' + path  # (relative to the query folder)
+        with self._search_lock:
+            self._search_results[query] = results
+            self._search_results.move_to_end(query)
+            while len(self._search_results) > 16:
+                self._search_results.popitem(last=False)
+        return results
+
+    def virtual_attr(self, path):
+        """ the attr of `virtual_folder` or a file in it (None for other paths). The content of a file is rendered
+        here, so its size is right, and served by the next `open`. """
+        if path == virtual_folder:
+            return self.folder_attr
+        query = self._query(path)
+        if query is not None:
+            query, _, name = query.partition('/')
+            if name == '':
+                return self.folder_attr
+            target = self.search_results(query).get(name)
+            if target is None:
+                return None
+            return dict(st_mode=stat.S_IFLNK | 0o777, st_nlink=1, st_size=len(target.encode()),
+                        st_ctime=self.time_created, st_mtime=self.time_created, st_atime=self.time_created)
+        render = self.virtual_files.get(path)
+        if render is None:
+            return None
+        content = self._virtual[path] = render()
+        attr = self.file_attr_base.copy()
+        attr['st_mode'] = stat.S_IFREG | 0o444
+        attr['st_size'] = len(content)
+        attr['st_mtime'] = attr['st_atime'] = time()
+        return attr
+
+    def tree_attr(self, path):
+        """ the attr of `path` in the crawled tree (None if it isn't there) """
         if path == '/':
             return self.folder_attr
+        folder, item = os.path.split(path)
+        folder = self.find_folder(folder)
+        item = None if folder is None else folder.get(item)
+        if item is None:
+            return None
+        elif isinstance(item, File):
+            return self.file_attr(item)
         else:
-            folder, item = os.path.split(path)
-            folder = self.find_folder(folder)
-            if folder is None:
-                raise FuseOSError(errno.ENOENT)
-            elif item in folder.folders:
-                return self.folder_attr
-            elif item in folder.files:
-                return self.file_attr(folder.files[item])
-            else:
-                raise FuseOSError(errno.ENOENT)
+            return self.folder_attr
 
     def find_folder(self, path):
+        if not self.crawler._finished_crawling:
+            return self.find_folder_listed(path)
         cur_folder = self.root
         if path != '/':
             hierarchy = path[1:].split('/')  # os.path.sep <= path must be normpath'ed for that..
             for folder in hierarchy:
-                if folder in cur_folder.folders:
-                    cur_folder = cur_folder.folders[folder]
-                else:
+                cur_folder = cur_folder.get_folder(folder)
+                if cur_folder is None:
                     return None
         return cur_folder
 
+    def find_folder_listed(self, path):
+        """ `find_folder` during the initial crawl: lists the folders on the way that it hasn't reached yet """
+        self.crawler.ensure_listed('/')
+        cur_folder = self.root
+        cur_path = ''
+        if path != '/':
+            for folder in path[1:].split('/'):
+                cur_folder = cur_folder.get_folder(folder)
+                if cur_folder is None:
+                    return None
+                cur_path += '/' + folder
+                self.crawler.ensure_listed(cur_path)
+        return cur_folder
+
     def open(self, path, flags):
+        if path in self.virtual_files:
+            fh = next(self._virtual_fh)
+            content = self._virtual.pop(path, None)
+            self._virtual_handles[fh] = self.virtual_files[path]() if content is None else content
+            return fh
+        if self.write_cache is not None and (flags & (os.O_WRONLY | os.O_RDWR) or path in self.write_cache):
+            fh = self.write_cache.open(path, flags, self.tree_file(path), self.local_file(path))
+            if fh is not None:
+                return fh
         rel_path = path[1:]
-        local = self.local_folder / rel_path
-        if local.exists():
+        if path in self.local_index:
             log.debug('open locally: {}'.format(path))
-            return self.file_cache.open_file(local, flags)
+            return self.file_cache.open_file(self.local_folder / rel_path, flags)
         folder, item = os.path.split(path)
         folder = self.find_folder(folder)
-        if item in folder.files:
+        file = None if folder is None else folder.get_file(item)
+        if file is not None:
             log.debug('trying to open from cache: {}'.format(path))
-            return self.file_cache.open(path, rel_path, folder.files[item], self.db_base_path + rel_path, flags)
+            fh = self.file_cache.open(path, rel_path, file, self.db_base_path + rel_path, flags)
+            if self.folder_prefetch:
+                self.prefetch_siblings(os.path.dirname(path), folder, file)
+            return fh
         else:
             return 0
 
+    def prefetch_siblings(self, path, folder, file: File):
+        with self._listed_lock:
+            opened = self._listed.get(path)
+            if opened is None:
+                return
+            opened.add(file.name)
+            if len(opened) != self.folder_prefetch_trigger:
+                return
+            opened = set(opened)
+        log.debug('prefetching {}'.format(path))
+        self.file_cache.cancel_prefetch()  # of the previous folder
+        prefix = '' if path == '/' else path[1:] + '/'
+        siblings = sorted(folder.files.values(), key=lambda f: (f.name < file.name, f.name))  # the next ones first
+        for f in siblings:
+            if f.size <= self.folder_prefetch_max_size and f.name not in opened \
+                    and '/' + prefix + f.name not in self.local_index:
+                self.file_cache.prefetch(prefix + f.name, f, self.db_base_path + prefix + f.name)
+
+    def tree_file(self, path):
+        """ the file at `path` in the crawled tree (None if there is none) """
+        folder, item = os.path.split(path)
+        folder = self.find_folder(folder)
+        return None if folder is None else folder.get_file(item)
+
+    def local_file(self, path):
+        """ the copy of `path` in the local dropbox folder (None if there is none) """
+        return self.local_folder / path[1:] if path in self.local_index else None
+
     def read(self, path, size, offset, fh):
         if fh == 0:
             raise FuseOSError(errno.EIO)
-        log.debug('read {} @ {}: {}'.format(size, offset, path))
+        if fh >= virtual_fh:
+            return self._virtual_handles[fh][offset:offset + size]
+        if self.write_cache is not None and fh in self.write_cache.handles:
+            return self.write_cache.read(fh, size, offset)
         return self.file_cache.read(path, size, offset, fh)
 
+    def create(self, path, mode, fi=None):
+        self.check_writable(path)
+        return self.write_cache.create(path)
+
+    def write(self, path, data, offset, fh):
+        return self.write_cache.write(fh, data, offset)
+
+    def truncate(self, path, length, fh=None):
+        self.check_writable(path)
+        attr = self.tree_attr(path)
+        if attr is self.folder_attr:
+            raise FuseOSError(errno.EISDIR)
+        if attr is None and path not in self.write_cache and fh not in self.write_cache.handles:
+            raise FuseOSError(errno.ENOENT)
+        self.write_cache.truncate(path, length, fh, self.tree_file(path), self.local_file(path))
+
+    def flush(self, path, fh):
+        if self.write_cache is not None and fh in self.write_cache.handles:
+            self.write_cache.flush(fh)
+
+    def fsync(self, path, datasync, fh):
+        if self.write_cache is not None and fh in self.write_cache.handles:
+            self.write_cache.fsync(fh, datasync)
+
+    def unlink(self, path):
+        self.check_writable(path)
+        remote = self.tree_file(path) is not None
+        if not remote and path not in self.write_cache:
+            raise FuseOSError(errno.ENOENT)
+        self.write_cache.unlink(path, remote)
+
+    def mkdir(self, path, mode):
+        self.check_writable(path)
+        self.write_cache.mkdir(path)
+
+    def rmdir(self, path):
+        self.check_writable(path)
+        folder = self.find_folder(path)
+        if folder is None:
+            raise FuseOSError(errno.ENOENT)
+        if len(folder) > 0:
+            raise FuseOSError(errno.ENOTEMPTY)
+        self.write_cache.rmdir(path)
+
+    def rename(self, old, new):
+        self.check_writable(old)
+        self.check_writable(new)
+        old_attr = self.tree_attr(old)
+        old_remote = old_attr is not None
+        if not old_remote and old not in self.write_cache:
+            raise FuseOSError(errno.ENOENT)
+        new_attr = self.tree_attr(new)
+        new_folder = new_attr is self.folder_attr
+        if (old_attr is self.folder_attr) != new_folder and (new_attr is not None or new in self.write_cache):
+            raise FuseOSError(errno.EISDIR if new_folder else errno.ENOTDIR)  # (like rename(2))
+        if new_folder and len(self.find_folder(new)) > 0:
+            raise FuseOSError(errno.ENOTEMPTY)
+        self.write_cache.rename(old, new, old_remote, new_attr is not None)
+
+    def utimens(self, path, times=None):
+        if self.write_cache is not None:
+            self.write_cache.utimens(path, time() if times is None else times[1])
+
+    def chmod(self, path, mode):
+        pass  # (dropbox has no permissions)
+
+    def chown(self, path, uid, gid):
+        pass
+
+    def check_writable(self, path):
+        if self.write_cache is None:
+            raise FuseOSError(errno.EROFS)
+        if path.startswith(virtual_folder):
+            raise FuseOSError(errno.EACCES)
+
+    def readlink(self, path):
+        query = self._query(path)
+        query, _, name = ('' if query is None else query).partition('/')
+        target = None if name == '' else self.search_results(query).get(name)
+        if target is None:
+            raise FuseOSError(errno.ENOENT)
+        return target
+
     def release(self, path, fh):
         log.debug('close {}'.format(path))
+        if fh >= virtual_fh:
+            del self._virtual_handles[fh]
+            return
+        if self.write_cache is not None and fh in self.write_cache.handles:
+            self.write_cache.release(fh)
+            return
         self.file_cache.close(fh)
 
     # access = None
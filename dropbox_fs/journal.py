@@ -0,0 +1,95 @@
+import logging
+import os
+import pickle
+
+log = logging.getLogger(__name__)
+
+
+class Journal:
+    """ Append-only log of the changes applied to the tree since the last full snapshot.
+
+    Every record is a pickled `(changes, state)` tuple, where `changes` is a list of `(path_display, node)` and
+    `state` holds the cursors etc. after applying them. For compaction the current log is sealed (renamed to
+    `<path>.sealed`) and a new one is started, so the sealed records can be merged into the base snapshot
+    without blocking further appends.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sealed_path = path + '.sealed'
+        self._f = None
+
+    def append(self, changes, state):
+        if self._f is None:
+            self._f = open(self.path, 'ab')
+        pickle.dump((changes, state), self._f, pickle.HIGHEST_PROTOCOL)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def size(self):
+        if self._f is not None:
+            return self._f.tell()
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def sealed(self):
+        return os.path.exists(self.sealed_path)
+
+    def seal(self):
+        """ moves the current log aside for compaction. Returns False if the previous one is not compacted yet. """
+        if self.sealed():
+            return False
+        self.close()
+        try:
+            os.replace(self.path, self.sealed_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def remove_sealed(self):
+        os.remove(self.sealed_path)
+
+    def replay(self):
+        """ yields the records of the sealed and the current log (in that order).
+
+        A torn record at the end of the current log (e.g. after a crash) is cut off, so appending can continue.
+        """
+        yield from self.records(self.sealed_path)
+        yield from self.records(self.path, truncate=True)
+
+    @staticmethod
+    def records(path, truncate=False):
+        try:
+            f = open(path, 'r+b' if truncate else 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            valid_size = 0
+            while True:
+                try:
+                    record = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError, TypeError, AttributeError):
+                    break
+                valid_size = f.tell()
+                yield record
+            total_size = f.seek(0, os.SEEK_END)
+            if total_size > valid_size:
+                log.warning('corrupt end of {} ({} of {} bytes valid)'.format(path, valid_size, total_size))
+                if truncate:
+                    f.truncate(valid_size)
+
+    def reset(self):
+        """ deletes both logs, e.g. after everything has been written to a full snapshot """
+        self.close()
+        for path in [self.path, self.sealed_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
@@ -0,0 +1,258 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import stat
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from threading import Thread, Lock
+
+log = logging.getLogger(__name__)
+
+stat_keys = ['st_mode', 'st_size', 'st_mtime', 'st_atime', 'st_ctime', 'st_nlink', 'st_uid', 'st_gid']  # (mode first)
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+
+class Inotify:
+    """ Minimal binding of linux' inotify (raises OSError where it isn't available) """
+    _event = struct.Struct('iIII')  # wd, mask, cookie, len (of the name that follows)
+
+    def __init__(self):
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise OSError('inotify is not available ({})'.format(str(e)))
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """ blocks until there are events, returns them as a list of (wd, mask, name) """
+        data = os.read(self.fd, 2 ** 16)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self._event.unpack_from(data, pos)
+            pos += self._event.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+
+class LocalIndex:
+    """ The stats of everything in the local dropbox folder, so `DropboxFs` doesn't have to ask the file system
+    whether a path is there on every call.
+
+    Paths are the ones `DropboxFs` gets ('/' is the folder itself). `folders` maps the path of every folder to its
+    entries, name -> the values of `stat_keys` as a tuple (`get` returns them as the attr dict of `getattr`); the
+    entry of the folder itself is '' in '/'. The index is built with a parallel scan in the background (until that is
+    done, `get` asks the file system) and kept current with inotify; where that isn't available (or runs out of
+    watches) the folder is rescanned every `rescan_interval` seconds instead.
+    """
+
+    def __init__(self, root: Path = None, workers=8, rescan_interval=60):
+        self.root = None if root is None else str(root)
+        self.workers = workers
+        self.rescan_interval = rescan_interval
+        self.folders = {}
+        self.ready = root is None  # the first scan is done
+        self.mode = None  # 'inotify' or 'rescan' after `start`
+        self._inotify = None
+        self._watches = {}  # wd -> path of the watched folder
+        self._watch_ids = {}  # path of a watched folder -> wd
+        self._lock = Lock()
+
+    def __contains__(self, path):
+        return self._entry(path) is not None
+
+    def __len__(self):
+        return sum(len(entries) for entries in list(self.folders.values()))  # (including the folder itself)
+
+    def get(self, path):
+        e = self._entry(path)
+        if e is None:
+            return None
+        return {'st_mode': e[0], 'st_size': e[1], 'st_mtime': e[2], 'st_atime': e[3], 'st_ctime': e[4],
+                'st_nlink': e[5], 'st_uid': e[6], 'st_gid': e[7]}
+
+    def _entry(self, path):
+        if not self.ready:
+            st = self._lstat(path)
+            return None if st is None else self._attr(st)
+        folder, _, name = path.rpartition('/')
+        entries = self.folders.get(folder or '/')
+        return None if entries is None else entries.get(name)
+
+    def start(self):
+        """ scans the folder in the background, then keeps the index current """
+        if self.root is None:
+            return
+        try:
+            self._inotify = Inotify()
+            self.mode = 'inotify'
+        except OSError as e:
+            log.info('watching the local folder failed, rescanning it every {}s instead ({})'
+                     .format(self.rescan_interval, str(e)))
+            self.mode = 'rescan'
+        Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        t = time.time()
+        self.folders = self._scan_all()
+        self.ready = True
+        log.info('indexed {} local files and folders in {:.1f}s'.format(len(self), time.time() - t))
+        if self.mode == 'inotify':
+            self._watch()
+        self._rescan()
+
+    def _scan_all(self):
+        st = self._lstat('/')
+        if st is None:
+            return {}
+        folders = self._scan('/') if stat.S_ISDIR(st.st_mode) else {'/': {}}
+        folders['/'][''] = self._attr(st)
+        return folders
+
+    def _scan(self, path):
+        """ the folders `path` and below with their entries, scanned in parallel """
+        folders = {}
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = {pool.submit(self._scan_folder, path)}
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folder, found, sub_folders = future.result()
+                    folders[folder] = found
+                    pending.update(pool.submit(self._scan_folder, f) for f in sub_folders)
+        return folders
+
+    def _scan_folder(self, path):
+        found, folders = {}, []
+        self._add_watch(path)  # before listing, so nothing created in the meantime is missed
+        try:
+            with os.scandir(self.root + path) as it:
+                for e in it:
+                    try:
+                        st = e.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    found[e.name] = self._attr(st)
+                    if stat.S_ISDIR(st.st_mode):
+                        folders.append(self._join(path, e.name))
+        except OSError as e:
+            log.warning('scanning {} failed ({})'.format(path, str(e)))
+        return path, found, folders
+
+    def _add_watch(self, path):
+        if self.mode != 'inotify':
+            return
+        try:
+            wd = self._inotify.add_watch(self.root + path, watch_mask)
+        except OSError as e:
+            log.warning('watching the local folder failed, rescanning it every {}s instead ({})'
+                        .format(self.rescan_interval, str(e)))
+            self.mode = 'rescan'  # e.g. out of watches (fs.inotify.max_user_watches)
+            return
+        with self._lock:
+            self._watches[wd] = path
+            self._watch_ids[path] = wd
+
+    def _watch(self):
+        while self.mode == 'inotify':
+            try:
+                events = self._inotify.read()
+            except OSError as e:
+                log.error('reading inotify events failed ({})'.format(str(e)))
+                self.mode = 'rescan'
+                break
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    log.warning('missed changes of the local folder, rescanning it')
+                    self.folders = self._scan_all()
+                    continue
+                with self._lock:
+                    if mask & IN_IGNORED:
+                        folder = self._watches.pop(wd, None)
+                        if self._watch_ids.get(folder) == wd:
+                            del self._watch_ids[folder]
+                    else:
+                        folder = self._watches.get(wd)
+                if folder is not None and len(name) > 0:
+                    self._refresh(self._join(folder, name))
+
+    def _refresh(self, path):
+        """ updates the entry of `path` after an event """
+        st = self._lstat(path)
+        folder, _, name = path.rpartition('/')
+        entries = self.folders.get(folder or '/')
+        if entries is None:  # (its folder is gone as well)
+            return
+        old = entries.get(name)
+        if st is not None and (not stat.S_ISDIR(st.st_mode) or (old is not None and stat.S_ISDIR(old[0]))):
+            entries[name] = self._attr(st)
+            return
+        with self._lock:  # gone, or a new folder: drop everything that was below it
+            entries.pop(name, None)
+            self._remove_folder(path)
+        if st is not None:
+            found = self._scan(path)
+            entries[name] = self._attr(st)
+            self.folders.update(found)
+
+    def _remove_folder(self, path):
+        """ drops the folder `path` and everything below it from the index, stops watching them """
+        stack = [path]
+        while len(stack) > 0:
+            folder = stack.pop()
+            entries = self.folders.pop(folder, None)
+            wd = self._watch_ids.pop(folder, None)
+            if wd is not None:
+                self._inotify.rm_watch(wd)
+                self._watches.pop(wd, None)
+            if entries is not None:
+                stack += [self._join(folder, name) for name, entry in entries.items() if stat.S_ISDIR(entry[0])]
+
+    def _rescan(self):
+        while True:
+            time.sleep(self.rescan_interval)
+            self.folders = self._scan_all()
+
+    def _lstat(self, path):
+        try:
+            return os.lstat(self.root + path)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _attr(st):
+        return tuple(getattr(st, key) for key in stat_keys)
+
+    @staticmethod
+    def _join(folder, name):
+        return folder + name if folder.endswith('/') else folder + '/' + name
@@ -0,0 +1,160 @@
+import json
+import logging
+import sys
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Event, get_ident
+
+log = logging.getLogger(__name__)
+
+buckets = (.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)  # s
+
+
+class Histogram:
+    """ Counts of durations per bucket (upper bounds in `buckets`, the last count is everything above).
+    Not locked: a concurrent update is lost once in a while, which doesn't matter for the statistics. """
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """ upper bound of the bucket the `q` quantile falls into (None without observations) """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        n = 0
+        for i, count in enumerate(self.counts):
+            n += count
+            if n >= rank:
+                return buckets[i] if i < len(buckets) else float('inf')
+
+    def summary(self):
+        ms = [None if q is None else round(q * 1000, 3) for q in (self.quantile(.5), self.quantile(.99))]
+        return dict(count=self.count, mean_ms=round(self.sum / max(self.count, 1) * 1000, 3), p50_ms=ms[0],
+                    p99_ms=ms[1])
+
+
+class Metrics:
+    """ Latency histograms of the FUSE operations and the stats of the other components (`sources`: section name ->
+    function returning a dict), as JSON or in the Prometheus text format """
+
+    def __init__(self):
+        self.operations = defaultdict(Histogram)  # name -> Histogram
+        self.sources = {}
+
+    def snapshot(self):
+        data = {'operations': {op: h.summary() for op, h in sorted(list(self.operations.items()))}}
+        for section, fn in self.sources.items():
+            try:
+                data[section] = fn()
+            except Exception as e:  # (statistics must never break the file system)
+                data[section] = {'error': str(e)}
+        return data
+
+    def json(self) -> bytes:
+        return (json.dumps(self.snapshot(), indent=2, sort_keys=True, default=str) + '\n').encode()
+
+    def prometheus(self) -> bytes:
+        lines = ['# TYPE dropbox_fs_operation_seconds histogram']
+        for op, h in sorted(list(self.operations.items())):
+            n = 0
+            for bound, count in zip(buckets + ('+Inf',), h.counts):
+                n += count
+                lines.append('dropbox_fs_operation_seconds_bucket{{op="{}",le="{}"}} {}'.format(op, bound, n))
+            lines.append('dropbox_fs_operation_seconds_sum{{op="{}"}} {}'.format(op, h.sum))
+            lines.append('dropbox_fs_operation_seconds_count{{op="{}"}} {}'.format(op, h.count))
+        for section, fn in self.sources.items():
+            try:
+                values = fn()
+            except Exception:
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (bool, int, float)):
+                    lines.append('dropbox_fs_{}_{} {}'.format(section, key, float(value)))
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class MetricsServer:
+    """ serves `Metrics.prometheus` over HTTP (any path) """
+
+    def __init__(self, metrics: Metrics, port, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info('serving metrics on http://{}:{}/metrics'.format(*self.server.server_address))
+
+
+class SamplingProfiler:
+    """ Samples the stacks of all threads every `interval` seconds from a thread of its own, the profiled code
+    isn't touched. The samples are wall clock time, so threads waiting for I/O or a lock show up too.
+
+    `folded` returns them in the folded format of flamegraph.pl / speedscope: 'file:function;...;file:function n'.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = {}  # folded stack -> number of samples
+        self._stop = None
+
+    @property
+    def running(self):
+        return self._stop is not None
+
+    def start(self):
+        if self._stop is None:
+            self._stop = Event()
+            Thread(target=self._run, args=(self._stop,), name='profiler', daemon=True).start()
+            log.info('profiler started (sampling every {}s)'.format(self.interval))
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+            log.info('profiler stopped ({} samples)'.format(sum(self.samples.values())))
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def folded(self) -> bytes:
+        lines = ['{} {}'.format(stack, n) for stack, n in sorted(dict(self.samples).items(), key=lambda i: -i[1])]
+        return ('\n'.join(lines) + '\n' if lines else '').encode()
+
+    def _run(self, stop):
+        own = get_ident()
+        while not stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
@@ -5,14 +5,6 @@ import time
 log = logging.getLogger(__name__)
 
 
-def remove_from_dict_case_insensitive(dict, key):
-    key_lower = key.lower()
-    existing_key = next((k for k in dict.keys() if k.lower() == key_lower), None)
-    if existing_key is not None:
-        log.debug('change {} to {}'.format(existing_key, key))
-        del dict[existing_key]
-
-
 def wait_for_event(event, timeout_seconds):
     if os.name != 'nt':
         return event.wait(timeout_seconds)
@@ -21,3 +13,12 @@ def wait_for_event(event, timeout_seconds):
         if event.is_set():
             return True
     return False
+
+
+def parse_size(size: str) -> int:
+    """ parses sizes like '500M' or '20G' (binary units) """
+    units = 'KMGT'
+    size = size.strip().upper().rstrip('B')
+    if len(size) > 0 and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(size)
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class PathCache:
+    """ LRU cache of what `DropboxFs.getattr` and `readdir` return, keyed by the case-folded path.
+
+    An attr of None is a negative entry (the path doesn't exist). `invalidate` drops the entries the changes of
+    `DropboxCrawler.update_tree` make stale, the cached paths are indexed by their folder for that (so a deleted
+    folder only costs what was cached below it). Results computed while an invalidation happened are not stored
+    (see `generation`).
+    """
+
+    def __init__(self, size=100000):
+        self.size = size  # entries per kind (0: off)
+        self.generation = 0  # incremented on every invalidation
+        self.hits = 0
+        self.misses = 0
+        self._attrs = OrderedDict()
+        self._listings = OrderedDict()
+        self._children = {}  # key of a folder -> keys below it that are cached (or have cached entries below them)
+        self._lock = Lock()
+
+    def attr(self, key):
+        """ the cached attr (or None for a negative entry), raises KeyError if there is none """
+        return self._get(self._attrs, key)
+
+    def set_attr(self, key, attr, generation):
+        self._set(self._attrs, key, attr, generation)
+
+    def listing(self, key):
+        """ the cached `readdir` result, raises KeyError if there is none """
+        return self._get(self._listings, key)
+
+    def set_listing(self, key, listing, generation):
+        self._set(self._listings, key, listing, generation)
+
+    def invalidate(self, changes, path_depth):
+        """ drops the entries of the changed paths, the listings of their parents and everything below deleted
+        paths (`changes` as in `crawler.apply_changes`) """
+        deleted = []
+        with self._lock:
+            self.generation += 1
+            for path, node in changes:
+                key = ''
+                for c in path[1:].lower().split('/')[path_depth:]:
+                    self._drop(self._listings, key or '/')  # of the parent (and implicitly created ancestors)
+                    key += '/' + c
+                    self._drop(self._attrs, key)
+                if node is None and len(key) > 0:
+                    self._drop(self._listings, key)
+                    deleted.append(key)
+            for key in deleted:
+                stack = list(self._children.pop(key, ()))
+                while len(stack) > 0:
+                    k = stack.pop()
+                    self._attrs.pop(k, None)
+                    self._listings.pop(k, None)
+                    stack += self._children.pop(k, ())
+                self._unlink(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._attrs.clear()
+            self._listings.clear()
+            self._children.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, attrs=len(self._attrs), listings=len(self._listings))
+
+    def _get(self, d, key):
+        with self._lock:
+            try:
+                value = d[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            d.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _set(self, d, key, value, generation):
+        with self._lock:
+            if generation != self.generation or self.size <= 0:
+                return
+            d[key] = value
+            self._link(key)
+            if len(d) > self.size:
+                self._unlink(d.popitem(last=False)[0])
+
+    def _drop(self, d, key):
+        d.pop(key, None)
+        self._unlink(key)
+
+    def _link(self, key):
+        """ adds `key` (and its folders) to `_children` """
+        while key != '/':
+            folder = key.rpartition('/')[0] or '/'
+            children = self._children.get(folder)
+            if children is not None:
+                children.add(key)
+                return
+            self._children[folder] = {key}
+            key = folder
+
+    def _unlink(self, key):
+        """ removes `key` (and its folders) from `_children` once nothing is cached at or below it """
+        while key != '/' and key not in self._attrs and key not in self._listings and not self._children.get(key):
+            self._children.pop(key, None)
+            folder = key.rpartition('/')[0] or '/'
+            children = self._children.get(folder)
+            if children is None:
+                return
+            children.discard(key)
+            key = folder
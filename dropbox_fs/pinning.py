@@ -0,0 +1,89 @@
+import logging
+from dropbox_fs.cache import FileCache
+from dropbox_fs.crawler import DropboxCrawler, File, Folder
+
+log = logging.getLogger(__name__)
+
+
+class Pinner:
+    """ Keeps pinned files and folders of the crawled tree completely in the file cache: `pin` downloads everything
+    below a path (see `FileCache.sync`), files the crawler changes below pinned paths are downloaded again in the
+    background and pinned files are never evicted.
+
+    Paths are relative to the mount (e.g. '/Photos/2020'), like the ones `DropboxFs` gets.
+    """
+
+    def __init__(self, crawler: DropboxCrawler, file_cache: FileCache):
+        self.crawler = crawler
+        self.file_cache = file_cache
+        crawler.change_listeners.append(self.changed)
+
+    @property
+    def db_base_path(self):
+        return self.crawler._db_base_path.rstrip('/') + '/'
+
+    def pin(self, path):
+        """ pins `path` and queues the download of its files, returns what is queued """
+        rel_path, node = self.find(path.strip('/'))
+        if node is None:
+            raise ValueError('{} not found'.format(path))
+        self.file_cache.pin(rel_path)
+        files = list(self.files(rel_path, node))
+        self.file_cache.sync(files)
+        log.info('pinned {} ({} files)'.format(path, len(files)))
+        return dict(path='/' + rel_path, files=len(files), bytes=sum(f.size for _, f, _ in files))
+
+    def unpin(self, path):
+        """ unpins `path` and the paths pinned below it, their files can be evicted from now on """
+        rel_path = path.strip('/')
+        removed = self.file_cache.unpin(rel_path)
+        if len(removed) == 0:
+            if self.file_cache.is_pinned(rel_path):
+                raise ValueError('{} is pinned by a folder above it'.format(path))
+            raise ValueError('{} is not pinned'.format(path))
+        log.info('unpinned {}'.format(', '.join('/' + p for p in removed)))
+        return ['/' + p for p in removed]
+
+    def pinned(self):
+        return sorted('/' + p for p in self.file_cache.index.pinned.values())
+
+    def resync(self):
+        """ queues the files of all pinned paths (e.g. after starting, the cached ones are skipped) """
+        for pinned in list(self.file_cache.index.pinned.values()):
+            rel_path, node = self.find(pinned)
+            if node is not None:
+                self.file_cache.sync(list(self.files(rel_path, node)))
+
+    def changed(self, changes):
+        """ downloads the changed files below pinned paths (see `crawler.apply_changes`) """
+        if len(self.file_cache.index.pinned) == 0:
+            return
+        depth = self.crawler._base_path_depth
+        files = []
+        for path, node in changes:
+            if isinstance(node, File):
+                rel_path = '/'.join(path[1:].split('/')[depth:])
+                if self.file_cache.is_pinned(rel_path):
+                    files.append((rel_path, node, path))
+        if len(files) > 0:
+            self.file_cache.sync(files)
+
+    def find(self, rel_path):
+        """ (rel_path as spelled in the tree, file or folder) of `rel_path` (node None if it isn't there) """
+        node = self.crawler.root
+        names = []
+        for name in rel_path.split('/') if rel_path else ():
+            node = node.get(name) if isinstance(node, Folder) else None
+            if node is None:
+                return rel_path, None
+            names.append(node.name)
+        return '/'.join(names), node
+
+    def files(self, rel_path, node):
+        """ (rel_path, file, db_path) of `node` and all files below it """
+        if isinstance(node, File):
+            yield rel_path, node, self.db_base_path + rel_path
+            return
+        prefix = rel_path + '/' if rel_path else ''
+        for item in list(node):
+            yield from self.files(prefix + item.name, item)
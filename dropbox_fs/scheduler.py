@@ -0,0 +1,86 @@
+import itertools
+import logging
+from enum import IntEnum
+from queue import PriorityQueue
+from threading import Thread, Event, Lock
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    read = 0  # a read is waiting for it
+    fill = 1  # background download of an opened file
+    prefetch = 2  # speculative
+    sync = 3  # bulk download of pinned files
+
+
+class Job:
+    __slots__ = ('priority', 'fn', 'args', 'started', 'cancelled', 'done')
+
+    def __init__(self, priority, fn, args):
+        self.priority, self.fn, self.args = priority, fn, args
+        self.started = False
+        self.cancelled = False
+        self.done = Event()
+
+
+class DownloadScheduler:
+    """ Runs downloads on a fixed number of worker threads, highest priority (lowest value) first.
+
+    All downloads share one HTTP session, whose connection pool is sized to the number of workers.
+    """
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._queue = PriorityQueue()
+        self._order = itertools.count()  # FIFO within a priority
+        self._lock = Lock()
+        for i in range(workers):
+            Thread(target=self._work, name='download-{}'.format(i), daemon=True).start()
+
+    def submit(self, priority, fn, *args) -> Job:
+        job = Job(priority, fn, args)
+        self._queue.put((priority, next(self._order), job))
+        return job
+
+    def boost(self, job: Job, priority):
+        """ raises the priority of a queued job (e.g. when a read needs what is being prefetched) """
+        with self._lock:
+            if job.started or job.cancelled or priority >= job.priority:
+                return
+            job.priority = priority
+        self._queue.put((priority, next(self._order), job))  # the old queue entry is skipped
+
+    def cancel(self, job: Job) -> bool:
+        """ makes sure a job won't run, returns False if it has already been started """
+        with self._lock:
+            if job.started:
+                return False
+            job.cancelled = True
+            return True
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            _, _, job = self._queue.get()
+            with self._lock:
+                if job.started:  # a duplicate entry of a boosted job
+                    continue
+                job.started = True
+            if job.cancelled:
+                job.done.set()
+                continue
+            try:
+                job.fn(*job.args)
+            except Exception:
+                log.exception('download job failed')
+            finally:
+                job.done.set()
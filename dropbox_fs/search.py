@@ -0,0 +1,235 @@
+import calendar
+import logging
+import shlex
+import time
+from array import array
+from threading import Lock
+from dropbox_fs.crawler import DropboxCrawler, File, Folder
+from dropbox_fs.misc import parse_size
+
+log = logging.getLogger(__name__)
+
+
+def trigrams(name):
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+def parse_date(text):
+    return calendar.timegm(time.strptime(text, '%Y-%m-%d'))
+
+
+def parse_query(text):
+    """ the arguments of `SearchIndex.search` for a query like 'holiday jpg type:file size>1M after:2020-01-31
+    in:/Photos': words that must all be in the name and filters (size< size> after: before: type: in:), quoted
+    like in a shell if they contain spaces (e.g. 'in:"/My Photos"'). Paths can be separated by '\u2215' (division
+    slash, like in the names of `DropboxFs` search results) as well, a folder name cannot contain '/'. """
+    query = dict(words=[])
+    for word in shlex.split(text):
+        key, op, value = word.partition(':') if ':' in word else word.partition('>') if '>' in word \
+            else word.partition('<')
+        try:
+            if key == 'size' and op in ['<', '>']:
+                query['min_size' if op == '>' else 'max_size'] = parse_size(value)
+            elif op == ':' and key in ['after', 'before']:
+                query[key] = parse_date(value)
+            elif op == ':' and key == 'type' and value in ['file', 'folder']:
+                query['folders'] = value == 'folder'
+            elif op == ':' and key == 'in':
+                query['folder'] = '/' + value.replace('\u2215', '/').strip('/')
+            else:
+                query['words'].append(word)
+        except ValueError:
+            raise ValueError('invalid filter: {}'.format(word))
+    return query
+
+
+class SearchIndex:
+    """ Finds files and folders of the crawled tree by name without walking it: every name is indexed by its
+    trigrams (case-folded), a query only checks the entries of its rarest trigram, or those below its `in:` folder
+    if there are fewer of them. Queries with words shorter than 3 characters (or only filters) scan all entries.
+
+    `build` indexes the tree once, after that the crawler's changes (see `crawler.apply_changes`) keep it current.
+    Paths are relative to the mount (e.g. '/Photos/2020'). Entries get an id, the arrays hold their attributes;
+    ids of removed entries are reused and their stale postings are skipped (the names are checked anyway).
+    """
+
+    def __init__(self, crawler: DropboxCrawler):
+        self.crawler = crawler
+        self.ready = False
+        self._lock = Lock()
+        self._ids = {}  # case-folded folder path ('' for the top) -> {case-folded name: id}
+        self._entries = 0
+        self._paths = []  # id -> path (None: removed)
+        self._sizes = array('q')  # id -> size (-1: folder)
+        self._modified = array('q')
+        self._trigrams = {}  # trigram -> array of ids
+        self._free = []  # ids of removed entries
+        self._removed = 0  # entries removed since the postings were last rebuilt
+        self._pending = []  # changes that arrived during `build`
+        crawler.change_listeners.append(self.changed)
+
+    def __len__(self):
+        return self._entries
+
+    def build(self):
+        t = time.time()
+        stack = [('', self.crawler.root)]
+        while len(stack) > 0:
+            path, folder = stack.pop()
+            items = list(folder)
+            with self._lock:
+                for item in items:
+                    self._add(path + '/' + item.name, item)
+            stack += [(path + '/' + item.name, item) for item in items if isinstance(item, Folder)]
+        with self._lock:
+            for changes in self._pending:
+                self._apply(changes)
+            self._pending = None
+            self.ready = True
+        log.info('indexed {} names in {:.1f}s'.format(self._entries, time.time() - t))
+
+    def changed(self, changes):
+        depth = self.crawler._base_path_depth
+        changes = [('/' + '/'.join(path[1:].split('/')[depth:]), node) for path, node in changes]
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(changes)
+            else:
+                self._apply(changes)
+
+    def _apply(self, changes):
+        for path, node in changes:
+            if node is None:
+                self._remove(path)
+            elif path != '/':
+                self._add(path, node)
+
+    def _add(self, path, node):
+        folder, _, name = path.lower().rpartition('/')
+        names = self._ids.get(folder)
+        if names is None:
+            names = self._ids[folder] = {}
+        i = names.get(name)
+        size, modified = (node.size, node.modified) if isinstance(node, File) else (-1, 0)
+        if i is not None and self._paths[i] == path:  # (only the size / time changed)
+            self._sizes[i], self._modified[i] = size, modified
+            return
+        if i is None:
+            if len(self._free) > 0:
+                i = self._free.pop()
+            else:
+                i = len(self._paths)
+                self._paths.append(None)
+                self._sizes.append(0)
+                self._modified.append(0)
+            names[name] = i
+            self._entries += 1
+        self._paths[i] = path
+        self._sizes[i], self._modified[i] = size, modified
+        for trigram in trigrams(node.name.lower()):
+            ids = self._trigrams.get(trigram)
+            if ids is None:
+                ids = self._trigrams[trigram] = array('I')
+            ids.append(i)
+
+    def _remove(self, path):
+        key = path.lower()
+        folder, _, name = key.rpartition('/')
+        i = self._ids.get(folder, {}).pop(name, None)
+        if i is None:
+            return
+        removed = [i]
+        stack = [key] if self._sizes[i] < 0 else []  # a folder, everything below it is gone too
+        while len(stack) > 0:
+            folder = stack.pop()
+            names = self._ids.pop(folder, {})
+            removed += names.values()
+            stack += [folder + '/' + name for name, i in names.items() if self._sizes[i] < 0]
+        for i in removed:
+            self._paths[i] = None
+        self._free += removed
+        self._removed += len(removed)
+        self._entries -= len(removed)
+        if self._removed > max(self._entries, 100000):
+            self._reindex()
+
+    def _reindex(self):
+        """ rebuilds the postings without the stale ones """
+        self._trigrams = {}
+        for i, path in enumerate(self._paths):
+            if path is not None:
+                for trigram in trigrams(path[path.rfind('/') + 1:].lower()):
+                    ids = self._trigrams.get(trigram)
+                    if ids is None:
+                        ids = self._trigrams[trigram] = array('I')
+                    ids.append(i)
+        self._removed = 0
+
+    def search(self, words=(), min_size=None, max_size=None, after=None, before=None, folders=None, folder=None,
+               limit=1000):
+        """ [(path, size, modified)] of the entries whose name contains all `words` (case-insensitive) and that
+        match the filters (`folders`: only folders / only files, `folder`: below that path), size is None for
+        folders. At most `limit` results, sorted by path. """
+        if not self.ready:
+            raise ValueError('the search index is being built')
+        words = [w.lower() for w in words]
+        prefix = None if folder is None or folder == '/' else folder.lower() + '/'
+        results = []
+        with self._lock:
+            candidates = self._candidates(words)
+            if folder is not None:
+                below = self._below(folder, len(candidates))
+                candidates = candidates if below is None else below
+            seen = None if isinstance(candidates, range) else set()  # (postings may hold an id twice)
+            for i in candidates:
+                path = self._paths[i]
+                if path is None:
+                    continue
+                if seen is not None:
+                    if i in seen:
+                        continue
+                    seen.add(i)
+                size, modified = self._sizes[i], self._modified[i]
+                if folders is not None and folders != (size < 0):
+                    continue
+                if (min_size is not None or max_size is not None) and size < 0:
+                    continue
+                if (min_size is not None and size < min_size) or (max_size is not None and size > max_size) \
+                        or (after is not None and modified < after) or (before is not None and modified >= before):
+                    continue
+                name = path[path.rfind('/') + 1:].lower()
+                if not all(w in name for w in words):
+                    continue
+                if prefix is not None and not path.lower().startswith(prefix):
+                    continue
+                results.append((path, None if size < 0 else size, modified))
+                if len(results) >= limit:
+                    break
+        return sorted(results)
+
+    def _candidates(self, words):
+        """ the ids of the rarest trigram of the words (all ids if there is none) """
+        best = None
+        for word in words:
+            for trigram in trigrams(word):
+                ids = self._trigrams.get(trigram, ())
+                if best is None or len(ids) < len(best):
+                    best = ids
+        return range(len(self._paths)) if best is None else best
+
+    def _below(self, folder, limit):
+        """ the ids of the entries below `folder` (None if there are more than `limit`) """
+        ids = []
+        stack = [folder.rstrip('/').lower()]
+        while len(stack) > 0:
+            path = stack.pop()
+            for name, i in self._ids.get(path, {}).items():
+                ids.append(i)
+                if self._sizes[i] < 0:
+                    stack.append(path + '/' + name)
+            if len(ids) > limit:
+                return None
+        return ids
+
+    def stats(self):
+        return dict(entries=self._entries, trigrams=len(self._trigrams), ready=self.ready)
@@ -0,0 +1,118 @@
+import contextlib
+import logging
+import pickle
+import sqlite3
+from collections import OrderedDict
+from threading import RLock
+
+log = logging.getLogger(__name__)
+
+
+class SqliteStore:
+    """ The metadata tree in an SQLite database, so it doesn't have to be loaded as a whole.
+
+    Every file or folder is a row keyed by the case-folded path of its parent folder (relative to the dropbox base
+    path, '' for the base folder itself) and its case-folded name. Folders have no size. The saved crawler state
+    (cursors etc.) is a pickled dict in the `meta` table.
+
+    The store also keeps track of which folders are loaded in memory and unloads the least recently used ones
+    when there are more than `cache_size`.
+    """
+
+    def __init__(self, path: str, cache_size=10000):
+        self.path = path
+        self.cache_size = cache_size
+        self.lock = RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (parent TEXT NOT NULL, key TEXT NOT NULL, '
+                        'name TEXT NOT NULL, size INTEGER, modified INTEGER, rev TEXT, content_hash BLOB, '
+                        'PRIMARY KEY (parent, key)) WITHOUT ROWID')
+        self.db.commit()
+        self._loaded = OrderedDict()  # loaded folders, least recently used first
+        self._known_folders = set()  # folder keys that are known to exist in the current transaction
+
+    def get_meta(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'data'").fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def set_meta(self, data):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('data', ?)", (pickle.dumps(data),))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ all `put_*`/`delete` calls must be made within a transaction """
+        with self.lock, self.db:
+            self._known_folders.clear()
+            yield
+
+    def put_file(self, components, size, modified, rev, content_hash):
+        parent, key = self._parents(components)
+        self._delete_below(parent, key)  # in case this used to be a folder
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (parent, key, components[-1], size, modified, rev, content_hash))
+
+    def put_folder(self, components):
+        parent, key = self._parents(components)
+        self._delete_file(parent, key)
+        self.db.execute('INSERT INTO entries VALUES (?, ?, ?, NULL, NULL, NULL, NULL) '
+                        'ON CONFLICT (parent, key) DO UPDATE SET name = excluded.name', (parent, key, components[-1]))
+
+    def delete(self, components):
+        parent, key = self._parents(components, create=False)
+        self.db.execute('DELETE FROM entries WHERE parent = ? AND key = ?', (parent, key))
+        self._delete_below(parent, key)
+        self._known_folders.clear()
+
+    def children(self, key):
+        """ (name, size, modified, rev, content_hash) of all entries in the folder with the case-folded path `key`
+        (size is None for folders) """
+        with self.lock:
+            return self.db.execute('SELECT name, size, modified, rev, content_hash FROM entries WHERE parent = ?',
+                                   (key,)).fetchall()
+
+    def loaded(self, folder):
+        """ registers a folder whose children have just been loaded and unloads the least recently used ones """
+        with self.lock:
+            self._loaded[folder] = None
+            while len(self._loaded) > self.cache_size:
+                old, _ = self._loaded.popitem(last=False)
+                old.unload()
+
+    def touch(self, folder):
+        try:
+            self._loaded.move_to_end(folder)
+        except KeyError:  # unloaded in the meantime
+            pass
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _parents(self, components, create=True):
+        """ the parent key and the key of the entry at `components` (and makes sure all parent folders exist) """
+        keys = [c.lower() for c in components]
+        parent = ''
+        for i, key in enumerate(keys[:-1]):
+            folder_key = parent + '/' + key if parent else key
+            if create and folder_key not in self._known_folders:
+                # only the last component of `path_display` is guaranteed to have the right case
+                self._delete_file(parent, key)
+                self.db.execute('INSERT OR IGNORE INTO entries VALUES (?, ?, ?, NULL, NULL, NULL, NULL)',
+                                (parent, key, components[i]))
+                self._known_folders.add(folder_key)
+            parent = folder_key
+        return parent, keys[-1]
+
+    def _delete_file(self, parent, key):
+        self.db.execute('DELETE FROM entries WHERE parent = ? AND key = ? AND size IS NOT NULL', (parent, key))
+
+    def _delete_below(self, parent, key):
+        """ deletes everything below the folder `key` in `parent` (uses the primary key index: '0' follows '/') """
+        folder_key = parent + '/' + key if parent else key
+        self.db.execute('DELETE FROM entries WHERE parent = ? OR (parent >= ? AND parent < ?)',
+                        (folder_key, folder_key + '/', folder_key + '0'))
@@ -0,0 +1,684 @@
+import errno
+import logging
+import os
+import pickle
+import shutil
+import stat
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from threading import Condition, Thread
+from fuse import FuseOSError
+from requests.exceptions import ReadTimeout, ConnectionError
+from dropbox.exceptions import ApiError, InternalServerError, RateLimitError
+from dropbox.files import CommitInfo, FolderMetadata, UploadSessionCursor, UploadSessionFinishArg, WriteMode
+from dropbox_fs.cache import FileCache, read_at, write_at
+from dropbox_fs.crawler import DropboxCrawler, File, node_from_metadata
+
+log = logging.getLogger(__name__)
+
+transient_errors = (ConnectionError, ReadTimeout, RateLimitError, InternalServerError)  # worth retrying
+
+
+def error_number(e):
+    """ the errno for a failed API call (the errors are unions like DeleteError('path_lookup', LookupError(
+    'not_found', None)), their repr names the reason) """
+    if isinstance(e, ApiError):
+        reason = repr(e.error)
+        if "'not_found'" in reason:
+            return errno.ENOENT
+        if "'conflict'" in reason:
+            return errno.EEXIST
+        if "'insufficient_space'" in reason:
+            return errno.ENOSPC
+    return errno.EIO
+
+
+class Staged:
+    """ A file of the mount with a local copy in the write cache """
+    __slots__ = ('path', 'file', 'size', 'modified', 'generation', 'uploaded', 'node', 'due', 'since', 'retry',
+                 'writers', 'uploading', 'busy', 'remote', 'error')
+
+    def __init__(self, path, file: Path, size=0, modified=None, remote=False):
+        self.path = path  # relative to the mount, e.g. '/Photos/a.jpg'
+        self.file = file
+        self.size = size
+        self.modified = time.time() if modified is None else modified
+        self.generation = 0  # counts the changes
+        self.uploaded = 0  # the generation that was uploaded last
+        self.node = None  # the tree's file of that upload
+        self.due = 0  # when it is uploaded (if it doesn't change until then)
+        self.since = 0  # when the first change that isn't uploaded was made
+        self.retry = 0  # when a failed upload is tried again
+        self.writers = 0  # handles that are open for writing
+        self.uploading = False
+        self.busy = False  # it is moved to the file cache, renamed or deleted
+        self.remote = remote  # dropbox has (a version of) it
+        self.error = None  # why the last upload failed for good (it is tried again after the next change)
+
+    @property
+    def dirty(self):
+        return self.generation > self.uploaded
+
+
+class WriteCache:
+    """ Makes the mount writable: the files that are written are copied to `base_path` (or created there), reads
+    and writes of them use that copy, at the speed of the local disk. A background thread uploads them once they
+    haven't changed for `delay` seconds (so repeated writes to a file are uploaded once) or at the latest
+    `max_delay` seconds after their first change.
+
+    The uploads run in batches: the content of every file goes to an upload session (in requests of `chunk_size`,
+    `upload_workers` files at the same time), then the whole batch is committed with one
+    `files_upload_session_finish_batch_v2` call (a batch of a single small file uses `files_upload`). Uploaded
+    files are put into the crawled tree right away (see `DropboxCrawler.apply_local`) and their local copy into the
+    file cache. Uploads overwrite the file in dropbox, the last writer wins.
+
+    Until then `attr` and `listing` overlay the tree with the local copies. Deleting, renaming and creating folders
+    goes to the API right away. `sync_mode` decides what waits for the upload: 'fsync' (fsync(2) returns once the
+    file is uploaded), 'close' (close(2) as well) or 'none' (fsync only makes the local copy durable).
+
+    The paths of the local copies are saved to `base_path/index.pkl` (every `save_interval` seconds and by
+    fsync), what wasn't uploaded before exiting is uploaded after the next start.
+    """
+
+    def __init__(self, base_path: Path, crawler: DropboxCrawler, file_cache: FileCache, upload_workers=8):
+        self.base_path = base_path
+        self.crawler = crawler
+        self.file_cache = file_cache
+        self.db_base_path = crawler._db_base_path.rstrip('/') + '/'
+        self.sync_mode = 'fsync'
+        self.delay = 2  # seconds a file has to stay unchanged before it is uploaded
+        self.max_delay = 60
+        self.batch_size = 1000  # files committed at once (dropbox' limit)
+        self.chunk_size = 2 ** 23  # bytes per upload request
+        self.retries = 5  # for timeouts, connection errors and rate limiting (then the batch is tried again later)
+        self.backoff = 1  # seconds before the first retry, doubled for each further one
+        self.max_backoff = 60
+        self.save_interval = 5  # seconds between saving the index while uploading (fsync saves it right away)
+        self.handles = {}  # fh -> (Staged, file object, open for writing)
+
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.batches = 0
+        self.sessions = 0
+        self.failures = 0
+
+        self._staged = {}  # case-folded path -> Staged
+        self._queue = []  # files that were due beyond the last batch (largest first)
+        self._folders = {}  # case-folded path of a folder -> {case-folded name: Staged} of the files in it
+        self._lock = Condition()
+        self._changed_index = False
+        self._wakeup = 0  # when the uploader looks for due files next (0: it is busy and looks afterwards)
+        self._last_save = 0
+        self._pool = ThreadPoolExecutor(upload_workers, 'upload')
+
+    @property
+    def dbx(self):
+        return self.crawler.dbx
+
+    def __contains__(self, path):
+        return len(self._staged) > 0 and path.lower() in self._staged
+
+    def start(self):
+        self._load()
+        Thread(target=self._run, name='upload', daemon=True).start()
+
+    def attr(self, path):
+        """ the attr of the local copy of `path` (None if there is none) """
+        staged = self._staged.get(path.lower()) if len(self._staged) > 0 else None
+        if staged is None:
+            return None
+        return dict(st_mode=stat.S_IFREG | 0o666, st_nlink=1, st_size=staged.size, st_ctime=staged.modified,
+                    st_mtime=staged.modified, st_atime=staged.modified)
+
+    def listing(self, path, listing):
+        """ `listing` of the folder `path` plus the local copies in it """
+        if len(self._folders) == 0:
+            return listing
+        with self._lock:
+            staged = list(self._folders.get(path.lower(), {}).values())
+        if len(staged) == 0:
+            return listing
+        names = {name.lower() for name in listing}
+        return listing + [s.path.rsplit('/', 1)[1] for s in staged if s.path.rsplit('/', 1)[1].lower() not in names]
+
+    def open(self, path, flags, node: File = None, local_file: Path = None):
+        """ opens the local copy of `path`. For writing it is made first if needed: an empty file if `flags`
+        truncate it or it is new (no `node`), else a copy of the `local_file` or the file cache's download.
+        Returns None for reading if there is no local copy (anymore). """
+        write = flags & (os.O_WRONLY | os.O_RDWR) != 0
+        truncate = write and flags & os.O_TRUNC != 0
+        with self._lock:
+            staged = self._idle(path)
+            if staged is None and not write:
+                return None
+            if staged is not None and write:
+                staged.writers += 1
+        if staged is None:
+            staged = self._stage(path, None if truncate else node, local_file, node is not None)
+        try:
+            f = open(str(staged.file), 'r+b' if write else 'rb', buffering=0)
+        except OSError:
+            if write:
+                self._release(staged)
+            raise
+        if truncate:
+            if staged.size > 0:
+                f.truncate(0)
+            with self._lock:
+                staged.size = 0
+                self._changed(staged)
+        self.handles[f.fileno()] = (staged, f, write)
+        return f.fileno()
+
+    def create(self, path):
+        with self._lock:
+            staged = self._idle(path)
+            if staged is not None:
+                staged.writers += 1
+        if staged is None:
+            staged = self._stage(path, None, None, False)
+        with self._lock:
+            self._changed(staged)  # (an empty file is uploaded as well)
+        f = open(str(staged.file), 'r+b', buffering=0)
+        self.handles[f.fileno()] = (staged, f, True)
+        return f.fileno()
+
+    def _stage(self, path, node: File, local_file: Path, remote):
+        """ makes the local copy of `path` (of `node` if given) and opens it for writing """
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        file = self.base_path / uuid.uuid4().hex
+        try:
+            if node is None:
+                file.touch()
+            elif local_file is not None:
+                shutil.copyfile(str(local_file), str(file))
+            else:
+                self._download(path, node, file)
+        except BaseException:
+            self._discard(file)
+            raise
+        staged = Staged(path, file, file.stat().st_size, None if node is None else node.modified, remote)
+        staged.writers = 1
+        with self._lock:
+            current = self._idle(path)
+            if current is not None:  # made by another thread in the meantime
+                current.writers += 1
+                self._discard(file)
+                return current
+            self._add(staged)
+        return staged
+
+    def _download(self, path, node: File, file: Path):
+        rel_path = path[1:]
+        fh = self.file_cache.open(path, rel_path, node, self.db_base_path + rel_path, os.O_RDONLY)
+        try:
+            with open(str(file), 'wb') as f:
+                for offset in range(0, node.size, self.chunk_size):
+                    f.write(self.file_cache.read(path, self.chunk_size, offset, fh))
+        finally:
+            self.file_cache.close(fh)
+
+    def read(self, fh, size, offset):
+        return read_at(self.handles[fh][1], size, offset, self._lock)
+
+    def write(self, fh, data, offset):
+        staged, f, _ = self.handles[fh]
+        write_at(f, data, offset, self._lock)
+        with self._lock:
+            staged.size = max(staged.size, offset + len(data))
+            self._changed(staged)
+        return len(data)
+
+    def truncate(self, path, length, fh=None, node: File = None, local_file: Path = None):
+        handle = self.handles.get(fh)
+        if handle is None or not handle[2]:
+            fh = self.open(path, os.O_WRONLY | (os.O_TRUNC if length == 0 else 0), node, local_file)
+            try:
+                return self.truncate(path, length, fh)
+            finally:
+                self.release(fh)
+        staged, f, _ = handle
+        f.truncate(length)
+        with self._lock:
+            staged.size = length
+            self._changed(staged)
+
+    def utimens(self, path, mtime):
+        with self._lock:
+            staged = self._staged.get(path.lower())
+            if staged is not None:
+                staged.modified = mtime
+
+    def flush(self, fh):
+        staged, _, write = self.handles[fh]
+        if write and self.sync_mode == 'close':
+            self._wait(staged)
+
+    def fsync(self, fh, datasync):
+        staged, f, write = self.handles[fh]
+        if not write:
+            return
+        if datasync and hasattr(os, 'fdatasync'):
+            os.fdatasync(f.fileno())
+        else:
+            os.fsync(f.fileno())
+        self.save()
+        if self.sync_mode != 'none':
+            self._wait(staged)
+
+    def release(self, fh):
+        staged, f, write = self.handles.pop(fh)
+        f.close()
+        if write:
+            self._release(staged)
+
+    def _release(self, staged):
+        with self._lock:
+            staged.writers -= 1
+            if staged.writers > 0 or staged.dirty or staged.uploading or staged.busy:
+                return
+            staged.busy = True  # unchanged or uploaded: the tree has it, the file cache can take over
+        self._commit(staged, staged.node)
+
+    def unlink(self, path, remote):
+        """ deletes `path`, in dropbox as well if it is there (`remote`) """
+        with self._lock:
+            staged = self._idle(path, uploads=True)
+            if staged is not None:
+                staged.busy = True
+                remote = remote or staged.remote
+        try:
+            if remote:
+                self._delete(path)
+        finally:
+            with self._lock:
+                if staged is not None:
+                    staged.busy = False
+                    self._lock.notify_all()
+        with self._lock:
+            if staged is not None:
+                self._remove(staged)
+        if staged is not None:
+            self._discard(staged.file)  # (open handles keep working where the OS allows it)
+
+    def mkdir(self, path):
+        metadata = self._api(self.dbx.files_create_folder_v2, self._db_path(path)).metadata
+        self.crawler.apply_local([(metadata.path_display, node_from_metadata(metadata))])
+
+    def rmdir(self, path):
+        with self._lock:
+            if len(self._folders.get(path.lower(), ())) > 0:
+                raise FuseOSError(errno.ENOTEMPTY)
+        self._delete(path)
+
+    def rename(self, old, new, old_remote, new_remote):
+        """ renames a file or folder: the local copies at or below `old` are renamed (and uploaded to their new path
+        later), what exists in dropbox (`old_remote`) is moved there right away. An existing file at `new` is
+        replaced. """
+        old_key, new_key = old.lower(), new.lower()
+        same = old_key == new_key  # (only the case changes)
+        with self._lock:
+            while True:
+                moved = [s for k, s in self._staged.items() if k == old_key or k.startswith(old_key + '/')]
+                replaced = None if same else self._staged.get(new_key)
+                if not any(s.uploading or s.busy for s in moved + [replaced] if s is not None):
+                    break
+                self._lock.wait()
+            for s in moved + [replaced]:
+                if s is not None:
+                    s.busy = True
+        try:
+            if old_remote:
+                if new_remote and not same:
+                    self._delete(new)
+                metadata = self._api(self.dbx.files_move_v2, self._db_path(old), self._db_path(new)).metadata
+                changes = [(self._db_path(old), None), (metadata.path_display, node_from_metadata(metadata))]
+                if isinstance(metadata, FolderMetadata):
+                    changes += self._listing(metadata.path_display)
+                self.crawler.apply_local(changes)
+        finally:
+            with self._lock:
+                for s in moved + [replaced]:
+                    if s is not None:
+                        s.busy = False
+                self._lock.notify_all()
+        with self._lock:
+            if replaced is not None:
+                self._remove(replaced)
+            for s in moved:
+                self._remove(s)
+                s.path = new + s.path[len(old):]
+                self._add(s)
+                if not old_remote and not s.dirty:  # (dropbox doesn't have it at the new path)
+                    self._changed(s)
+        if replaced is not None:
+            self._discard(replaced.file)
+
+    def _listing(self, db_path):
+        """ the changes that add everything below a folder of dropbox to the tree """
+        result = self._api(self.dbx.files_list_folder, db_path, recursive=True)
+        changes = [(e.path_display, node_from_metadata(e)) for e in result.entries]
+        while result.has_more:
+            result = self._api(self.dbx.files_list_folder_continue, result.cursor)
+            changes += [(e.path_display, node_from_metadata(e)) for e in result.entries]
+        return changes
+
+    def _delete(self, path):
+        try:
+            self._retry(self.dbx.files_delete_v2, self._db_path(path))
+        except Exception as e:
+            if error_number(e) != errno.ENOENT:
+                log.error('deleting {} failed ({})'.format(path, str(e)))
+                raise FuseOSError(error_number(e))
+        self.crawler.apply_local([(self._db_path(path), None)])
+
+    def _api(self, fn, *args, **kwargs):
+        """ calls the API for a FUSE operation, failures become FuseOSErrors """
+        try:
+            return self._retry(fn, *args, **kwargs)
+        except Exception as e:
+            log.error('{} failed ({})'.format(fn.__name__, str(e)))
+            raise FuseOSError(error_number(e))
+
+    def _retry(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except transient_errors as e:
+                if attempt >= self.retries:
+                    raise
+                delay = getattr(e, 'backoff', None) or min(self.backoff * 2 ** attempt, self.max_backoff)
+                log.warning('{} failed ({}), retrying in {}s'.format(fn.__name__, str(e), delay))
+                time.sleep(delay)
+                attempt += 1
+
+    def _db_path(self, path):
+        return self.db_base_path + path[1:]
+
+    def _add(self, staged):
+        key = staged.path.lower()
+        self._staged[key] = staged
+        folder, _, name = key.rpartition('/')
+        self._folders.setdefault(folder or '/', {})[name] = staged
+        self._changed_index = True
+
+    def _remove(self, staged):
+        key = staged.path.lower()
+        if self._staged.get(key) is not staged:
+            return
+        del self._staged[key]
+        folder, _, name = key.rpartition('/')
+        names = self._folders[folder or '/']
+        del names[name]
+        if len(names) == 0:
+            del self._folders[folder or '/']
+        self._changed_index = True
+
+    def _idle(self, path, uploads=False):
+        """ the local copy of `path` (None if there is none) once nothing moves or deletes it (and uploads it) """
+        key = path.lower()
+        staged = self._staged.get(key)
+        while staged is not None and (staged.busy or (uploads and staged.uploading)):
+            self._lock.wait()
+            staged = self._staged.get(key)
+        return staged
+
+    def _changed(self, staged):
+        now = time.time()
+        staged.due = now + self.delay
+        if not staged.dirty:
+            staged.since = now
+            self._changed_index = True
+            if staged.due < self._wakeup:
+                self._lock.notify_all()
+        staged.generation += 1
+        staged.modified = now
+        staged.error = None
+
+    def _wait(self, staged):
+        """ waits until the current content of `staged` is uploaded """
+        with self._lock:
+            generation = staged.generation
+            if staged.uploaded >= generation:
+                return
+            staged.due = staged.retry = 0
+            self._lock.notify_all()
+            while staged.uploaded < generation and staged.error is None and staged.retry == 0 \
+                    and self._staged.get(staged.path.lower()) is staged:
+                self._lock.wait()
+            if staged.uploaded < generation and (staged.error is not None or staged.retry > 0):
+                raise FuseOSError(errno.EIO)
+
+    def _run(self):
+        """ uploads the files that are due (the uploader thread) """
+        while True:
+            with self._lock:
+                batch, timeout = self._due()
+                while len(batch) == 0:
+                    self._wakeup = float('inf') if timeout is None else time.time() + timeout
+                    self._lock.wait(timeout)
+                    self._wakeup = 0
+                    batch, timeout = self._due()
+                generations = []
+                for staged in batch:
+                    staged.uploading = True
+                    generations.append(staged.generation)
+            try:
+                if time.time() - self._last_save > self.save_interval:
+                    self.save()
+                self._upload(batch, generations)
+            except Exception as e:
+                log.exception('uploading failed ({})'.format(str(e)))
+                for staged in batch:
+                    self._failed(staged, e)
+            finally:
+                with self._lock:
+                    for staged in batch:
+                        staged.uploading = False
+                    self._lock.notify_all()
+
+    def _due(self):
+        """ (the files to upload now (smallest first), seconds until the next one is due (None: none)); the files
+        that are due beyond `batch_size` are queued for the next batches, so a backlog isn't scanned for each one """
+        now = time.time()
+        batch = self._dequeue(now)
+        if len(batch) > 0:
+            return batch, None
+        due, next_due = [], None
+        for staged in self._staged.values():
+            if not staged.dirty or staged.uploading or staged.busy or staged.error is not None:
+                continue
+            t = self._due_at(staged)
+            if t <= now:
+                due.append(staged)
+            elif next_due is None or t - now < next_due:
+                next_due = t - now
+        due.sort(key=lambda s: s.size, reverse=True)
+        self._queue = due
+        return self._dequeue(now), next_due
+
+    def _dequeue(self, now):
+        batch = []
+        while len(self._queue) > 0 and len(batch) < self.batch_size:
+            staged = self._queue.pop()
+            if staged.dirty and not staged.uploading and not staged.busy and staged.error is None \
+                    and self._due_at(staged) <= now and self._staged.get(staged.path.lower()) is staged:
+                batch.append(staged)
+        return batch
+
+    def _due_at(self, staged):
+        return max(min(staged.due, staged.since + self.max_delay), staged.retry)
+
+    def _upload(self, batch, generations):
+        uploaded = []  # (staged, generation, metadata)
+        if len(batch) == 1 and batch[0].size <= self.chunk_size:
+            staged = batch[0]
+            with open(str(staged.file), 'rb') as f:
+                data = f.read()
+            try:
+                metadata = self._retry(self.dbx.files_upload, data, self._db_path(staged.path),
+                                       mode=WriteMode.overwrite, client_modified=self._client_modified(staged))
+                uploaded.append((staged, generations[0], metadata))
+                self.batches += 1
+            except Exception as e:
+                self._failed(staged, e)
+        else:
+            futures = [self._pool.submit(self._transfer, staged) for staged in batch]
+            sent = []
+            for staged, generation, future in zip(batch, generations, futures):
+                try:
+                    sent.append((staged, generation, future.result()))
+                except Exception as e:
+                    self._failed(staged, e)
+            if len(sent) == 0:
+                return
+            entries = [UploadSessionFinishArg(cursor, CommitInfo(self._db_path(staged.path), mode=WriteMode.overwrite,
+                                                                 client_modified=self._client_modified(staged)))
+                       for staged, _, cursor in sent]
+            try:
+                result = self._retry(self.dbx.files_upload_session_finish_batch_v2, entries)
+            except Exception as e:
+                for staged, _, _ in sent:
+                    self._failed(staged, e)
+                return
+            self.batches += 1
+            for (staged, generation, _), entry in zip(sent, result.entries):
+                if entry.is_success():
+                    uploaded.append((staged, generation, entry.get_success()))
+                else:
+                    self._failed(staged, ApiError(None, entry.get_failure(), None, None))
+        if len(uploaded) > 0:
+            self._uploaded(uploaded)
+
+    def _transfer(self, staged):
+        """ sends the content of a file to a new upload session, returns the cursor for committing it """
+        with open(str(staged.file), 'rb') as f:
+            data = f.read(self.chunk_size)
+            session_id = self._retry(self.dbx.files_upload_session_start, data,
+                                     close=len(data) < self.chunk_size).session_id
+            offset = len(data)
+            while len(data) == self.chunk_size:
+                data = f.read(self.chunk_size)
+                self._retry(self.dbx.files_upload_session_append_v2, data, UploadSessionCursor(session_id, offset),
+                            close=len(data) < self.chunk_size)
+                offset += len(data)
+        with self._lock:
+            self.sessions += 1
+        return UploadSessionCursor(session_id, offset)
+
+    @staticmethod
+    def _client_modified(staged):
+        return datetime.fromtimestamp(int(staged.modified), timezone.utc).replace(tzinfo=None)
+
+    def _uploaded(self, uploaded):
+        """ puts the uploaded files into the tree, moves the local copies that didn't change since into the file
+        cache """
+        nodes = [node_from_metadata(metadata) for _, _, metadata in uploaded]
+        self.crawler.apply_local([(metadata.path_display, node) for (_, _, metadata), node in zip(uploaded, nodes)])
+        done = []
+        with self._lock:
+            for (staged, generation, _), node in zip(uploaded, nodes):
+                if generation > staged.uploaded:
+                    staged.uploaded, staged.node = generation, node
+                staged.remote = True
+                staged.uploading = False
+                self.uploaded_files += 1
+                self.uploaded_bytes += node.size
+                if not staged.dirty and staged.writers == 0 and not staged.busy:
+                    staged.busy = True
+                    done.append((staged, node))
+            self._lock.notify_all()
+        for staged, node in done:
+            self._commit(staged, node)
+        log.debug('uploaded {} files'.format(len(uploaded)))
+
+    def _commit(self, staged, node: File):
+        """ hands a local copy that is uploaded (or unchanged) over to the tree and the file cache """
+        if node is not None:
+            self.file_cache.add_local(staged.path[1:], node, staged.file)
+        with self._lock:
+            staged.busy = False
+            self._remove(staged)
+            self._lock.notify_all()
+        self._discard(staged.file)
+
+    def _failed(self, staged, e):
+        with self._lock:
+            self.failures += 1
+            if isinstance(e, transient_errors):
+                staged.retry = time.time() + self.max_backoff
+            else:
+                staged.error = str(e)
+            self._lock.notify_all()
+        log.error('uploading {} failed ({})'.format(staged.path, str(e)))
+
+    @staticmethod
+    def _discard(file: Path):
+        try:
+            file.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning('deleting {} failed ({})'.format(file, str(e)))
+
+    def pending(self):
+        """ number of files with changes that aren't uploaded """
+        with self._lock:
+            return sum(1 for s in self._staged.values() if s.dirty)
+
+    def stats(self):
+        with self._lock:
+            staged = list(self._staged.values())
+        pending = [s for s in staged if s.dirty]
+        return dict(local_copies=len(staged), pending=len(pending), pending_bytes=sum(s.size for s in pending),
+                    uploading=sum(1 for s in staged if s.uploading),
+                    failed=sum(1 for s in staged if s.error is not None), uploaded_files=self.uploaded_files,
+                    uploaded_bytes=self.uploaded_bytes, batches=self.batches, sessions=self.sessions,
+                    failures=self.failures)
+
+    def save(self):
+        """ saves the paths of the local copies that aren't uploaded yet """
+        with self._lock:
+            self._last_save = time.time()
+            if not self._changed_index:
+                return
+            entries = [(s.path, s.file.name, s.modified, s.remote) for s in self._staged.values() if s.dirty]
+            self._changed_index = False
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        index_file = self.base_path / 'index.pkl'
+        tmp_file = str(index_file) + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'staged': entries}, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, str(index_file))
+
+    def _load(self):
+        """ picks up the local copies that weren't uploaded before exiting, deletes the others """
+        try:
+            with open(str(self.base_path / 'index.pkl'), 'rb') as f:
+                entries = pickle.load(f)['staged']
+        except FileNotFoundError:
+            return
+        except (pickle.PickleError, EOFError, KeyError) as e:
+            log.error('ignoring the corrupt index of the write cache ({})'.format(str(e)))
+            return
+        known = {'index.pkl'}
+        with self._lock:
+            for path, name, modified, remote in entries:
+                file = self.base_path / name
+                if not file.exists():
+                    continue
+                staged = Staged(path, file, file.stat().st_size, modified, remote)
+                staged.generation = 1
+                self._add(staged)
+                known.add(name)
+        for file in self.base_path.iterdir():
+            if file.name not in known:
+                self._discard(file)
+        if len(known) > 1:
+            log.info('{} files to upload from the last run'.format(len(known) - 1))
@@ -0,0 +1,21 @@
+import time
+import pytest
+from dropbox_fs.crawler import File
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    """ runs every test in its own directory (the crawler and the control server keep their files in the working
+    directory) """
+    monkeypatch.chdir(tmp_path)
+
+
+def new_file(name, size=1, rev='0123456789abcdef'):
+    return File(name, size, 1600000000 + size, rev, bytes(range(32)))
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
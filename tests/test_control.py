@@ -0,0 +1,27 @@
+import os
+import socket
+import pytest
+from dropbox_fs import control
+from dropbox_fs.control import ControlServer
+
+
+@pytest.fixture(autouse=True)
+def control_address(tmp_path, monkeypatch):
+    monkeypatch.setattr(control, 'address', str(tmp_path / control.address))  # (listeners remove it at exit)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='unix sockets')
+def test_a_running_instance_is_not_replaced():
+    ControlServer({'echo': lambda x: x}).start()
+    assert control.call('echo', 1) == 1
+    ControlServer({'echo': lambda x: -x}).start()  # (another mount in the same directory)
+    assert control.call('echo', 2) == 2
+    assert control.call('echo', 3) == 3  # (the first one still accepts connections)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='unix sockets')
+def test_a_stale_socket_is_removed():
+    with socket.socket(socket.AF_UNIX) as s:
+        s.bind(control.address)  # (left over by an instance that crashed)
+    ControlServer({'echo': lambda x: x}).start()
+    assert control.call('echo', 1) == 1
@@ -0,0 +1,53 @@
+from dropbox_fs.cache import ExtentMap
+
+
+def test_add_merges_overlapping_and_touching():
+    extents = ExtentMap([(10, 20), (30, 40)])
+    assert list(extents) == [(10, 20), (30, 40)]
+    extents.add(20, 25)  # touches the first one
+    assert list(extents) == [(10, 25), (30, 40)]
+    extents.add(24, 31)  # bridges the gap
+    assert list(extents) == [(10, 40)]
+    extents.add(0, 5)
+    extents.add(50, 60)
+    assert list(extents) == [(0, 5), (10, 40), (50, 60)]
+    extents.add(3, 55)  # covers several
+    assert list(extents) == [(0, 60)]
+
+
+def test_add_inside_and_empty():
+    extents = ExtentMap([(0, 100)])
+    extents.add(10, 20)
+    extents.add(50, 50)
+    assert list(extents) == [(0, 100)]
+    extents = ExtentMap()
+    extents.add(5, 5)
+    extents.add(7, 3)
+    assert len(extents) == 0
+
+
+def test_add_in_any_order():
+    chunks = [(i * 10, i * 10 + 10) for i in range(10)]
+    extents = ExtentMap(chunks[::2] + chunks[1::2][::-1])
+    assert list(extents) == [(0, 100)]
+
+
+def test_missing():
+    extents = ExtentMap([(10, 20), (30, 40)])
+    assert extents.missing(0, 50) == [(0, 10), (20, 30), (40, 50)]
+    assert extents.missing(10, 20) == []
+    assert extents.missing(15, 35) == [(20, 30)]
+    assert extents.missing(20, 30) == [(20, 30)]
+    assert extents.missing(35, 45) == [(40, 45)]
+    assert ExtentMap().missing(0, 10) == [(0, 10)]
+
+
+def test_contains_and_filled():
+    extents = ExtentMap([(10, 20), (30, 40)])
+    assert extents.contains(10, 20)
+    assert extents.contains(12, 18)
+    assert not extents.contains(15, 25)
+    assert not extents.contains(5, 15)
+    assert not extents.contains(20, 30)
+    assert extents.contains(25, 25)  # (empty)
+    assert extents.filled() == 20
@@ -0,0 +1,194 @@
+import errno
+import os
+import pytest
+from fuse import FuseOSError
+from requests.exceptions import ConnectionError
+from dropbox_fs.cache import FileCache, FileDownloader
+from dropbox_fs.cache_index import CacheIndex, object_key
+from dropbox_fs.crawler import File
+from benchmarks.fake_dropbox import FakeDropbox, FakeSession, content_hash
+from tests.conftest import wait_for
+
+chunk_size = 2 ** 16
+chunks = 8
+
+
+class FlakySession(FakeSession):
+    """ fails every request after the first `working` ones, until `working` is None """
+
+    def __init__(self, dbx, working=None):
+        super().__init__(dbx)
+        self.working = working
+
+    def get(self, link, headers=None, stream=True, timeout=None):
+        if self.working is not None:
+            if self.working <= 0:
+                raise ConnectionError('network is down')
+            self.working -= 1
+        return super().get(link, headers, stream, timeout)
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(FileDownloader, 'chunk_size', chunk_size)
+    monkeypatch.setattr(FileDownloader, 'retries', 1)
+    monkeypatch.setattr(FileDownloader, 'backoff', 0.01)
+
+
+@pytest.fixture
+def account(tmp_path):
+    """ (file cache, session, path, db_file, content) for a file of `chunks` chunks """
+    content = os.urandom(chunks * chunk_size)
+    dbx = FakeDropbox()
+    dbx.add_file('/file.bin', content, '000000001')
+    db_file = File('file.bin', len(content), 0, '000000001', content_hash(content, chunk_size))
+    session = FlakySession(dbx)
+    file_cache = FileCache(tmp_path, dbx, download_workers=1)
+    file_cache.scheduler.session = session
+    return file_cache, session, '/file.bin', db_file, content
+
+
+def cached(file_cache, path, db_file):
+    entry = file_cache.index.get(object_key(path[1:], db_file))
+    return entry is not None and entry.complete
+
+
+def test_complete_download(account):
+    file_cache, session, path, db_file, content = account
+    fh = file_cache.open(path, path[1:], db_file, path, os.O_RDONLY)
+    assert file_cache.read(path, 100, chunk_size * 3 - 50, fh) == content[chunk_size * 3 - 50:chunk_size * 3 + 50]
+    wait_for(lambda: cached(file_cache, path, db_file))
+    assert file_cache.read(path, len(content), 0, fh) == content
+    file_cache.close(fh)
+
+
+def test_interrupted_sync_is_resumed(account):
+    file_cache, session, path, db_file, content = account
+    session.working = 3
+    file_cache.sync([(path[1:], db_file, path)])
+    wait_for(lambda: file_cache.sync_pending() == 0)  # (gave up, doesn't hold on to its slot)
+    assert file_cache.interruptions == 1
+    assert len(file_cache.downloading) == 0
+    assert list(file_cache.sync_failed.values()) == [path]
+    entry = file_cache.index.get(object_key(path[1:], db_file))
+    assert not entry.complete and sum(end - start for start, end in entry.extents) == 3 * chunk_size
+
+    session.working = None
+    requests = session.requests
+    file_cache.sync([(path[1:], db_file, path)])
+    wait_for(lambda: file_cache.sync_pending() == 0)
+    assert cached(file_cache, path, db_file) and len(file_cache.sync_failed) == 0
+    assert session.requests - requests == chunks - 3  # (resumed)
+    with open(str(file_cache.base_path / object_key(path[1:], db_file)), 'rb') as f:
+        assert f.read() == content
+
+
+def test_sync_ends_on_unexpected_errors(account, monkeypatch):
+    file_cache, session, path, db_file, content = account
+
+    def broken_link(self):
+        raise KeyError('link')
+    monkeypatch.setattr(FileDownloader, '_temporary_link', broken_link)
+    file_cache.sync([(path[1:], db_file, path)])
+    wait_for(lambda: file_cache.sync_pending() == 0)
+    assert list(file_cache.sync_failed.values()) == [path]
+    assert not cached(file_cache, path, db_file)
+
+
+def test_reads_of_an_interrupted_download(account):
+    file_cache, session, path, db_file, content = account
+    session.working = 2
+    fh = file_cache.open(path, path[1:], db_file, path, os.O_RDONLY)
+    wait_for(lambda: file_cache.interruptions == 1)
+    assert file_cache.read(path, 10, 0, fh) == content[:10]
+    with pytest.raises(FuseOSError) as e:  # not the zeros of the sparse file
+        file_cache.read(path, 10, 5 * chunk_size, fh)
+    assert e.value.errno == errno.EIO
+
+    session.working = None
+    assert file_cache.read(path, 10, 5 * chunk_size, fh) == content[5 * chunk_size:5 * chunk_size + 10]
+    file_cache.close(fh)
+    assert len(file_cache.downloading) == 0
+
+    fh = file_cache.open(path, path[1:], db_file, path, os.O_RDONLY)  # resumes the rest
+    wait_for(lambda: cached(file_cache, path, db_file))
+    assert file_cache.read(path, len(content), 0, fh) == content
+    file_cache.close(fh)
+
+
+def test_checkpoint_syncs_outside_the_lock(account, monkeypatch):
+    file_cache, session, path, db_file, content = account
+    session.working = 1  # (stays open with the first chunk)
+    fh = file_cache.open(path, path[1:], db_file, path, os.O_RDONLY)
+    wait_for(lambda: file_cache.interruptions == 1)
+    downloader = file_cache.downloading[object_key(path[1:], db_file)]
+    locked = []
+
+    def fsync(fd):
+        locked.append(not downloader._lock.acquire(timeout=1))
+        if not locked[-1]:
+            downloader._lock.release()
+    monkeypatch.setattr(os, 'fsync', fsync)
+    extents, block_hashes = downloader.checkpoint()
+    assert locked == [False] and extents[0] == (0, chunk_size)
+    file_cache.close(fh)
+
+
+def test_reads_of_a_download_with_a_wrong_hash(account):
+    file_cache, session, path, db_file, content = account
+    db_file = File(db_file.name, db_file.size, 0, db_file.rev, b'\0' * 32)
+    fh = file_cache.open(path, path[1:], db_file, path, os.O_RDONLY)
+    wait_for(lambda: len(file_cache.downloading) == 0)
+    with pytest.raises(FuseOSError) as e:  # (not the bytes that didn't match)
+        file_cache.read(path, 10, 0, fh)
+    assert e.value.errno == errno.EIO
+    file_cache.close(fh)
+    assert not cached(file_cache, path, db_file)
+
+
+def test_interrupted_download_is_synced_before_its_progress_is_saved(account, monkeypatch):
+    file_cache, session, path, db_file, content = account
+    key = object_key(path[1:], db_file)
+    synced = []
+
+    def fsync(fd):
+        downloader = file_cache.downloading.get(key)
+        synced.append((downloader and downloader.state, file_cache._lock.locked(), file_cache.index.get(key).extents))
+    monkeypatch.setattr(os, 'fsync', fsync)
+    monkeypatch.setattr(file_cache, 'save', lambda: None)  # (no periodic checkpoints)
+    session.working = 2
+    file_cache.sync([(path[1:], db_file, path)])
+    wait_for(lambda: file_cache.sync_pending() == 0)
+    assert synced == [(FileDownloader.State.interrupted, False, None)]  # (outside the lock, before recording)
+    assert sum(end - start for start, end in file_cache.index.get(key).extents) == 2 * chunk_size
+
+
+def test_index_is_reconciled_with_the_cache_directory(tmp_path):
+    kept, lost, unindexed = (File(name, 10, 0, 'rev', bytes([i]) * 32) for i, name in enumerate(('a', 'b', 'c'), 1))
+    index = CacheIndex(tmp_path)
+    for file in kept, lost, unindexed:
+        key = object_key(file.name, file)
+        (tmp_path / key).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / key).write_bytes(b'x' * file.size)
+        if file is not unindexed:
+            index.add(key, file, complete=True)
+            index.set_path(file.name, key)
+    index.save()
+    (tmp_path / object_key(lost.name, lost)).unlink()  # (as if the process crashed before saving the index)
+
+    index = CacheIndex(tmp_path)
+    assert index.load() and index.dirty
+    assert set(index.entries) == {object_key(kept.name, kept), object_key(unindexed.name, unindexed)}
+    assert index.total_size == 20 and index.paths == {'a': object_key(kept.name, kept)}
+    assert not index.get(object_key(unindexed.name, unindexed)).complete
+
+
+def test_pinned_paths_keep_their_spelling(tmp_path):
+    index = CacheIndex(tmp_path)
+    index.pin('Photos/2020')
+    index.pin('Docs')
+    index.save()
+    index = CacheIndex(tmp_path)
+    assert index.load()
+    assert index.is_pinned('photos/2020/a.jpg') and sorted(index.pinned.values()) == ['Docs', 'Photos/2020']
+    assert index.unpin('photos') == ['Photos/2020'] and list(index.pinned.values()) == ['Docs']
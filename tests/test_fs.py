@@ -0,0 +1,51 @@
+import os
+from dropbox.files import ListFolderResult
+from dropbox_fs.cache import FileCache
+from dropbox_fs.fs import DropboxFs
+from benchmarks.fake_dropbox import FakeDropbox, FakeCrawler
+
+
+def mounted(dbx, tmp_path):
+    """ a `DropboxFs` of the files added to `dbx` """
+    crawler = FakeCrawler(dbx)
+    crawler.init('token', '')
+    crawler._finished_crawling = True
+    crawler.update_tree(ListFolderResult(entries=list(dbx.entries.values()), cursor='cursor', has_more=False))
+    file_cache = FileCache(tmp_path / 'cache', dbx)
+    file_cache.scheduler.session = dbx.session
+    return DropboxFs(crawler, file_cache)
+
+
+def opened(fs, path):
+    fs('release', path, fs('open', path, os.O_RDONLY))
+
+
+def test_folder_prefetch_of_several_folders(tmp_path):
+    dbx = FakeDropbox()
+    for folder in ['A', 'B']:
+        for i in range(4):
+            dbx.add_file('/{}/{}.jpg'.format(folder, i), os.urandom(100))
+    fs = mounted(dbx, tmp_path)
+    fs.folder_prefetch = True
+    fs('readdir', '/A', 0)
+    fs('readdir', '/B', 0)  # (another program)
+    opened(fs, '/A/0.jpg')
+    opened(fs, '/B/0.jpg')
+    opened(fs, '/A/1.jpg')
+    assert fs.file_cache.prefetched_files == 2  # A/2.jpg and A/3.jpg
+    opened(fs, '/B/3.jpg')
+    assert fs.file_cache.prefetched_files == 4
+
+
+def test_folder_prefetch_needs_a_listing(tmp_path):
+    dbx = FakeDropbox()
+    for i in range(4):
+        dbx.add_file('/A/{}.jpg'.format(i), os.urandom(100))
+    fs = mounted(dbx, tmp_path)
+    fs.folder_prefetch = True
+    fs.folder_prefetch_folders = 1
+    fs('readdir', '/A', 0)
+    fs('readdir', '/', 0)  # (only the last one is tracked)
+    opened(fs, '/A/0.jpg')
+    opened(fs, '/A/1.jpg')
+    assert fs.file_cache.prefetched_files == 0
@@ -0,0 +1,129 @@
+import os
+import pickle
+from dropbox_fs.crawler import DropboxCrawler, Folder, data_file, journal_file
+from dropbox_fs.journal import Journal
+from tests.conftest import new_file
+
+
+def test_replay_in_order():
+    journal = Journal(journal_file)
+    journal.append([('/a', new_file('a'))], {'update_cursor': 1})
+    assert journal.seal()
+    journal.append([('/b', new_file('b'))], {'update_cursor': 2})
+    assert not journal.seal()  # (the sealed one isn't compacted yet)
+    assert [state['update_cursor'] for _, state in journal.replay()] == [1, 2]
+
+
+def test_torn_tail_is_truncated():
+    journal = Journal(journal_file)
+    for i in range(3):
+        journal.append([('/f{}'.format(i), new_file('f{}'.format(i)))], {'update_cursor': i})
+    journal.close()
+    valid_size = os.path.getsize(journal_file)
+    with open(journal_file, 'ab') as f:  # a record that was only partly written
+        f.write(pickle.dumps(([('/torn', new_file('torn'))], {}), pickle.HIGHEST_PROTOCOL)[:-5])
+
+    assert [state['update_cursor'] for _, state in Journal.records(journal_file)] == [0, 1, 2]
+    assert os.path.getsize(journal_file) > valid_size  # (only `truncate` cuts it off)
+    assert len(list(Journal.records(journal_file, truncate=True))) == 3
+    assert os.path.getsize(journal_file) == valid_size
+
+    journal = Journal(journal_file)
+    journal.append([], {'update_cursor': 3})
+    assert [state['update_cursor'] for _, state in journal.replay()] == [0, 1, 2, 3]
+
+
+def test_garbage_after_valid_records():
+    journal = Journal(journal_file)
+    journal.append([], {'update_cursor': 0})
+    journal.close()
+    with open(journal_file, 'ab') as f:
+        f.write(b'\x00garbage')
+    assert len(list(Journal.records(journal_file, truncate=True))) == 1
+    assert len(list(Journal.records(journal_file))) == 1
+
+
+def journal_crawler():
+    crawler = DropboxCrawler()
+    crawler.storage = 'journal'
+    crawler._db_token = 'token'
+    crawler._db_base_path = ''
+    crawler._local_folder = None
+    crawler._crawl_cursor = None
+    crawler._partitions = None
+    crawler._update_cursor = 'cursor'
+    crawler._finished_crawling = True
+    crawler.connect()
+    crawler.root = Folder('')
+    crawler._save_full_snapshot()
+    return crawler
+
+
+def compacted(crawler):
+    if crawler._compacting is not None:
+        crawler._compacting.join(10)
+    return not os.path.exists(journal_file + '.sealed')
+
+
+def saved_names():
+    with open(data_file, 'rb') as f:
+        return sorted(item.name for item in pickle.load(f)['root'])
+
+
+def test_sealed_journal_is_compacted_after_load():
+    crawler = journal_crawler()
+    crawler.apply_local([('/a', new_file('a'))])
+    crawler.save_snapshot()
+    assert crawler._journal.seal()  # as if the process stopped before compacting it
+
+    crawler = DropboxCrawler()
+    assert crawler.load_snapshot()
+    assert compacted(crawler)
+    assert saved_names() == ['a']
+    assert crawler.root.get_file('a') is not None
+
+
+def failing_write(monkeypatch):
+    """ makes writing `data_file` fail until the returned list is cleared """
+    failing = [True]
+    write = DropboxCrawler._write
+
+    def fail(data):
+        if failing:
+            raise OSError('disk full')
+        write(data)
+    monkeypatch.setattr(DropboxCrawler, '_write', staticmethod(fail))
+    return failing
+
+
+def test_failed_compaction_is_retried(monkeypatch):
+    crawler = journal_crawler()
+    crawler.journal_compact_size = 0
+    crawler.compact_retry_interval = 0
+    failing = failing_write(monkeypatch)
+    crawler.apply_local([('/a', new_file('a'))])
+    crawler.save_snapshot()
+    assert not compacted(crawler)
+
+    failing.clear()
+    crawler.apply_local([('/b', new_file('b'))])
+    crawler.save_snapshot()  # (the sealed journal is still there, so this one is appended to the new journal)
+    assert compacted(crawler)
+    assert saved_names() == ['a']
+
+    crawler.apply_local([('/c', new_file('c'))])
+    crawler.save_snapshot()
+    assert compacted(crawler)
+    assert saved_names() == ['a', 'b', 'c']
+
+
+def test_failed_compaction_waits_before_retrying(monkeypatch):
+    crawler = journal_crawler()
+    crawler.journal_compact_size = 0
+    failing_write(monkeypatch)
+    crawler.apply_local([('/a', new_file('a'))])
+    crawler.save_snapshot()
+    assert not compacted(crawler)
+    crawler.apply_local([('/b', new_file('b'))])
+    crawler.save_snapshot()
+    assert crawler._compacting is None  # (not before `compact_retry_interval`)
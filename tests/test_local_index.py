@@ -0,0 +1,74 @@
+import os
+import stat
+import pytest
+from dropbox_fs.local_index import LocalIndex
+from tests.conftest import wait_for
+
+
+def write(path, content=b''):
+    with open(str(path), 'wb') as f:
+        f.write(content)
+
+
+@pytest.fixture
+def local_folder(tmp_path):
+    (tmp_path / 'A' / 'B').mkdir(parents=True)
+    write(tmp_path / 'top.txt', b'12345')
+    write(tmp_path / 'A' / 'a.txt')
+    write(tmp_path / 'A' / 'B' / 'b.txt')
+    return tmp_path
+
+
+@pytest.fixture
+def index(local_folder):
+    index = LocalIndex(local_folder)
+    index.start()
+    wait_for(lambda: index.ready)
+    return index
+
+
+def test_scan(index):
+    assert len(index) == 6
+    assert stat.S_ISDIR(index.get('/')['st_mode'])
+    assert stat.S_ISDIR(index.get('/A/B')['st_mode'])
+    attr = index.get('/top.txt')
+    assert stat.S_ISREG(attr['st_mode']) and attr['st_size'] == 5
+    assert '/A/B/b.txt' in index
+    assert '/A/missing' not in index and '/missing/b.txt' not in index
+    assert index.get('/a/b/b.txt') is None  # (case-sensitive like the local file system)
+
+
+def test_without_local_folder():
+    index = LocalIndex(None)
+    index.start()
+    assert index.ready and '/' not in index and index.get('/x') is None
+
+
+def test_file_system_is_asked_until_scanned(local_folder):
+    index = LocalIndex(local_folder)  # (not started)
+    assert not index.ready
+    assert index.get('/top.txt')['st_size'] == 5
+    assert '/A/B' in index and '/A/missing' not in index
+
+
+def test_changes(index, local_folder):
+    if index.mode != 'inotify':
+        pytest.skip('inotify is not available')
+    write(local_folder / 'A' / 'new.txt', b'123')
+    wait_for(lambda: '/A/new.txt' in index)
+    write(local_folder / 'top.txt', b'1')
+    wait_for(lambda: index.get('/top.txt')['st_size'] == 1)
+
+    (local_folder / 'A' / 'B' / 'C').mkdir()
+    write(local_folder / 'A' / 'B' / 'C' / 'c.txt')
+    wait_for(lambda: '/A/B/C/c.txt' in index)
+
+    os.rename(str(local_folder / 'A'), str(local_folder / 'Z'))
+    wait_for(lambda: '/Z/B/C/c.txt' in index)
+    assert '/A' not in index
+    assert not any(folder.startswith('/A') for folder in index.folders)
+    wait_for(lambda: not any(path.startswith('/A') for path in index._watch_ids))
+
+    os.remove(str(local_folder / 'Z' / 'B' / 'b.txt'))
+    wait_for(lambda: '/Z/B/b.txt' not in index)
+    assert len(index) == 8
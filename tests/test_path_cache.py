@@ -0,0 +1,40 @@
+from dropbox_fs.path_cache import PathCache
+
+
+def cached(cache, keys):
+    """ caches an attr for each key (and a listing for those ending with '/') """
+    for key in keys:
+        if key.endswith('/'):
+            cache.set_listing(key.rstrip('/') or '/', ['.', '..'], cache.generation)
+        else:
+            cache.set_attr(key, {}, cache.generation)
+
+
+def attrs(cache):
+    return sorted(cache._attrs)
+
+
+def test_deleted_folder_drops_its_subtree():
+    cache = PathCache()
+    cached(cache, ['/a', '/a/', '/a/b/c', '/a/b/c/', '/a/b/c/d.txt', '/a b', '/a b/e.txt', '/f.txt', '/'])
+    cache.invalidate([('/A', None)], 0)
+    assert attrs(cache) == ['/a b', '/a b/e.txt', '/f.txt']
+    assert sorted(cache._listings) == []  # (the root's listing changed as well)
+    assert set(cache._children) == {'/', '/a b'}
+
+
+def test_changes_in_a_base_path():
+    cache = PathCache()
+    cached(cache, ['/x', '/x/y', '/x/y/z', '/x/', '/w'])
+    cache.invalidate([('/Base/X/y', None)], 1)
+    assert attrs(cache) == ['/w']  # (the folders' attrs are dropped as well)
+    assert sorted(cache._listings) == []
+
+
+def test_evicted_entries_leave_the_index():
+    cache = PathCache(size=2)
+    cached(cache, ['/a/b/c', '/d', '/e/f'])
+    assert attrs(cache) == ['/d', '/e/f']
+    assert set(cache._children) == {'/', '/e'}
+    cache.clear()
+    assert len(cache._children) == 0
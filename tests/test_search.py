@@ -0,0 +1,50 @@
+from dropbox.files import DeletedMetadata, ListFolderResult
+from dropbox_fs.search import SearchIndex, parse_query
+from benchmarks.getattr import crawled
+from benchmarks.update_tree import file_entry, folder_entry
+
+
+def entry(path, i):
+    """ metadata of the file `path`, or the folder `path` if it ends with '/' """
+    return folder_entry(path[:-1], i) if path.endswith('/') else file_entry(path, i)
+
+
+def indexed(paths):
+    crawler = crawled([entry(p, i) for i, p in enumerate(paths)], None)
+    index = SearchIndex(crawler)
+    index.build()
+    return crawler, index
+
+
+def found(index, query):
+    return [path for path, _, _ in index.search(**parse_query(query))]
+
+
+def delete(crawler, path):
+    name = path.rsplit('/', 1)[1]
+    deleted = DeletedMetadata(name=name, path_lower=path.lower(), path_display=path)
+    crawler.update_tree(ListFolderResult(entries=[deleted], cursor='cursor', has_more=False))
+
+
+def test_removing_a_folder_removes_its_subtree():
+    crawler, index = indexed(['/Photos/', '/Photos/a.jpg', '/Photos/2020/', '/Photos/2020/b.jpg',
+                              '/Photos 2/', '/Photos 2/c.jpg', '/d.jpg'])
+    assert len(index) == 7
+    assert found(index, 'jpg in:/photos') == ['/Photos/2020/b.jpg', '/Photos/a.jpg']
+
+    delete(crawler, '/Photos')
+    assert len(index) == 3
+    assert found(index, 'jpg') == ['/Photos 2/c.jpg', '/d.jpg']
+    assert found(index, 'jpg in:/photos') == []
+    assert index.stats()['entries'] == 3
+
+
+def test_entries_come_back():
+    crawler, index = indexed(['/A/', '/A/B/', '/A/B/x.txt', '/y.txt'])
+    delete(crawler, '/A/B')
+    delete(crawler, '/y.txt')
+    assert found(index, 'txt') == []
+    crawler.update_tree(ListFolderResult(entries=[entry('/A/B/', 0), entry('/A/B/x.txt', 1)], cursor='cursor',
+                                         has_more=False))
+    assert found(index, 'txt') == ['/A/B/x.txt'] and found(index, 'x in:/a') == ['/A/B/x.txt']
+    assert len(index) == 3
@@ -0,0 +1,82 @@
+import pickle
+from threading import Event, Thread
+from dropbox_fs.crawler import DropboxCrawler, Folder, data_file
+from tests.conftest import new_file
+
+
+def new_crawler(storage):
+    crawler = DropboxCrawler()
+    crawler.storage = storage
+    crawler._db_token = 'token'
+    crawler._db_base_path = ''
+    crawler._local_folder = None
+    crawler._crawl_cursor = 'cursor'
+    crawler._partitions = None
+    crawler._update_cursor = None
+    crawler._finished_crawling = False
+    crawler.connect()
+    crawler.root = Folder('')
+    return crawler
+
+
+def locked_elsewhere(lock):
+    """ whether another thread holds `lock` """
+    acquired = []
+
+    def try_lock():
+        acquired.append(lock.acquire(timeout=0))
+        if acquired[0]:
+            lock.release()
+    t = Thread(target=try_lock)
+    t.start()
+    t.join()
+    return not acquired[0]
+
+
+def saved_names():
+    with open(data_file, 'rb') as f:
+        return sorted(item.name for item in pickle.load(f)['root'])
+
+
+def test_tree_changes_while_saving(monkeypatch):
+    crawler = new_crawler('journal')  # (the first save is a full snapshot)
+    crawler.apply_local([('/a', new_file('a'))])
+    writing, done = Event(), Event()
+    write = DropboxCrawler._write
+
+    def slow_write(data):
+        writing.set()
+        assert done.wait(10)
+        write(data)
+    monkeypatch.setattr(DropboxCrawler, '_write', staticmethod(slow_write))
+    saving = Thread(target=crawler.save_snapshot)
+    saving.start()
+    assert writing.wait(10)
+    changing = Thread(target=crawler.apply_local, args=([('/b', new_file('b'))],))
+    changing.start()
+    changing.join(5)
+    assert not changing.is_alive()  # (didn't wait for the save)
+    done.set()
+    saving.join(10)
+
+    assert saved_names() == ['a', 'b']  # (either way, it is delivered again)
+    assert [path for path, _ in crawler._unsaved_changes] == ['/b']  # (for the next journal record)
+
+
+def test_tree_changed_while_pickling(monkeypatch):
+    crawler = new_crawler('pickle')
+    crawler.apply_local([('/a', new_file('a'))])
+    locked = []
+    write = DropboxCrawler._write
+
+    def changed_write(data):
+        locked.append(locked_elsewhere(crawler._lock))
+        if len(locked) == 1:
+            raise RuntimeError('dictionary changed size during iteration')
+        write(data)
+    monkeypatch.setattr(DropboxCrawler, '_write', staticmethod(changed_write))
+    saving = Thread(target=crawler.save_snapshot)
+    saving.start()
+    saving.join(10)
+    assert locked == [False, True]  # (pickled again under the lock)
+    assert saved_names() == ['a']
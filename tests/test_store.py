@@ -0,0 +1,103 @@
+from dropbox_fs.crawler import DropboxCrawler, Folder, LazyFolder, data_version, db_file, store_changes
+from dropbox_fs.store import SqliteStore
+from tests.conftest import new_file
+
+
+def header(**values):
+    data = dict(data_version=data_version, storage='sqlite', root_path='', local_folder=None, db_token='token',
+                partitions=None, crawl_cursor=None, update_cursor='cursor', finished_crawling=True,
+                last_save=1600000000.)
+    data.update(values)
+    return data
+
+
+def saved_store(changes):
+    store = SqliteStore(db_file)
+    with store.transaction():
+        store_changes(store, changes, 0)
+    store.set_meta(header())
+    store.close()
+
+
+def loaded():
+    crawler = DropboxCrawler()
+    assert crawler.load_snapshot()
+    assert isinstance(crawler.root, LazyFolder)
+    return crawler
+
+
+def test_round_trip():
+    saved_store([('/Photos', Folder('Photos')),
+                 ('/Photos/2020/Beach.JPG', new_file('Beach.JPG', 123)),
+                 ('/Notes.txt', new_file('Notes.txt', 5, rev=None))])
+    crawler = loaded()
+    assert crawler._update_cursor == 'cursor' and crawler.storage == 'sqlite'
+    root = crawler.root
+    assert sorted(item.name for item in root) == ['Notes.txt', 'Photos']
+    photos = root.get_folder('photos')
+    assert photos.name == 'Photos' and not photos.is_loaded()
+    beach = photos.get_folder('2020').get_file('beach.jpg')
+    assert photos.is_loaded()
+    assert (beach.name, beach.size, beach.modified, beach.rev, beach.content_hash) == \
+        ('Beach.JPG', 123, 1600000123, '0123456789abcdef', bytes(range(32)))
+    assert root.get_file('notes.txt').rev is None
+    crawler._store.close()
+
+
+def test_changes_replace_and_delete():
+    saved_store([('/A/b.txt', new_file('b.txt')),
+                 ('/A/Sub/c.txt', new_file('c.txt')),
+                 ('/X', new_file('X')),
+                 ('/A/b.txt', new_file('b.txt', 7)),  # modified
+                 ('/A/Sub', new_file('Sub', 2)),  # a file replaces the folder and everything below it
+                 ('/X', Folder('X')),  # a folder replaces the file
+                 ('/A/b.txt', None)])
+    crawler = loaded()
+    a = crawler.root.get_folder('a')
+    assert [(item.name, item.size) for item in a] == [('Sub', 2)]
+    assert isinstance(crawler.root.get('x'), Folder)
+    store = crawler._store
+    assert store.children('a/sub') == []
+    store.close()
+
+
+def test_folder_names_keep_their_case():
+    saved_store([('/photos/a.jpg', new_file('a.jpg')), ('/Photos', Folder('Photos'))])
+    crawler = loaded()
+    assert [item.name for item in crawler.root] == ['Photos']
+    crawler._store.close()
+
+
+def test_other_data_version_is_rejected():
+    store = SqliteStore(db_file)
+    store.set_meta(header(data_version=data_version - 1))
+    store.close()
+    assert not DropboxCrawler().load_snapshot()
+
+
+def test_empty_store_is_rejected():
+    SqliteStore(db_file).close()
+    assert not DropboxCrawler().load_snapshot()
+
+
+def test_least_recently_used_folders_are_unloaded():
+    saved_store([('/F{}/file'.format(i), new_file('file')) for i in range(4)])
+    store = SqliteStore(db_file, cache_size=2)
+    root = LazyFolder('', store, '')
+    folders = [root.get_folder('f{}'.format(i)) for i in range(4)]
+    len(folders[0])
+    len(folders[1])
+    len(folders[0])  # (touches it, so F1 is the least recently used one now)
+    len(folders[2])
+    assert [f.is_loaded() for f in folders] == [True, False, True, False]
+    assert folders[1].get_file('FILE') is not None  # loaded again
+    store.close()
+
+
+def test_meta_round_trip():
+    store = SqliteStore(db_file)
+    assert store.get_meta() is None
+    store.set_meta(header(update_cursor='a'))
+    store.set_meta(header(update_cursor='b'))
+    assert store.get_meta() == header(update_cursor='b')
+    store.close()
@@ -0,0 +1,175 @@
+import errno
+import os
+import time
+import pytest
+from dropbox.files import ListFolderResult
+from fuse import FuseOSError
+from dropbox_fs.cache import FileCache
+from dropbox_fs.fs import DropboxFs
+from dropbox_fs.writeback import WriteCache
+from benchmarks.fake_dropbox import FakeDropbox, FakeCrawler
+
+
+def mounted(dbx, tmp_path):
+    """ a writable `DropboxFs` of the files added to `dbx`, its uploader isn't started yet """
+    crawler = FakeCrawler(dbx)
+    crawler.init('token', '')
+    crawler._finished_crawling = True
+    crawler.update_tree(ListFolderResult(entries=list(dbx.entries.values()), cursor='cursor', has_more=False))
+    file_cache = FileCache(tmp_path / 'cache', dbx)
+    file_cache.scheduler.session = dbx.session
+    fs = DropboxFs(crawler, file_cache)
+    fs.write_cache = WriteCache(tmp_path / 'uploads', crawler, file_cache, 4)
+    fs.write_cache.delay = 0
+    fs.write_cache.chunk_size = 1024
+    return fs
+
+
+def write(fs, path, data):
+    fh = fs('create', path, 0o644)
+    fs('write', path, data, 0, fh)
+    fs('release', path, fh)
+
+
+def uploaded(fs, timeout=10):
+    """ waits until everything is uploaded (or failed for good) """
+    deadline = time.time() + timeout
+    stats = fs.write_cache.stats()
+    while stats['pending'] > stats['failed'] or stats['uploading'] > 0:
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+        stats = fs.write_cache.stats()
+
+
+def test_batch_of_upload_sessions(tmp_path):
+    dbx = FakeDropbox()
+    fs = mounted(dbx, tmp_path)
+    files = {'/a.txt': b'a' * 100, '/b.txt': b'b' * 2500, '/c.txt': b''}  # (b needs two appends)
+    for path, data in files.items():
+        write(fs, path, data)
+    fs.write_cache.start()  # (finds all three due at once)
+    uploaded(fs)
+    for path, data in files.items():
+        assert dbx.files[path] == data
+        assert fs.crawler.root.get_file(path[1:]).size == len(data)
+    assert dbx.calls['files_upload_session_start'] == 3
+    assert dbx.calls['files_upload_session_append_v2'] == 2
+    assert dbx.calls['files_upload_session_finish_batch_v2'] == 1
+    assert 'files_upload' not in dbx.calls
+    stats = fs.write_cache.stats()
+    assert stats['batches'] == 1 and stats['sessions'] == 3 and stats['uploaded_files'] == 3
+
+
+def test_single_small_file_is_uploaded_directly(tmp_path):
+    dbx = FakeDropbox()
+    fs = mounted(dbx, tmp_path)
+    fs.write_cache.start()
+    fh = fs('create', '/a.txt', 0o644)
+    fs('write', '/a.txt', b'abc', 0, fh)
+    fs('fsync', '/a.txt', 0, fh)  # (waits for the upload)
+    assert dbx.files['/a.txt'] == b'abc'
+    fs('release', '/a.txt', fh)
+    assert 'files_upload_session_start' not in dbx.calls  # (the new empty file may have been uploaded first)
+
+
+def test_failed_entries_of_a_batch(tmp_path):
+    dbx = FakeDropbox()
+    fs = mounted(dbx, tmp_path)
+    finish = dbx.files_upload_session_finish_batch_v2
+
+    def lose_a_session(entries):  # (the session of b.txt expired)
+        dbx._sessions.pop(next(e.cursor.session_id for e in entries if e.commit.path == '/b.txt'))
+        return finish(entries)
+    dbx.files_upload_session_finish_batch_v2 = lose_a_session
+    for path in ['/a.txt', '/b.txt', '/c.txt']:
+        write(fs, path, path.encode())
+    fs.write_cache.start()
+    uploaded(fs)
+    assert sorted(p for p in dbx.files if not p.startswith('rev:')) == ['/a.txt', '/c.txt']
+    stats = fs.write_cache.stats()
+    assert stats['failed'] == 1 and stats['failures'] == 1 and stats['local_copies'] == 1
+    assert fs('getattr', '/b.txt')['st_size'] == 6  # (still there, from the local copy)
+
+    dbx.files_upload_session_finish_batch_v2 = finish
+    fh = fs('open', '/b.txt', os.O_WRONLY)
+    fs('write', '/b.txt', b'B', 0, fh)  # (a change tries it again)
+    fs('fsync', '/b.txt', 0, fh)
+    fs('release', '/b.txt', fh)
+    assert dbx.files['/b.txt'] == b'Bb.txt'
+
+
+def test_fsync_reports_a_failed_upload(tmp_path):
+    dbx = FakeDropbox()
+    fs = mounted(dbx, tmp_path)
+
+    def full(*args, **kwargs):
+        raise ValueError('insufficient_space')
+    dbx.files_upload = full
+    fs.write_cache.start()
+    fh = fs('create', '/a.txt', 0o644)
+    fs('write', '/a.txt', b'abc', 0, fh)
+    with pytest.raises(FuseOSError) as e:
+        fs('fsync', '/a.txt', 0, fh)
+    assert e.value.errno == errno.EIO
+    fs('release', '/a.txt', fh)
+    assert fs.write_cache.pending() == 1
+
+
+def test_conflicts(tmp_path):
+    dbx = FakeDropbox()
+    dbx.add_file('/a.txt', b'old', '000000001')
+    fs = mounted(dbx, tmp_path)
+    fs('mkdir', '/Folder', 0o755)
+    with pytest.raises(FuseOSError) as e:  # (created by someone else in the meantime)
+        fs.write_cache.mkdir('/folder')
+    assert e.value.errno == errno.EEXIST
+
+    fh = fs('open', '/a.txt', os.O_WRONLY)
+    fs('write', '/a.txt', b'mine', 0, fh)
+    fs('release', '/a.txt', fh)
+    dbx.files_upload(b'theirs', '/a.txt')  # (changed remotely before the upload)
+    fs.write_cache.start()
+    uploaded(fs)
+    assert dbx.files['/a.txt'] == b'mine'  # (the last writer wins)
+
+
+def test_uploads_resume_after_a_restart(tmp_path):
+    dbx = FakeDropbox()
+    fs = mounted(dbx, tmp_path)
+    write(fs, '/a.txt', b'abc')
+    write(fs, '/b.txt', b'def')
+    fs.write_cache.save()  # (exits before uploading them)
+    (tmp_path / 'uploads' / 'left over').write_bytes(b'?')
+
+    fs = mounted(dbx, tmp_path)
+    fs.write_cache.start()
+    assert sorted(fs('readdir', '/', 0)) == ['.', '..', 'a.txt', 'b.txt']
+    uploaded(fs)
+    assert dbx.files['/a.txt'] == b'abc' and dbx.files['/b.txt'] == b'def'
+    assert not (tmp_path / 'uploads' / 'left over').exists()
+
+
+def test_errors_of_truncate_and_rename(tmp_path):
+    dbx = FakeDropbox()
+    dbx.add_file('/a.txt', b'abc', '000000001')
+    dbx.add_file('/full/b.txt', b'b', '000000001')
+    fs = mounted(dbx, tmp_path)
+    fs('mkdir', '/empty', 0o755)
+    write(fs, '/new.txt', b'new')  # (only in the write cache)
+    for path, length, error in ('/missing.txt', 0, errno.ENOENT), ('/full', 0, errno.EISDIR):
+        with pytest.raises(FuseOSError) as e:
+            fs('truncate', path, length)
+        assert e.value.errno == error
+    assert '/missing.txt' not in fs.write_cache
+    fs('truncate', '/new.txt', 1)
+    assert fs('getattr', '/new.txt')['st_size'] == 1
+
+    for old, new, error in [('/a.txt', '/empty', errno.EISDIR), ('/new.txt', '/empty', errno.EISDIR),
+                            ('/empty', '/a.txt', errno.ENOTDIR), ('/empty', '/new.txt', errno.ENOTDIR),
+                            ('/empty', '/full', errno.ENOTEMPTY), ('/missing.txt', '/b.txt', errno.ENOENT)]:
+        with pytest.raises(FuseOSError) as e:
+            fs('rename', old, new)
+        assert e.value.errno == error, (old, new)
+    assert 'files_move_v2' not in dbx.calls
+    fs('rename', '/new.txt', '/a.txt')  # (a file replaces a file)
+    assert fs('getattr', '/a.txt')['st_size'] == 1